@@ -38,8 +38,15 @@ def main():
 @click.option('--host', default='0.0.0.0')
 @click.option('--port', default=5000)
 @click.option('--debug', default=False)
+@click.option('--production', default=False, is_flag=True, help='Serve with gunicorn instead of the flask dev server')
+@click.option('--workers', default=1, help='Number of gunicorn worker processes')
+@click.option('--threads', default=8, help='Number of request threads per gunicorn worker')
+@click.option('--max-batch-size', default=64, help='Maximum number of questions batched into one guess call')
+@click.option('--max-wait-ms', default=5.0, help='Maximum time a question waits for others to batch with')
+@click.option('--guess-cache/--no-guess-cache', default=True, help='Cache guesses as configured in guess_cache')
 @click.argument('guessers', nargs=-1)
-def guesser_api(host, port, debug, guessers):
+def guesser_api(host, port, debug, production, workers, threads, max_batch_size, max_wait_ms, guess_cache,
+                guessers):
     if debug:
         log.warn(
             'WARNING: debug mode in flask can expose environment variables, including AWS keys, NEVER use this when the API is exposed to the web')
@@ -48,7 +55,11 @@ def guesser_api(host, port, debug, guessers):
         if confirmation != 'yes':
             raise ValueError('Most confirm enabling debug mode')
 
-    AbstractGuesser.multi_guesser_web_api(guessers, host=host, port=port, debug=debug)
+    AbstractGuesser.multi_guesser_web_api(
+        guessers, host=host, port=port, debug=debug,
+        production=production, workers=workers, threads=threads,
+        max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, guess_cache=guess_cache
+    )
 
 
 def run_guesser(n_times, workers, guesser_qualified_class):
@@ -69,6 +80,67 @@ def guesser_pipeline(n_times, workers, guesser_qualified_class):
     run_guesser(n_times, workers, guesser_qualified_class)
 
 
+@main.command()
+@click.option('--fp16-embeddings', default=False, is_flag=True)
+@click.option('--report/--no-report', default=None,
+              help='Compare accuracy and CPU latency with the original, by default only when CUDA is not in use')
+@click.option('--fold', default='guessdev')
+@click.argument('directory')
+@click.argument('output_directory')
+def quantize_dan(fp16_embeddings, report, fold, directory, output_directory):
+    """
+    Export an int8 dynamically quantized copy of the DanGuesser saved in directory to output_directory
+    """
+    from qanta.guesser.dan import DanGuesser, compare_quantized, CUDA
+    if report is None:
+        report = not CUDA
+        if CUDA:
+            log.info('Skipping the quantization report since CUDA is in use, set QB_FORCE_CPU=1 to produce it')
+    elif report and CUDA:
+        # Checked before exporting so that the export is not written only for the report to fail afterwards
+        raise click.UsageError('The quantization report compares CPU latency, set QB_FORCE_CPU=1 or pass --no-report')
+    guesser = DanGuesser.load(directory)
+    shell(f'mkdir -p {output_directory}')
+    guesser.save_quantized(output_directory, fp16_embeddings=fp16_embeddings)
+    if report:
+        log.info(json.dumps(compare_quantized(directory, output_directory, fold=fold), indent=2))
+
+
+@main.command()
+@click.argument('dataset_paths', nargs=-1)
+def build_dataset_snapshot(dataset_paths):
+    """
+    Build binary snapshots of qanta dataset json files, by default the mapped and expo datasets. Snapshots are also
+    built automatically the first time QantaDatabase loads a dataset.
+    """
+    from qanta.datasets.snapshot import build_snapshot
+    from qanta.util.constants import QANTA_MAPPED_DATASET_PATH, QANTA_EXPO_DATASET_PATH
+    if len(dataset_paths) == 0:
+        dataset_paths = [p for p in (QANTA_MAPPED_DATASET_PATH, QANTA_EXPO_DATASET_PATH) if path.exists(p)]
+    for p in dataset_paths:
+        build_snapshot(p)
+
+
+@main.command()
+@click.option('--n-sentences', default=5)
+@click.option('--replace-title-mentions', default='')
+@click.option('--workers', default=1)
+def build_wiki_sentence_cache(n_sentences, replace_title_mentions, workers):
+    """
+    Extract and cache wikipedia sentences for every training answer with the given settings
+    """
+    from qanta.datasets.quiz_bowl import get_qanta_database
+    from qanta.wikipedia.cached_wikipedia import Wikipedia, WikiSentenceCache, wiki_sentences
+    pages = {q.page for q in get_qanta_database().train_questions}
+    wiki_lookup = Wikipedia()
+    cache = WikiSentenceCache.for_store(wiki_lookup.lookup)
+    wiki_sentences(
+        wiki_lookup, pages, n_sentences,
+        replace_title_mentions=replace_title_mentions, n_workers=workers, cache=cache
+    )
+    cache.close()
+
+
 @main.command()
 @click.option('--n', default=20)
 def sample_answer_pages(n):
@@ -354,8 +426,8 @@ def process_annotated_test(question_tsv):
 @click.argument('adversarial_json')
 @click.argument('json_dir')
 def adversarial_to_json(adversarial_json, json_dir):
-    from qanta.datasets.quiz_bowl import QantaDatabase
-    db = QantaDatabase()
+    from qanta.datasets.quiz_bowl import get_qanta_database
+    db = get_qanta_database()
     lookup = {q.page.lower(): q.page for q in db.mapped_questions}
     with open(adversarial_json) as f:
         questions = json.load(f)
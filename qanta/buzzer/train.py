@@ -8,7 +8,7 @@ from chainer.training import extensions
 
 from qanta.buzzer.nets import RNNBuzzer
 from qanta.buzzer.args import args
-from qanta.buzzer.util import read_data, convert_seq, output_dir
+from qanta.buzzer.util import read_data, BucketIterator, convert_bucket, output_dir
 from qanta.util.constants import BUZZER_TRAIN_FOLD, BUZZER_DEV_FOLD
 
 
@@ -18,8 +18,8 @@ def main():
     print('# train data: {}'.format(len(train)))
     print('# valid data: {}'.format(len(valid)))
 
-    train_iter = chainer.iterators.SerialIterator(train, args.batch_size)
-    valid_iter = chainer.iterators.SerialIterator(
+    train_iter = BucketIterator(train, args.batch_size)
+    valid_iter = BucketIterator(
             valid, args.batch_size, repeat=False, shuffle=False)
 
     args.n_input = train[0][1][0].shape[0]
@@ -29,6 +29,8 @@ def main():
     if args.gpu >= 0:
         chainer.backends.cuda.get_device_from_id(args.gpu).use()
         model.to_gpu()
+        train_iter.to_device(args.gpu)
+        valid_iter.to_device(args.gpu)
 
     optimizer = chainer.optimizers.Adam()
     optimizer.setup(model)
@@ -36,12 +38,12 @@ def main():
 
     updater = training.updaters.StandardUpdater(
         train_iter, optimizer,
-        converter=convert_seq, device=args.gpu)
+        converter=convert_bucket, device=args.gpu)
     trainer = training.Trainer(updater, (args.epoch, 'epoch'), out=output_dir)
 
     trainer.extend(extensions.Evaluator(
         valid_iter, model,
-        converter=convert_seq, device=args.gpu))
+        converter=convert_bucket, device=args.gpu))
 
     record_trigger = training.triggers.MaxValueTrigger(
         'validation/main/accuracy', (1, 'epoch'))
@@ -1,12 +1,17 @@
 import os
+import json
 import pickle
+import hashlib
 import numpy as np
+import pandas as pd
 import chainer
 from tqdm import tqdm
 from multiprocessing import Pool
 from functools import partial
+from collections import namedtuple
 from chainer import Variable
 from chainer.backends import cuda
+from qanta.config import conf
 from qanta.datasets.quiz_bowl import QuizBowlDataset
 from qanta.guesser.abstract import AbstractGuesser
 from qanta.util.constants import BUZZER_DEV_FOLD, BUZZER_TRAIN_FOLD
@@ -14,11 +19,83 @@ from qanta.util.constants import BUZZER_DEV_FOLD, BUZZER_TRAIN_FOLD
 # constansts
 N_GUESSES = 10
 output_dir = 'output/buzzer'
-dataset_dir = 'output/buzzer/data_{}.pkl'
+dataset_dir = 'output/buzzer/data_{}_{}.pkl'
 buzzes_dir = 'output/buzzer/{}_buzzes.pkl'
 report_dir = 'output/buzzer/report'
 
 
+def _shift(matrix, question_start, fill):
+    """
+    Return the previous row of matrix for each row, or fill for the first row of each question
+    """
+    shifted = np.empty_like(matrix)
+    shifted[1:] = matrix[:-1]
+    shifted[question_start] = fill
+    return shifted
+
+
+def guess_features(value_matrices, guess_ids, question_start):
+    '''vectorized feature extractor shared by the vector converters
+
+    Args:
+        value_matrices: list of [n_positions, N_GUESSES] arrays of guess
+            values sorted by score, padded with 0. [prob] gives the layout of
+            vector_converter_0 and [logit, prob] the layout of
+            vector_converter_1
+        guess_ids: [n_positions, N_GUESSES] integer ids of the guesses,
+            padded with -1
+        question_start: [n_positions] bool, True at the first position of
+            each question
+    Returns:
+        [n_positions, n_features] float32 array
+    '''
+    n_guesses = guess_ids.shape[1]
+    valid = guess_ids >= 0
+    prev_ids = _shift(guess_ids, question_start, -1)
+    prev_matrices = [_shift(v, question_start, 0) for v in value_matrices]
+
+    # For each guess find whether it was among the previous position's guesses and its value there
+    in_prev = np.zeros(guess_ids.shape, dtype=np.bool_)
+    prev_values = [np.zeros_like(v) for v in value_matrices]
+    for j in range(n_guesses):
+        match = valid & (guess_ids == prev_ids[:, j:j + 1])
+        in_prev |= match
+        for prev_v, prev_matrix in zip(prev_values, prev_matrices):
+            np.copyto(prev_v, np.broadcast_to(prev_matrix[:, j:j + 1], prev_v.shape), where=match)
+    isnew = (valid & ~in_prev).astype(np.float64)
+    diffs = [np.where(in_prev, v - prev_v, v) for v, prev_v in zip(value_matrices, prev_values)]
+
+    pairs = list(zip(value_matrices, prev_matrices))
+    columns = [v[:, :3] for v in value_matrices]
+    columns.append(isnew[:, :3])
+    columns.extend(d[:, :3] for d in diffs)
+    columns.extend(np.stack([v[:, 0] - v[:, 1], v[:, 1] - v[:, 2]], axis=1) for v in value_matrices)
+    columns.extend(np.stack([v[:, 0] - p[:, 0], v[:, 1] - p[:, 1]], axis=1) for v, p in pairs)
+    columns.append(isnew[:, :5].sum(axis=1, keepdims=True))
+    columns.extend(np.stack([v.mean(axis=1), p.mean(axis=1)], axis=1) for v, p in pairs)
+    columns.extend(np.stack([v[:, :6].mean(axis=1), p[:, :5].mean(axis=1)], axis=1) for v, p in pairs)
+    columns.extend(np.stack([v.var(axis=1), p.var(axis=1)], axis=1) for v, p in pairs)
+    columns.extend(np.stack([v[:, :5].var(axis=1), p[:, :5].var(axis=1)], axis=1) for v, p in pairs)
+    return np.concatenate(columns, axis=1).astype(np.float32)
+
+
+def _sequence_features(guesses_sequence, n_values):
+    length = len(guesses_sequence)
+    if length == 0:
+        return []
+    guess_ids = np.full((length, N_GUESSES), -1, dtype=np.int64)
+    value_matrices = [np.zeros((length, N_GUESSES)) for _ in range(n_values)]
+    guess_to_id = {}
+    for i, guesses in enumerate(guesses_sequence):
+        for k, guess in enumerate(guesses[:N_GUESSES]):
+            guess_ids[i, k] = guess_to_id.setdefault(guess[0], len(guess_to_id))
+            for v in range(n_values):
+                value_matrices[v][i, k] = guess[v + 1]
+    question_start = np.zeros(length, dtype=np.bool_)
+    question_start[0] = True
+    return list(guess_features(value_matrices, guess_ids, question_start))
+
+
 def vector_converter_0(guesses_sequence):
     '''vector converter / feature extractor with only prob
 
@@ -28,44 +105,7 @@ def vector_converter_0(guesses_sequence):
     Returns:
         a sequence of vectors
     '''
-    length = len(guesses_sequence)
-    prev_prob_vec = [0. for _ in range(N_GUESSES)]
-    prev_dict = dict()
-
-    vecs = []
-    for i in range(length):
-        prob_vec = []
-        prob_diff_vec = []
-        isnew_vec = []
-        guesses = guesses_sequence[i]
-        for guess, prob in guesses:
-            prob_vec.append(prob)
-            if i > 0 and guess in prev_dict:
-                prev_prob = prev_dict[guess]
-                prob_diff_vec.append(prob - prev_prob)
-                isnew_vec.append(0)
-            else:
-                prob_diff_vec.append(prob)
-                isnew_vec.append(1)
-        if len(guesses) < N_GUESSES:
-            for k in range(max(N_GUESSES - len(guesses), 0)):
-                prob_vec.append(0)
-                prob_diff_vec.append(0)
-                isnew_vec.append(0)
-        features = prob_vec[:3] \
-            + isnew_vec[:3] \
-            + prob_diff_vec[:3] \
-            + [prob_vec[0] - prob_vec[1], prob_vec[1] - prob_vec[2]] \
-            + [prob_vec[0] - prev_prob_vec[0], prob_vec[1] - prev_prob_vec[1]] \
-            + [sum(isnew_vec[:5])] \
-            + [np.average(prob_vec), np.average(prev_prob_vec)] \
-            + [np.average(prob_vec[:6]), np.average(prev_prob_vec[:5])] \
-            + [np.var(prob_vec), np.var(prev_prob_vec)] \
-            + [np.var(prob_vec[:5]), np.var(prev_prob_vec[:5])]
-        vecs.append(np.array(features, dtype=np.float32))
-        prev_prob_vec = prob_vec
-        prev_dict = {g: p for g, p in guesses}
-    return vecs
+    return _sequence_features(guesses_sequence, 1)
 
 
 def vector_converter_1(guesses_sequence):
@@ -77,61 +117,76 @@ def vector_converter_1(guesses_sequence):
     Returns:
         a sequence of vectors
     '''
-    length = len(guesses_sequence)
-    prev_logit_vec = [0. for _ in range(N_GUESSES)]
-    prev_prob_vec = [0. for _ in range(N_GUESSES)]
-    prev_dict = dict()
-
-    vecs = []
-    for i in range(length):
-        logit_vec = []
-        prob_vec = []
-        logit_diff_vec = []
-        prob_diff_vec = []
-        isnew_vec = []
-        guesses = guesses_sequence[i]
-        for guess, logit, prob in guesses:
-            logit_vec.append(logit)
-            prob_vec.append(prob)
-            if i > 0 and guess in prev_dict:
-                prev_logit, prev_prob = prev_dict[guess]
-                logit_diff_vec.append(logit - prev_logit)
-                prob_diff_vec.append(prob - prev_prob)
-                isnew_vec.append(0)
-            else:
-                logit_diff_vec.append(logit)
-                prob_diff_vec.append(prob)
-                isnew_vec.append(1)
-        if len(guesses) < N_GUESSES:
-            for k in range(max(N_GUESSES - len(guesses), 0)):
-                logit_vec.append(0)
-                prob_vec.append(0)
-                logit_diff_vec.append(0)
-                prob_diff_vec.append(0)
-                isnew_vec.append(0)
-        features = logit_vec[:3] \
-            + prob_vec[:3] \
-            + isnew_vec[:3] \
-            + logit_diff_vec[:3] \
-            + prob_diff_vec[:3] \
-            + [logit_vec[0] - logit_vec[1], logit_vec[1] - logit_vec[2]] \
-            + [prob_vec[0] - prob_vec[1], prob_vec[1] - prob_vec[2]] \
-            + [logit_vec[0] - prev_logit_vec[0], logit_vec[1] - prev_logit_vec[1]] \
-            + [prob_vec[0] - prev_prob_vec[0], prob_vec[1] - prev_prob_vec[1]] \
-            + [sum(isnew_vec[:5])] \
-            + [np.average(logit_vec), np.average(prev_logit_vec)] \
-            + [np.average(prob_vec), np.average(prev_prob_vec)] \
-            + [np.average(logit_vec[:6]), np.average(prev_logit_vec[:5])] \
-            + [np.average(prob_vec[:6]), np.average(prev_prob_vec[:5])] \
-            + [np.var(logit_vec), np.var(prev_logit_vec)] \
-            + [np.var(prob_vec), np.var(prev_prob_vec)] \
-            + [np.var(logit_vec[:5]), np.var(prev_logit_vec[:5])] \
-            + [np.var(prob_vec[:5]), np.var(prev_prob_vec[:5])]
-        vecs.append(np.array(features, dtype=np.float32))
-        prev_logit_vec = logit_vec
-        prev_prob_vec = prob_vec
-        prev_dict = {x: (y, z) for x, y, z in guesses}
-    return vecs
+    return _sequence_features(guesses_sequence, 2)
+
+
+def fold_features(qanta_ids, char_indices, guess_ids, scores):
+    '''compute vector_converter_0 features for the guesses of a whole fold
+
+    Args:
+        qanta_ids, char_indices, guess_ids, scores: one entry per guess,
+            guess_ids are integer codes of the guessed pages
+    Returns:
+        qanta_id, char_index, and top guess id of each position sorted by
+        qanta_id then char_index, and the [n_positions, n_features] features
+    '''
+    order = np.lexsort((-scores, char_indices, qanta_ids))
+    qanta_ids = qanta_ids[order]
+    char_indices = char_indices[order]
+    guess_ids = guess_ids[order]
+    scores = scores[order]
+
+    position_start = np.empty(len(order), dtype=np.bool_)
+    position_start[:1] = True
+    position_start[1:] = (qanta_ids[1:] != qanta_ids[:-1]) | (char_indices[1:] != char_indices[:-1])
+    starts = np.flatnonzero(position_start)
+    position = np.cumsum(position_start) - 1
+    rank = np.arange(len(order)) - starts[position]
+    keep = rank < N_GUESSES
+
+    n_positions = len(starts)
+    id_matrix = np.full((n_positions, N_GUESSES), -1, dtype=np.int64)
+    score_matrix = np.zeros((n_positions, N_GUESSES))
+    id_matrix[position[keep], rank[keep]] = guess_ids[keep]
+    score_matrix[position[keep], rank[keep]] = scores[keep]
+
+    position_qanta_ids = qanta_ids[starts]
+    question_start = np.empty(n_positions, dtype=np.bool_)
+    question_start[:1] = True
+    question_start[1:] = position_qanta_ids[1:] != position_qanta_ids[:-1]
+    features = guess_features([score_matrix], id_matrix, question_start)
+    return position_qanta_ids, char_indices[starts], id_matrix[:, 0], features
+
+
+def build_dataset(guess_df, questions):
+    '''convert the guesser output of a fold into the format used by the
+        buzzer with vector_converter_0 features, equivalent to
+        process_question on every question
+
+    Args:
+        guess_df: guesses with qanta_id, char_index, guess, and score columns
+        questions: dictionary from qanta_id to question
+    Returns:
+        list of (qanta_id, features, labels, char_indices) sorted by qanta_id
+    '''
+    if len(guess_df) == 0:
+        return []
+    guess_ids, pages = pd.factorize(guess_df.guess.values)
+    page_to_id = {p: i for i, p in enumerate(pages)}
+    qanta_ids, char_indices, top_guess_ids, features = fold_features(
+        guess_df.qanta_id.values, guess_df.char_index.values, guess_ids, guess_df.score.values)
+
+    question_starts = np.flatnonzero(np.r_[True, qanta_ids[1:] != qanta_ids[:-1]])
+    question_ends = np.r_[question_starts[1:], len(qanta_ids)]
+    question_ids = qanta_ids[question_starts].tolist()
+    answer_ids = np.array([page_to_id.get(questions[qid].page, -1) for qid in question_ids])
+    position_answer_ids = np.repeat(answer_ids, question_ends - question_starts)
+    labels = (top_guess_ids == position_answer_ids).astype(np.int64)
+
+    dataset = []
+    for qid, start, end in zip(question_ids, question_starts, question_ends):
+        dataset.append((qid, features[start:end], labels[start:end].tolist(), char_indices[start:end].tolist()))
+    return dataset
 
 
 def process_question(questions, vector_converter, item):
@@ -153,36 +208,90 @@ def process_question(questions, vector_converter, item):
     return qid, vectors, labels, char_indices
 
 
+def guess_file_fingerprint(g_dir, fold, output_type):
+    '''identify the guess file read_data reads by its path, modification
+        time, and size
+    '''
+    path = AbstractGuesser.guess_path(g_dir, fold, output_type)
+    if not os.path.exists(path):
+        path = AbstractGuesser.legacy_guess_path(g_dir, fold, output_type)
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def dataset_key(guess_fingerprint, vector_converter, fold):
+    '''hash of everything the features built by read_data depend on'''
+    key = {
+        'guesses': guess_fingerprint,
+        'converter': f'{vector_converter.__module__}.{vector_converter.__qualname__}',
+        'n_guesses': N_GUESSES,
+        'fold': fold
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def write_dataset(path, records):
+    '''pickle records one at a time to path and return them as a list. The
+        file is written to a temporary path and renamed so that concurrent
+        experiments never read a partial dataset.
+    '''
+    dataset = []
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        for record in records:
+            pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            dataset.append(record)
+    os.replace(tmp_path, path)
+    return dataset
+
+
+def load_dataset(path):
+    dataset = []
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                dataset.append(pickle.load(f))
+            except EOFError:
+                return dataset
+
+
 def read_data(
         fold,
         output_type='char',
         guesser_module='qanta.guesser.dan',
         guesser_class='DanGuesser',
         guesser_config_num=0,
-        vector_converter=vector_converter_0):
-
-    if os.path.isfile(dataset_dir.format(fold)):
-        with open(dataset_dir.format(fold), 'rb') as f:
-            return pickle.load(f)
+        vector_converter=vector_converter_0,
+        n_workers=None):
+    '''load buzzer features for the guesses of a guesser on fold, building
+        them if no cached copy matches the guess file, converter, N_GUESSES,
+        and fold
 
+    Args:
+        n_workers: processes used by converters other than
+            vector_converter_0, by default the buzzer n_cores setting
+    '''
     g_dir = AbstractGuesser.output_path(
         guesser_module, guesser_class, guesser_config_num, '')
-    g_path = AbstractGuesser.guess_path(g_dir, fold, output_type)
-    with open(g_path, 'rb') as f:
-        df = pickle.load(f)
-    df_groups = df.groupby('qanta_id')
+    key = dataset_key(guess_file_fingerprint(g_dir, fold, output_type), vector_converter, fold)
+    cache_path = dataset_dir.format(fold, key)
+    if os.path.isfile(cache_path):
+        return load_dataset(cache_path)
+
+    df = AbstractGuesser.load_guesses(g_dir, output_type=output_type, folds=[fold])
 
     questions = QuizBowlDataset(buzzer_train=True).questions_by_fold()
     questions = {q.qanta_id: q for q in questions[fold]}
 
-    pool = Pool(8)
-    worker = partial(process_question, questions, vector_converter)
-    dataset = pool.map(worker, df_groups)
-
-    with open(dataset_dir.format(fold), 'wb') as f:
-        return pickle.dump(dataset, f)
-
-    return dataset
+    os.makedirs(output_dir, exist_ok=True)
+    if vector_converter is vector_converter_0:
+        return write_dataset(cache_path, build_dataset(df, questions))
+    else:
+        if n_workers is None:
+            n_workers = conf['buzzer']['n_cores']
+        worker = partial(process_question, questions, vector_converter)
+        with Pool(n_workers) as pool:
+            return write_dataset(cache_path, pool.imap(worker, df.groupby('qanta_id'), chunksize=64))
 
 
 def convert_seq(batch, device=None):
@@ -204,6 +313,121 @@ def convert_seq(batch, device=None):
     return {'xs': xs, 'ys': ys}
 
 
+Bucket = namedtuple('Bucket', ['indices', 'xs', 'ys', 'sections'])
+
+
+class BucketIterator(chainer.dataset.Iterator):
+    '''iterator over batches of questions with similar lengths
+
+    Questions are sorted by length and cut into buckets of batch_size, and
+    the features and labels of each bucket are concatenated once into
+    contiguous float32 and int32 arrays that are reused every epoch. Since
+    the questions in a batch have nearly the same length NStepLSTM runs on an
+    almost rectangular batch without padding. Each epoch visits every bucket
+    once, in random order if shuffle is True.
+    '''
+
+    def __init__(self, dataset, batch_size, repeat=True, shuffle=True):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self._repeat = repeat
+        self._shuffle = shuffle
+        lengths = np.array([len(labels) for _, _, labels, _ in dataset])
+        order = np.argsort(lengths, kind='mergesort')
+        self.buckets = [
+            self._make_bucket(order[i:i + batch_size])
+            for i in range(0, len(order), batch_size)
+        ]
+        self.reset()
+
+    def _make_bucket(self, indices):
+        examples = [self.dataset[i] for i in indices]
+        lengths = [len(labels) for _, _, labels, _ in examples]
+        xs = np.concatenate(
+            [np.asarray(vectors, dtype=np.float32) for _, vectors, _, _ in examples])
+        ys = np.concatenate(
+            [np.asarray(labels, dtype=np.int32) for _, _, labels, _ in examples])
+        sections = np.cumsum(lengths[:-1], dtype=np.int32)
+        return Bucket(indices, np.ascontiguousarray(xs), ys, sections)
+
+    def to_device(self, device):
+        '''move the bucket arrays to device once instead of every batch'''
+        self.buckets = [
+            bucket._replace(
+                xs=chainer.dataset.to_device(device, bucket.xs),
+                ys=chainer.dataset.to_device(device, bucket.ys))
+            for bucket in self.buckets
+        ]
+
+    def _bucket_order(self):
+        if self._shuffle:
+            return np.random.permutation(len(self.buckets))
+        else:
+            return np.arange(len(self.buckets))
+
+    def __next__(self):
+        if not self._repeat and self.epoch > 0:
+            raise StopIteration
+
+        self._previous_epoch_detail = self.epoch_detail
+        bucket = self.buckets[self._order[self.current_position]]
+        self.current_position += 1
+        if self.current_position >= len(self.buckets):
+            self.current_position = 0
+            self.epoch += 1
+            self.is_new_epoch = True
+            self._order = self._bucket_order()
+        else:
+            self.is_new_epoch = False
+        return bucket
+
+    next = __next__
+
+    @property
+    def epoch_detail(self):
+        return self.epoch + self.current_position / len(self.buckets)
+
+    @property
+    def previous_epoch_detail(self):
+        if self._previous_epoch_detail < 0:
+            return None
+        return self._previous_epoch_detail
+
+    @property
+    def repeat(self):
+        return self._repeat
+
+    def reset(self):
+        self.current_position = 0
+        self.epoch = 0
+        self.is_new_epoch = False
+        self._previous_epoch_detail = -1.
+        self._order = self._bucket_order()
+
+    def serialize(self, serializer):
+        self.current_position = serializer('current_position',
+                                           self.current_position)
+        self.epoch = serializer('epoch', self.epoch)
+        self.is_new_epoch = serializer('is_new_epoch', self.is_new_epoch)
+        self._order = serializer('order', self._order)
+        self._previous_epoch_detail = serializer(
+            'previous_epoch_detail', self._previous_epoch_detail)
+
+
+def convert_bucket(bucket, device=None):
+    '''converter for batches from BucketIterator, the concatenated arrays
+        are transferred at once and split into views per question
+    '''
+    xs, ys = bucket.xs, bucket.ys
+    if device is not None:
+        xs = chainer.dataset.to_device(device, xs)
+        ys = chainer.dataset.to_device(device, ys)
+    xp = cuda.get_array_module(xs)
+    xs = [Variable(x) for x in xp.split(xs, bucket.sections)]
+    ys = xp.split(ys, bucket.sections)
+    return {'xs': xs, 'ys': ys}
+
+
 if __name__ == '__main__':
     data = read_data(BUZZER_TRAIN_FOLD)
     print(data)
@@ -1,9 +1,13 @@
 from typing import List, Dict, Iterable, Optional, Tuple, NamedTuple
 import os
 import json
+import threading
+
+import numpy as np
 
 from qanta import qlogging
 from qanta.datasets.abstract import AbstractDataset, TrainingData
+from qanta.datasets.snapshot import load_snapshot, LazyQuestions
 from qanta.util.constants import (
     QANTA_MAPPED_DATASET_PATH, QANTA_EXPO_DATASET_PATH,
     GUESSER_TRAIN_FOLD, GUESSER_DEV_FOLD, BUZZER_TRAIN_FOLD, BUZZER_DEV_FOLD,
@@ -67,39 +71,53 @@ class Question(NamedTuple):
 
         :param char_skip: Number of characters to skip each time
         """
-        char_indices = list(range(char_skip, len(self.text) + char_skip, char_skip))
+        char_indices = self.run_indices(char_skip)
         return [self.text[:i] for i in char_indices], char_indices
 
+    def run_indices(self, char_skip: int) -> List[int]:
+        """
+        Returns only the character indices used by Question.runs, without materializing the text of each run
+        """
+        return list(range(char_skip, len(self.text) + char_skip, char_skip))
+
 
 class QantaDatabase:
     def __init__(self, dataset_path=QANTA_MAPPED_DATASET_PATH, expo_path=QANTA_EXPO_DATASET_PATH):
-        with open(dataset_path) as f:
-            self.dataset = json.load(f)
-
-        self.version = self.dataset['version']
-        self.raw_questions = self.dataset['questions']
-        self.all_questions = [Question(**q) for q in self.raw_questions]
-        self.mapped_questions = [q for q in self.all_questions if q.page is not None]
+        """
+        Questions of the qanta dataset split by fold. Questions are read from a binary snapshot of the dataset json
+        which is built the first time the json is loaded, so question lists are sequences which create Question
+        objects on access.
+        """
+        self.snapshot = load_snapshot(dataset_path)
+        self.version = self.snapshot.version
+        self.all_questions = self.snapshot.questions()
+        self._mapped_mask = self.snapshot.mapped_mask()
+        self.mapped_questions = self.snapshot.questions(np.flatnonzero(self._mapped_mask))
 
-        self.train_questions = [q for q in self.mapped_questions if q.fold in TRAIN_FOLDS]
-        self.guess_train_questions = [q for q in self.train_questions if q.fold == GUESSER_TRAIN_FOLD]
-        self.buzz_train_questions = [q for q in self.train_questions if q.fold == BUZZER_TRAIN_FOLD]
+        self.train_questions = self._mapped_in_folds(TRAIN_FOLDS)
+        self.guess_train_questions = self._mapped_in_folds([GUESSER_TRAIN_FOLD])
+        self.buzz_train_questions = self._mapped_in_folds([BUZZER_TRAIN_FOLD])
 
-        self.dev_questions = [q for q in self.mapped_questions if q.fold in DEV_FOLDS]
-        self.guess_dev_questions = [q for q in self.dev_questions if q.fold == GUESSER_DEV_FOLD]
-        self.buzz_dev_questions = [q for q in self.dev_questions if q.fold == BUZZER_DEV_FOLD]
+        self.dev_questions = self._mapped_in_folds(DEV_FOLDS)
+        self.guess_dev_questions = self._mapped_in_folds([GUESSER_DEV_FOLD])
+        self.buzz_dev_questions = self._mapped_in_folds([BUZZER_DEV_FOLD])
 
-        self.buzz_test_questions = [q for q in self.mapped_questions if q.fold == BUZZER_TEST_FOLD]
-        self.guess_test_questions = [q for q in self.mapped_questions if q.fold == GUESSER_TEST_FOLD]
+        self.buzz_test_questions = self._mapped_in_folds([BUZZER_TEST_FOLD])
+        self.guess_test_questions = self._mapped_in_folds([GUESSER_TEST_FOLD])
 
         if os.path.exists(expo_path):
-            with open(expo_path) as f:
-                self.expo_dataset = json.load(f)
-                self.expo_questions = [Question(**q) for q in self.expo_dataset['questions']]
+            self.expo_snapshot = load_snapshot(expo_path)
+            self.expo_questions = self.expo_snapshot.questions()
         else:
-            self.expo_dataset = None
+            self.expo_snapshot = None
             self.expo_questions = []
 
+    def _mapped_in_folds(self, folds: Iterable[str]) -> LazyQuestions:
+        rows = np.sort(np.concatenate(
+            [self.snapshot.group_rows('fold', fold) for fold in folds] + [np.zeros(0, dtype=np.int32)]
+        ))
+        return self.snapshot.questions(rows[self._mapped_mask[rows]])
+
     def by_fold(self):
         return {
             GUESSER_TRAIN_FOLD: self.guess_train_questions,
@@ -111,6 +129,62 @@ class QantaDatabase:
             EXPO_FOLD: self.expo_questions
         }
 
+    def by_qanta_id(self, qanta_id: int) -> Optional[Question]:
+        for snapshot in (self.snapshot, self.expo_snapshot):
+            if snapshot is not None:
+                row = snapshot.row_of_qanta_id(qanta_id)
+                if row is not None:
+                    return snapshot.question(row)
+        return None
+
+    def by_page(self, page: str) -> LazyQuestions:
+        return self.snapshot.questions(self.snapshot.group_rows('page', page))
+
+    def by_proto_id(self, proto_id) -> LazyQuestions:
+        return self.snapshot.questions(self.snapshot.group_rows('proto_id', proto_id))
+
+
+_db_cache: Dict[Tuple[str, str], Tuple[Tuple, QantaDatabase]] = {}
+_db_cache_lock = threading.Lock()
+
+
+def _mtime(path: str) -> Optional[int]:
+    if os.path.exists(path):
+        return os.stat(path).st_mtime_ns
+    else:
+        return None
+
+
+def get_qanta_database(dataset_path=QANTA_MAPPED_DATASET_PATH, expo_path=QANTA_EXPO_DATASET_PATH) -> QantaDatabase:
+    """
+    Return a QantaDatabase shared by the whole process. The database is reloaded if either file has been modified
+    since it was cached. Callers must treat the returned database and its question lists as read only.
+    """
+    key = (os.path.abspath(dataset_path), os.path.abspath(expo_path))
+    fingerprint = (_mtime(dataset_path), _mtime(expo_path))
+    with _db_cache_lock:
+        cached = _db_cache.get(key)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+        db = QantaDatabase(dataset_path=dataset_path, expo_path=expo_path)
+        _db_cache[key] = (fingerprint, db)
+        return db
+
+
+def invalidate_qanta_database_cache(dataset_path: Optional[str] = None) -> None:
+    """
+    Drop cached databases so the next get_qanta_database call reloads them
+
+    :param dataset_path: only drop databases loaded from this dataset, by default drop all of them
+    """
+    with _db_cache_lock:
+        if dataset_path is None:
+            _db_cache.clear()
+        else:
+            dataset_path = os.path.abspath(dataset_path)
+            for key in [k for k in _db_cache if k[0] == dataset_path]:
+                del _db_cache[key]
+
 
 class QuizBowlDataset(AbstractDataset):
     def __init__(self, *, guesser_train=False, buzzer_train=False) -> None:
@@ -126,7 +200,7 @@ class QuizBowlDataset(AbstractDataset):
                 'Using QuizBowlDataset with guesser and buzzer training data, make sure you know what you are doing!'
             )
 
-        self.db = QantaDatabase()
+        self.db = get_qanta_database()
         self.guesser_train = guesser_train
         self.buzzer_train = buzzer_train
 
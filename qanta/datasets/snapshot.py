@@ -0,0 +1,254 @@
+"""
+Binary snapshot of a qanta dataset json file which can be opened without parsing the json.
+
+The file starts with a JSON header followed by one contiguous array per column so each column can be memory mapped
+independently. Free text fields are stored as a single utf-8 blob with offsets, low cardinality and identifier fields
+are stored as int32 codes into tables in the header, and sentence tokenizations are stored as a flat array of
+(start, end) pairs with offsets. For fold, page and proto_id the snapshot also stores the rows grouped by value, and
+for qanta_id the sorted ids, so that lookups are a slice or binary search.
+
+Question objects are only created when a row is accessed and are then reused.
+"""
+from typing import List, Dict, Optional, Sequence, Tuple, Any
+import json
+
+import numpy as np
+
+from qanta import qlogging
+from qanta.util.columnar import write_columns, read_header, map_column, open_or_build, source_fingerprint
+
+
+log = qlogging.get(__name__)
+
+
+MAGIC = b'QBSNAP01'
+SNAPSHOT_SUFFIX = '.snapshot'
+TEXT_FIELDS = ['text', 'first_sentence', 'answer']
+CODED_FIELDS = ['page', 'fold', 'category', 'subcategory', 'tournament', 'difficulty', 'dataset', 'proto_id', 'qdb_id']
+GROUPED_FIELDS = ['page', 'fold', 'proto_id']
+
+
+def snapshot_path(dataset_path: str) -> str:
+    return dataset_path + SNAPSHOT_SUFFIX
+
+
+def _encode(values: List) -> Tuple[np.ndarray, List]:
+    table = []
+    lookup = {}
+    codes = np.empty(len(values), dtype=np.int32)
+    for i, v in enumerate(values):
+        if v not in lookup:
+            lookup[v] = len(table)
+            table.append(v)
+        codes[i] = lookup[v]
+    return codes, table
+
+
+def _encode_text(values: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    encoded = [v.encode('utf-8') for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(np.array([len(e) for e in encoded], dtype=np.int64), out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _group(codes: np.ndarray, n_values: int) -> Tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(codes, kind='mergesort').astype(np.int32)
+    offsets = np.zeros(n_values + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=n_values), out=offsets[1:])
+    return order, offsets
+
+
+def write_snapshot(questions: List[Dict[str, Any]], version: str, path: str,
+                   source: Optional[Dict[str, int]] = None) -> None:
+    """
+    Write questions in the format of the qanta dataset json to a snapshot at path. The file is written to a
+    temporary path and renamed so that concurrent readers never observe a partial snapshot.
+
+    :param questions: question dictionaries
+    :param version: dataset version
+    :param path: output path
+    :param source: fingerprint of the json file the snapshot was built from, used to detect stale snapshots
+    """
+    n_rows = len(questions)
+    arrays = {
+        'qanta_id': np.array([q['qanta_id'] for q in questions], dtype=np.int64),
+        'year': np.array([q['year'] for q in questions], dtype=np.int32),
+        'gameplay': np.array([q['gameplay'] for q in questions], dtype=np.int8)
+    }
+    tables = {}
+    for field in CODED_FIELDS:
+        arrays[field], tables[field] = _encode([q[field] for q in questions])
+    for field in TEXT_FIELDS:
+        arrays[f'{field}_bytes'], arrays[f'{field}_offsets'] = _encode_text([q[field] for q in questions])
+
+    token_counts = np.array([len(q['tokenizations']) for q in questions], dtype=np.int64)
+    tokenization_offsets = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(token_counts, out=tokenization_offsets[1:])
+    arrays['tokenization_offsets'] = tokenization_offsets
+    arrays['tokenization_spans'] = np.array(
+        [i for q in questions for span in q['tokenizations'] for i in span], dtype=np.int32
+    )
+
+    for field in GROUPED_FIELDS:
+        arrays[f'{field}_order'], arrays[f'{field}_group_offsets'] = _group(arrays[field], len(tables[field]))
+    qanta_id_order = np.argsort(arrays['qanta_id'], kind='mergesort').astype(np.int32)
+    arrays['qanta_id_order'] = qanta_id_order
+    arrays['qanta_id_sorted'] = arrays['qanta_id'][qanta_id_order]
+
+    header = {
+        'n_rows': n_rows,
+        'version': version,
+        'source': source,
+        'tables': tables
+    }
+    write_columns(path, MAGIC, header, arrays)
+
+
+def build_snapshot(dataset_path: str, output_path: Optional[str] = None) -> str:
+    """
+    Build a snapshot of the qanta dataset json at dataset_path, by default next to it
+    """
+    if output_path is None:
+        output_path = snapshot_path(dataset_path)
+    log.info(f'Building dataset snapshot of {dataset_path} at {output_path}')
+    source = source_fingerprint(dataset_path)
+    with open(dataset_path) as f:
+        dataset = json.load(f)
+    write_snapshot(dataset['questions'], dataset['version'], output_path, source=source)
+    return output_path
+
+
+def load_snapshot(dataset_path: str) -> 'QuestionSnapshot':
+    """
+    Open the snapshot of the qanta dataset json at dataset_path, building it first if it is missing or older than
+    the json. If the snapshot cannot be written next to the dataset it is built in the temporary directory instead.
+    """
+    return open_or_build(
+        dataset_path, snapshot_path(dataset_path), SNAPSHOT_SUFFIX, QuestionSnapshot, build_snapshot, 'snapshot'
+    )
+
+
+class QuestionSnapshot:
+    def __init__(self, path: str):
+        """
+        Read only view of a dataset snapshot written by write_snapshot. Opening a snapshot only reads the header,
+        columns are memory mapped on first use.
+        """
+        self.path = path
+        header, self.data_start = read_header(path, MAGIC, 'dataset snapshot')
+
+        self.n_rows: int = header['n_rows']
+        self.version: str = header['version']
+        self.source: Optional[Dict[str, int]] = header['source']
+        self.tables: Dict[str, List] = header['tables']
+        self._table_lookup = {
+            field: {v: i for i, v in enumerate(self.tables[field])} for field in GROUPED_FIELDS
+        }
+        self._column_info = header['columns']
+        self._columns = {}
+        self._questions = [None] * self.n_rows
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __len__(self):
+        return self.n_rows
+
+    def column(self, name: str) -> np.ndarray:
+        if name not in self._columns:
+            info = self._column_info[name]
+            self._columns[name] = map_column(self.path, self.data_start, info, info['length'])
+        return self._columns[name]
+
+    def _text(self, field: str, row: int) -> str:
+        offsets = self.column(f'{field}_offsets')
+        return self.column(f'{field}_bytes')[offsets[row]:offsets[row + 1]].tobytes().decode('utf-8')
+
+    def _decode(self, field: str, row: int):
+        return self.tables[field][self.column(field)[row]]
+
+    def question(self, row: int):
+        from qanta.datasets.quiz_bowl import Question
+        q = self._questions[row]
+        if q is None:
+            token_offsets = self.column('tokenization_offsets')
+            spans = self.column('tokenization_spans')[2 * token_offsets[row]:2 * token_offsets[row + 1]]
+            q = Question(
+                qanta_id=int(self.column('qanta_id')[row]),
+                text=self._text('text', row),
+                first_sentence=self._text('first_sentence', row),
+                tokenizations=[(int(spans[i]), int(spans[i + 1])) for i in range(0, len(spans), 2)],
+                answer=self._text('answer', row),
+                page=self._decode('page', row),
+                fold=self._decode('fold', row),
+                gameplay=bool(self.column('gameplay')[row]),
+                category=self._decode('category', row),
+                subcategory=self._decode('subcategory', row),
+                tournament=self._decode('tournament', row),
+                difficulty=self._decode('difficulty', row),
+                year=int(self.column('year')[row]),
+                proto_id=self._decode('proto_id', row),
+                qdb_id=self._decode('qdb_id', row),
+                dataset=self._decode('dataset', row)
+            )
+            self._questions[row] = q
+        return q
+
+    def questions(self, rows: Optional[np.ndarray] = None) -> 'LazyQuestions':
+        if rows is None:
+            rows = np.arange(self.n_rows, dtype=np.int32)
+        return LazyQuestions(self, rows)
+
+    def group_rows(self, field: str, value) -> np.ndarray:
+        """
+        Rows where field equals value in their original order, field must be one of GROUPED_FIELDS
+        """
+        code = self._table_lookup[field].get(value)
+        if code is None:
+            return np.zeros(0, dtype=np.int32)
+        offsets = self.column(f'{field}_group_offsets')
+        return np.asarray(self.column(f'{field}_order')[offsets[code]:offsets[code + 1]])
+
+    def mapped_mask(self) -> np.ndarray:
+        none_code = self._table_lookup['page'].get(None)
+        if none_code is None:
+            return np.ones(self.n_rows, dtype=np.bool_)
+        return np.asarray(self.column('page')) != none_code
+
+    def row_of_qanta_id(self, qanta_id: int) -> Optional[int]:
+        sorted_ids = self.column('qanta_id_sorted')
+        i = int(np.searchsorted(sorted_ids, qanta_id))
+        if i < len(sorted_ids) and sorted_ids[i] == qanta_id:
+            return int(self.column('qanta_id_order')[i])
+        return None
+
+
+class LazyQuestions(Sequence):
+    def __init__(self, snapshot: QuestionSnapshot, rows: np.ndarray):
+        """
+        Sequence of the questions in rows of snapshot which creates Question objects on access
+        """
+        self.snapshot = snapshot
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return LazyQuestions(self.snapshot, self.rows[i])
+        return self.snapshot.question(int(self.rows[i]))
+
+    def __iter__(self):
+        question = self.snapshot.question
+        for row in self.rows:
+            yield question(int(row))
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __repr__(self):
+        return f'LazyQuestions(n={len(self)}, path={self.snapshot.path})'
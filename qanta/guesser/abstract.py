@@ -13,7 +13,8 @@ with warnings.catch_warnings():
 import pandas as pd
 
 from qanta.datasets.abstract import TrainingData, QuestionText, Page
-from qanta.datasets.quiz_bowl import QuizBowlDataset, QantaDatabase
+from qanta.datasets.quiz_bowl import QuizBowlDataset, get_qanta_database
+from qanta.guesser.guess_store import GuessStore, write_guesses
 from qanta.config import conf
 from qanta.util import constants as c
 from qanta.util.io import safe_path
@@ -96,6 +97,34 @@ class AbstractGuesser(metaclass=ABCMeta):
         """
         pass
 
+    def guess_incremental(self, questions: List[QuestionText], char_indices: List[List[int]],
+                          max_n_guesses: Optional[int]) -> List[List[List[Tuple[Page, float]]]]:
+        """
+        Given a list of full questions and for each question a sorted list of character indices, return guesses for
+        every prefix question[:char_index]. The output for each prefix must match what AbstractGuesser.guess would
+        return for that prefix.
+
+        By default this expands each question into its prefixes and calls AbstractGuesser.guess. Guessers that can
+        featurize a prefix by updating the features of the previous prefix should override this to avoid
+        re-processing the same text once per prefix.
+
+        :param questions: Full question texts
+        :param char_indices: For each question, the character indices to generate prefixes at
+        :param max_n_guesses: Number of guesses to produce per prefix, if None then return all of them if possible
+        :return: For each question, a list with the top guesses per prefix
+        """
+        runs = []
+        for text, indices in zip(questions, char_indices):
+            runs.extend(text[:i] for i in indices)
+
+        flat_guesses = self.guess(runs, max_n_guesses)
+        guesses = []
+        position = 0
+        for indices in char_indices:
+            guesses.append(flat_guesses[position:position + len(indices)])
+            position += len(indices)
+        return guesses
+
     @classmethod
     @abstractmethod
     def targets(cls) -> List[str]:
@@ -153,7 +182,8 @@ class AbstractGuesser(metaclass=ABCMeta):
         return {}
 
     def generate_guesses(self, max_n_guesses: int, folds: List[str],
-                         char_skip=25, full_question=False, first_sentence=False) -> pd.DataFrame:
+                         char_skip=25, full_question=False, first_sentence=False,
+                         shard: Optional[Tuple[int, int]] = None) -> pd.DataFrame:
         """
         Generates guesses for this guesser for all questions in specified folds and returns it as a
         DataFrame
@@ -163,6 +193,8 @@ class AbstractGuesser(metaclass=ABCMeta):
         :param max_n_guesses: generate at most this many guesses per question, sentence, and token
         :param folds: which folds to generate guesses for
         :param char_skip: generate guesses every 10 characters
+        :param shard: if not None, a tuple (shard_index, n_shards) restricting guesses to questions with
+            qanta_id % n_shards == shard_index
         :return: dataframe of guesses
         """
         if full_question and first_sentence:
@@ -170,6 +202,12 @@ class AbstractGuesser(metaclass=ABCMeta):
 
         dataset = self.qb_dataset()
         questions_by_fold = dataset.questions_by_fold()
+        if shard is not None:
+            shard_index, n_shards = shard
+            questions_by_fold = {
+                fold: [q for q in questions_by_fold[fold] if q.qanta_id % n_shards == shard_index]
+                for fold in folds
+            }
 
         q_folds = []
         q_qnums = []
@@ -177,35 +215,54 @@ class AbstractGuesser(metaclass=ABCMeta):
         q_proto_ids = []
         question_texts = []
 
-        for fold in folds:
-            questions = questions_by_fold[fold]
-            for q in questions:
-                if full_question:
-                    question_texts.append(q.text)
-                    q_folds.append(fold)
-                    q_qnums.append(q.qanta_id)
-                    q_char_indices.append(len(q.text))
-                    q_proto_ids.append(q.proto_id)
-                elif first_sentence:
-                    question_texts.append(q.first_sentence)
+        if full_question or first_sentence:
+            for fold in folds:
+                questions = questions_by_fold[fold]
+                for q in questions:
+                    if full_question:
+                        question_texts.append(q.text)
+                        q_char_indices.append(len(q.text))
+                    else:
+                        question_texts.append(q.first_sentence)
+                        q_char_indices.append(q.tokenizations[0][1])
                     q_folds.append(fold)
                     q_qnums.append(q.qanta_id)
-                    q_char_indices.append(q.tokenizations[0][1])
                     q_proto_ids.append(q.proto_id)
-                else:
-                    for text_run, char_ix in zip(*q.runs(char_skip)):
-                        question_texts.append(text_run)
+
+            guesses_per_question = self.guess(question_texts, max_n_guesses)
+
+            if len(guesses_per_question) != len(question_texts):
+                raise ValueError(
+                    'Guesser has wrong number of answers: len(guesses_per_question)={} len(question_texts)={}'.format(
+                        len(guesses_per_question), len(question_texts)))
+        else:
+            full_texts = []
+            run_indices = []
+            for fold in folds:
+                questions = questions_by_fold[fold]
+                for q in questions:
+                    char_indices = q.run_indices(char_skip)
+                    full_texts.append(q.text)
+                    run_indices.append(char_indices)
+                    for char_ix in char_indices:
                         q_folds.append(fold)
                         q_qnums.append(q.qanta_id)
                         q_char_indices.append(char_ix)
                         q_proto_ids.append(q.proto_id)
 
-        guesses_per_question = self.guess(question_texts, max_n_guesses)
+            guesses_per_run = self.guess_incremental(full_texts, run_indices, max_n_guesses)
+            if len(guesses_per_run) != len(full_texts):
+                raise ValueError(
+                    'Guesser has wrong number of answers: len(guesses_per_run)={} len(full_texts)={}'.format(
+                        len(guesses_per_run), len(full_texts)))
 
-        if len(guesses_per_question) != len(question_texts):
-            raise ValueError(
-                'Guesser has wrong number of answers: len(guesses_per_question)={} len(question_texts)={}'.format(
-                    len(guesses_per_question), len(question_texts)))
+            guesses_per_question = []
+            for char_indices, run_guesses in zip(run_indices, guesses_per_run):
+                if len(run_guesses) != len(char_indices):
+                    raise ValueError(
+                        'Guesser has wrong number of runs: len(run_guesses)={} len(char_indices)={}'.format(
+                            len(run_guesses), len(char_indices)))
+                guesses_per_question.extend(run_guesses)
 
         log.info('Creating guess dataframe from guesses...')
         df_qnums = []
@@ -217,7 +274,7 @@ class AbstractGuesser(metaclass=ABCMeta):
         df_guessers = []
         guesser_name = self.display_name()
 
-        for i in range(len(question_texts)):
+        for i in range(len(guesses_per_question)):
             guesses_with_scores = guesses_per_question[i]
             fold = q_folds[i]
             qnum = q_qnums[i]
@@ -244,6 +301,10 @@ class AbstractGuesser(metaclass=ABCMeta):
 
     @staticmethod
     def guess_path(directory: str, fold: str, output_type: str) -> str:
+        return os.path.join(directory, f'guesses_{output_type}_{fold}.qgs')
+
+    @staticmethod
+    def legacy_guess_path(directory: str, fold: str, output_type: str) -> str:
         return os.path.join(directory, f'guesses_{output_type}_{fold}.pickle')
 
     @staticmethod
@@ -252,28 +313,46 @@ class AbstractGuesser(metaclass=ABCMeta):
             log.info('Saving fold {}'.format(fold))
             fold_df = guess_df[guess_df.fold == fold]
             output_path = AbstractGuesser.guess_path(directory, fold, output_type)
-            fold_df.to_pickle(output_path)
+            write_guesses(output_path, fold_df, fold)
 
     @staticmethod
-    def load_guesses(directory: str, output_type='char', folds=c.GUESSER_GENERATION_FOLDS) -> pd.DataFrame:
+    def load_guesses(directory: str, output_type='char', folds=c.GUESSER_GENERATION_FOLDS,
+                     min_qanta_id: Optional[int] = None, max_qanta_id: Optional[int] = None,
+                     columns: Optional[List[str]] = None) -> pd.DataFrame:
         """
         Loads all the guesses pertaining to a guesser inferred from directory
         :param directory: where to load guesses from
         :param output_type: One of: char, full, first
-        :param folds: folds to load, by default all of them
+        :param folds: folds to load, by default all of them. Files for other folds are not read
+        :param min_qanta_id: if not None, only load guesses for questions with qanta_id >= min_qanta_id
+        :param max_qanta_id: if not None, only load guesses for questions with qanta_id <= max_qanta_id
+        :param columns: columns to load, by default all of them
         :return: guesses across all folds for given directory
         """
         assert len(folds) > 0
-        guess_df = None
+        fold_dfs = []
         for fold in folds:
             input_path = AbstractGuesser.guess_path(directory, fold, output_type)
-            if guess_df is None:
-                guess_df = pd.read_pickle(input_path)
+            if os.path.exists(input_path):
+                fold_df = GuessStore(input_path).to_df(
+                    min_qanta_id=min_qanta_id, max_qanta_id=max_qanta_id, columns=columns
+                )
             else:
-                new_guesses_df = pd.read_pickle(input_path)
-                guess_df = pd.concat([guess_df, new_guesses_df])
-
-        return guess_df
+                legacy_path = AbstractGuesser.legacy_guess_path(directory, fold, output_type)
+                log.info(f'Guess store {input_path} not found, reading {legacy_path}')
+                fold_df = pd.read_pickle(legacy_path)
+                if min_qanta_id is not None:
+                    fold_df = fold_df[fold_df.qanta_id >= min_qanta_id]
+                if max_qanta_id is not None:
+                    fold_df = fold_df[fold_df.qanta_id <= max_qanta_id]
+                if columns is not None:
+                    fold_df = fold_df[columns]
+            fold_dfs.append(fold_df)
+
+        if len(fold_dfs) == 1:
+            return fold_dfs[0]
+        else:
+            return pd.concat(fold_dfs, ignore_index=True)
 
     @staticmethod
     def load_all_guesses(directory_prefix='') -> pd.DataFrame:
@@ -281,19 +360,18 @@ class AbstractGuesser(metaclass=ABCMeta):
         Loads all guesses from all guessers and folds
         :return:
         """
-        guess_df = None
+        guess_dfs = []
         guessers = conf['guessers']
         for guesser_key, g in guessers.items():
             g = guessers[guesser_key]
             if g['enabled']:
                 input_path = os.path.join(directory_prefix, c.GUESSER_TARGET_PREFIX, g['class'])
-                if guess_df is None:
-                    guess_df = AbstractGuesser.load_guesses(input_path)
-                else:
-                    new_guess_df = AbstractGuesser.load_guesses(input_path)
-                    guess_df = pd.concat([guess_df, new_guess_df])
+                guess_dfs.append(AbstractGuesser.load_guesses(input_path))
 
-        return guess_df
+        if len(guess_dfs) == 0:
+            return None
+        else:
+            return pd.concat(guess_dfs, ignore_index=True)
 
     @staticmethod
     def load_guess_score_map(guess_df: pd.DataFrame) -> defaultdict:
@@ -307,7 +385,7 @@ class AbstractGuesser(metaclass=ABCMeta):
         with open(os.path.join(directory, f'guesser_params.pickle'), 'rb') as f:
             params = pickle.load(f)
 
-        qdb = QantaDatabase()
+        qdb = get_qanta_database()
         guesser_train = qdb.guess_train_questions
         questions_by_fold = qdb.by_fold()
         guesser_report_questions = questions_by_fold[fold]
@@ -411,23 +489,32 @@ class AbstractGuesser(metaclass=ABCMeta):
 
     def web_api(self, host='0.0.0.0', port=5000, debug=False):
         from flask import Flask, jsonify, request
+        from qanta.guesser.serving import MicroBatcher, parse_n_guesses, format_guesses
+        from qanta.guesser.guess_cache import CachedGuesser, create_guess_cache
 
         app = Flask(__name__)
+        batcher = CachedGuesser(MicroBatcher(self), create_guess_cache(), name=type(self).__name__)
 
         @app.route('/api/answer_question', methods=['POST'])
         def answer_question():
             text = request.form['text']
-            guess, score = self.guess([text], 1)[0][0]
-            return jsonify({'guess': guess, 'score': float(score)})
+            try:
+                n_guesses = parse_n_guesses(request.form.get('n_guesses', 1))
+            except ValueError as e:
+                response = jsonify({'errors': str(e)})
+                response.status_code = 400
+                return response
+            guesses = batcher.guess([text], n_guesses)[0]
+            guess, score = guesses[0]
+            return jsonify({'guess': guess, 'score': score, 'guesses': format_guesses(guesses)})
 
-        app.run(host=host, port=port, debug=debug)
+        app.run(host=host, port=port, debug=debug, threaded=True)
 
     @staticmethod
-    def multi_guesser_web_api(guesser_names: List[str], host='0.0.0.0', port=5000, debug=False):
-        from flask import Flask, jsonify, request
-
-        app = Flask(__name__)
-
+    def load_guessers(guesser_names: List[str]) -> Dict[str, 'AbstractGuesser']:
+        """
+        Load the guessers with the given names in the guessers section of the configuration from output/guesser
+        """
         guesser_lookup = {}
         for name, g in conf['guessers'].items():
             g_qualified_name = g['class']
@@ -446,28 +533,37 @@ class AbstractGuesser(metaclass=ABCMeta):
                 guessers[name] = g_class.load(guesser_path)
             else:
                 log.info(f'Guesser with name="{name}" not found')
+        return guessers
 
-        @app.route('/api/guesser', methods=['POST'])
-        def guess():
-            if 'guesser_name' not in request.form:
-                response = jsonify({'errors': 'Missing expected field "guesser_name"'})
-                response.status_code = 400
-                return response
-
-            if 'text' not in request.form:
-                response = jsonify({'errors': 'Missing expected field "text"'})
-                response.status_code = 400
-                return response
-
-            g_name = request.form['guesser_name']
-            if g_name not in guessers:
-                response = jsonify(
-                    {'errors': f'Guesser "{g_name}" invalid, options are: "{list(guessers.keys())}"'}
-                )
-                response.status_code = 400
-                return response
-            text = request.form['text']
-            guess, score = guessers[g_name].guess([text], 1)[0][0]
-            return jsonify({'guess': guess, 'score': float(score)})
-
-        app.run(host=host, port=port, debug=debug)
+    @staticmethod
+    def multi_guesser_web_api(guesser_names: List[str], host='0.0.0.0', port=5000, debug=False,
+                              production=False, workers=1, threads=8,
+                              max_batch_size=None, max_wait_ms=None, guess_cache=True):
+        """
+        Serve several guessers, see qanta.guesser.serving.create_app for the endpoints
+
+        :param production: serve with gunicorn instead of the flask development server
+        :param workers: number of gunicorn worker processes
+        :param threads: number of request threads per gunicorn worker
+        :param max_batch_size: maximum number of questions batched into one guess call
+        :param max_wait_ms: maximum time a question waits for others to batch with
+        :param guess_cache: whether to cache guesses as configured by the guess_cache configuration section
+        """
+        from qanta.guesser import serving
+        from qanta.guesser.guess_cache import create_guess_cache
+
+        guessers = AbstractGuesser.load_guessers(guesser_names)
+        app = serving.create_app(
+            guessers,
+            max_batch_size=serving.DEFAULT_MAX_BATCH_SIZE if max_batch_size is None else max_batch_size,
+            max_wait_ms=serving.DEFAULT_MAX_WAIT_MS if max_wait_ms is None else max_wait_ms,
+            cache=create_guess_cache() if guess_cache else None,
+            ensemble_weights=conf['guesser_ensemble']['weights'],
+            ensemble_normalization=conf['guesser_ensemble']['normalization'],
+            ensemble_n_guesses_per_guesser=conf['guesser_ensemble']['n_guesses_per_guesser'],
+            threads=threads
+        )
+        serving.serve(
+            app, host=host, port=port, debug=debug,
+            production=production, workers=workers, threads=threads
+        )
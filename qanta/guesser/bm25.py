@@ -0,0 +1,316 @@
+from typing import List, Optional, Dict, Tuple
+import os
+import re
+import pickle
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+import tqdm
+from nltk.tokenize import word_tokenize
+
+from qanta.wikipedia.cached_wikipedia import Wikipedia
+from qanta.datasets.abstract import QuestionText
+from qanta.guesser.abstract import AbstractGuesser
+from qanta.config import conf
+from qanta import qlogging
+
+
+log = qlogging.get(__name__)
+BM25_PARAMS = 'bm25_params.pickle'
+FIELDS = ['wiki_content', 'qb_content']
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def _postings_path(directory: str, field: str, array: str) -> str:
+    return os.path.join(directory, f'bm25_{field}_{array}.npy')
+
+
+class BM25Index:
+    def __init__(self, k1=1.2, b=.75):
+        """
+        In memory replacement for ElasticSearchIndex which scores documents with BM25 using the same formula as
+        Lucene. Each field has its own inverted index stored as a CSR matrix of shape (n_terms, n_docs) whose values
+        are precomputed BM25 term weights, so scoring a batch of queries is a single sparse matrix product per field.
+        Queries are scored like the multi_match best_fields query used by ElasticSearchGuesser: the score of a
+        document is the maximum of its boosted field scores.
+
+        Postings are saved as .npy files and memory mapped by BM25Index.load, so several processes guessing from
+        the same index share the operating system page cache.
+        """
+        self.k1 = k1
+        self.b = b
+        self.pages: List[str] = []
+        self.doc_pages: Optional[np.ndarray] = None
+        self.vocab: Dict[str, Dict[str, int]] = {field: {} for field in FIELDS}
+        self.postings: Dict[str, Optional[sparse.csr_matrix]] = {field: None for field in FIELDS}
+
+    @property
+    def n_docs(self) -> int:
+        return 0 if self.doc_pages is None else len(self.doc_pages)
+
+    def build_large_docs(self, documents: Dict[str, str], use_wiki=True, use_qb=True):
+        wiki_lookup = Wikipedia() if use_wiki else None
+        log.info('Indexing questions and corresponding wikipedia pages as large docs...')
+        docs = []
+        for page in tqdm.tqdm(documents):
+            if use_wiki and page in wiki_lookup:
+                wiki_content = wiki_lookup[page].text
+            else:
+                wiki_content = ''
+
+            if use_qb:
+                qb_content = documents[page]
+            else:
+                qb_content = ''
+            docs.append((page, wiki_content, qb_content))
+        self._build(docs)
+
+    def build_many_docs(self, pages, documents, use_wiki=True, use_qb=True):
+        log.info('Indexing questions and corresponding pages as many docs...')
+        docs = []
+        if use_qb:
+            log.info('Indexing questions...')
+            for page, doc in tqdm.tqdm(documents):
+                docs.append((page, '', doc))
+
+        if use_wiki:
+            log.info('Indexing wikipedia...')
+            wiki_lookup = Wikipedia()
+            for page in tqdm.tqdm(pages):
+                if page in wiki_lookup:
+                    content = word_tokenize(wiki_lookup[page].text)
+                    for i in range(0, len(content), 200):
+                        chunked_content = content[i:i + 200]
+                        if len(chunked_content) > 0:
+                            docs.append((page, ' '.join(chunked_content), ''))
+        self._build(docs)
+
+    def _build(self, docs: List[Tuple[str, str, str]]):
+        page_lookup = {}
+        doc_pages = []
+        for page, _, _ in docs:
+            if page not in page_lookup:
+                page_lookup[page] = len(self.pages)
+                self.pages.append(page)
+            doc_pages.append(page_lookup[page])
+        self.doc_pages = np.array(doc_pages, dtype=np.int32)
+
+        for field_ix, field in enumerate(FIELDS):
+            log.info(f'Building postings for {field}')
+            vocab = self.vocab[field]
+            term_ids = []
+            doc_ids = []
+            term_freqs = []
+            doc_lengths = np.zeros(len(docs), dtype=np.float64)
+            for doc_id, doc in enumerate(docs):
+                tokens = tokenize(doc[field_ix + 1])
+                doc_lengths[doc_id] = len(tokens)
+                for term, tf in Counter(tokens).items():
+                    if term not in vocab:
+                        vocab[term] = len(vocab)
+                    term_ids.append(vocab[term])
+                    doc_ids.append(doc_id)
+                    term_freqs.append(tf)
+            self.postings[field] = self._weight_postings(
+                np.array(term_ids, dtype=np.int64), np.array(doc_ids, dtype=np.int64),
+                np.array(term_freqs, dtype=np.float64), doc_lengths, len(vocab)
+            )
+
+    def _weight_postings(self, term_ids, doc_ids, term_freqs, doc_lengths, n_terms) -> sparse.csr_matrix:
+        n_field_docs = np.count_nonzero(doc_lengths)
+        avg_doc_length = doc_lengths.sum() / max(n_field_docs, 1)
+        doc_freqs = np.bincount(term_ids, minlength=n_terms)
+        idf = np.log(1 + (n_field_docs - doc_freqs + .5) / (doc_freqs + .5))
+        length_norm = self.k1 * (1 - self.b + self.b * doc_lengths[doc_ids] / avg_doc_length)
+        weights = idf[term_ids] * term_freqs * (self.k1 + 1) / (term_freqs + length_norm)
+        postings = sparse.csr_matrix(
+            (weights.astype(np.float32), (term_ids, doc_ids)), shape=(n_terms, len(doc_lengths))
+        )
+        postings.sort_indices()
+        return postings
+
+    def _query_matrix(self, field: str, queries: List[str]) -> sparse.csr_matrix:
+        vocab = self.vocab[field]
+        rows = []
+        cols = []
+        values = []
+        for i, q in enumerate(queries):
+            for term, count in Counter(tokenize(q)).items():
+                if term in vocab:
+                    rows.append(i)
+                    cols.append(vocab[term])
+                    values.append(count)
+        return sparse.csr_matrix(
+            (np.array(values, dtype=np.float32), (rows, cols)), shape=(len(queries), len(vocab))
+        )
+
+    def search(self, queries: List[str], max_n_guesses: Optional[int],
+               normalize_score_by_length=False, wiki_boost=1, qb_boost=1,
+               chunk_size=256) -> List[List[Tuple[str, float]]]:
+        """
+        Score a batch of queries, returning for each query up to max_n_guesses pages sorted by score. When several
+        documents belong to the same page, the page is scored by its best document.
+        """
+        boosts = {'wiki_content': wiki_boost, 'qb_content': qb_boost}
+        results = []
+        for start in range(0, len(queries), chunk_size):
+            chunk = queries[start:start + chunk_size]
+            scores = None
+            for field in FIELDS:
+                field_scores = self._query_matrix(field, chunk).dot(self.postings[field])
+                if boosts[field] != 1:
+                    field_scores = field_scores * boosts[field]
+                scores = field_scores if scores is None else scores.maximum(field_scores)
+            scores = scores.tocsr()
+
+            for i, q in enumerate(chunk):
+                row = scores.getrow(i)
+                if normalize_score_by_length:
+                    query_length = max(len(q.split()), 1)
+                else:
+                    query_length = 1
+                results.append(self._top_pages(row.indices, row.data, max_n_guesses, query_length))
+        return results
+
+    def _top_pages(self, doc_ids, doc_scores, max_n_guesses, query_length) -> List[Tuple[str, float]]:
+        if len(doc_ids) == 0:
+            return []
+        pages = self.doc_pages[doc_ids]
+        order = np.lexsort((-doc_scores, pages))
+        unique_pages, first = np.unique(pages[order], return_index=True)
+        page_scores = doc_scores[order][first]
+        if max_n_guesses is not None and max_n_guesses < len(unique_pages):
+            top = np.argpartition(-page_scores, max_n_guesses - 1)[:max_n_guesses]
+            unique_pages = unique_pages[top]
+            page_scores = page_scores[top]
+        ranked = np.argsort(-page_scores, kind='mergesort')
+        return [(self.pages[unique_pages[i]], float(page_scores[i]) / query_length) for i in ranked]
+
+    def save(self, directory: str):
+        for field in FIELDS:
+            postings = self.postings[field]
+            np.save(_postings_path(directory, field, 'indptr'), postings.indptr)
+            np.save(_postings_path(directory, field, 'indices'), postings.indices)
+            np.save(_postings_path(directory, field, 'weights'), postings.data)
+        np.save(os.path.join(directory, 'bm25_doc_pages.npy'), self.doc_pages)
+        with open(os.path.join(directory, 'bm25_index.pickle'), 'wb') as f:
+            pickle.dump({
+                'k1': self.k1,
+                'b': self.b,
+                'pages': self.pages,
+                'vocab': self.vocab
+            }, f)
+
+    @classmethod
+    def load(cls, directory: str):
+        with open(os.path.join(directory, 'bm25_index.pickle'), 'rb') as f:
+            params = pickle.load(f)
+        index = BM25Index(k1=params['k1'], b=params['b'])
+        index.pages = params['pages']
+        index.vocab = params['vocab']
+        index.doc_pages = np.load(os.path.join(directory, 'bm25_doc_pages.npy'), mmap_mode='r')
+        for field in FIELDS:
+            indptr = np.load(_postings_path(directory, field, 'indptr'), mmap_mode='r')
+            indices = np.load(_postings_path(directory, field, 'indices'), mmap_mode='r')
+            weights = np.load(_postings_path(directory, field, 'weights'), mmap_mode='r')
+            index.postings[field] = sparse.csr_matrix(
+                (weights, indices, indptr), shape=(len(index.vocab[field]), index.n_docs), copy=False
+            )
+        return index
+
+    @staticmethod
+    def files() -> List[str]:
+        files = ['bm25_index.pickle', 'bm25_doc_pages.npy']
+        for field in FIELDS:
+            for array in ['indptr', 'indices', 'weights']:
+                files.append(os.path.basename(_postings_path('', field, array)))
+        return files
+
+
+class BM25Guesser(AbstractGuesser):
+    def __init__(self, config_num):
+        super().__init__(config_num)
+        guesser_conf = conf['guessers']['qanta.guesser.bm25.BM25Guesser'][self.config_num]
+        self.use_wiki = guesser_conf['use_wiki']
+        self.use_qb = guesser_conf['use_qb']
+        self.many_docs = guesser_conf['many_docs']
+        self.normalize_score_by_length = guesser_conf['normalize_score_by_length']
+        self.qb_boost = guesser_conf['qb_boost']
+        self.wiki_boost = guesser_conf['wiki_boost']
+        self.chunk_size = guesser_conf['chunk_size']
+        similarity = guesser_conf['similarity']
+        self.similarity_k1 = similarity['k1']
+        self.similarity_b = similarity['b']
+        self.index = BM25Index(k1=self.similarity_k1, b=self.similarity_b)
+
+    def parameters(self):
+        return conf['guessers']['qanta.guesser.bm25.BM25Guesser'][self.config_num]
+
+    def train(self, training_data):
+        if self.many_docs:
+            pages = set(training_data[1])
+            documents = []
+            for sentences, page in zip(training_data[0], training_data[1]):
+                paragraph = ' '.join(sentences)
+                documents.append((page, paragraph))
+            self.index.build_many_docs(pages, documents, use_qb=self.use_qb, use_wiki=self.use_wiki)
+        else:
+            documents = {}
+            for sentences, page in zip(training_data[0], training_data[1]):
+                paragraph = ' '.join(sentences)
+                if page in documents:
+                    documents[page] += ' ' + paragraph
+                else:
+                    documents[page] = paragraph
+
+            self.index.build_large_docs(documents, use_qb=self.use_qb, use_wiki=self.use_wiki)
+
+    def guess(self, questions: List[QuestionText], max_n_guesses: Optional[int]):
+        return self.index.search(
+            questions, max_n_guesses,
+            normalize_score_by_length=self.normalize_score_by_length,
+            wiki_boost=self.wiki_boost, qb_boost=self.qb_boost,
+            chunk_size=self.chunk_size
+        )
+
+    @classmethod
+    def targets(cls):
+        return [BM25_PARAMS] + BM25Index.files()
+
+    @classmethod
+    def load(cls, directory: str):
+        with open(os.path.join(directory, BM25_PARAMS), 'rb') as f:
+            params = pickle.load(f)
+        guesser = BM25Guesser(params['config_num'])
+        guesser.use_wiki = params['use_wiki']
+        guesser.use_qb = params['use_qb']
+        guesser.many_docs = params['many_docs']
+        guesser.normalize_score_by_length = params['normalize_score_by_length']
+        guesser.qb_boost = params['qb_boost']
+        guesser.wiki_boost = params['wiki_boost']
+        guesser.chunk_size = params['chunk_size']
+        guesser.similarity_k1 = params['similarity_k1']
+        guesser.similarity_b = params['similarity_b']
+        guesser.index = BM25Index.load(directory)
+        return guesser
+
+    def save(self, directory: str):
+        self.index.save(directory)
+        with open(os.path.join(directory, BM25_PARAMS), 'wb') as f:
+            pickle.dump({
+                'use_wiki': self.use_wiki,
+                'use_qb': self.use_qb,
+                'many_docs': self.many_docs,
+                'normalize_score_by_length': self.normalize_score_by_length,
+                'qb_boost': self.qb_boost,
+                'wiki_boost': self.wiki_boost,
+                'chunk_size': self.chunk_size,
+                'config_num': self.config_num,
+                'similarity_k1': self.similarity_k1,
+                'similarity_b': self.similarity_b
+            }, f)
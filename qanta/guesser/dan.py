@@ -1,5 +1,7 @@
 import re
 import os
+import copy
+import json
 import shutil
 import time
 import cloudpickle
@@ -22,16 +24,21 @@ from qanta.torch.dataset import QuizBowl
 from qanta.config import conf
 from qanta.guesser.abstract import AbstractGuesser
 from qanta.datasets.abstract import QuestionText
+from qanta.datasets.quiz_bowl import get_qanta_database
+from qanta.util.constants import GUESSER_DEV_FOLD
 from qanta.torch import (
     BaseLogger, TerminateOnNaN, EarlyStopping, ModelCheckpoint,
     MaxEpochStopping, TrainingManager
 )
+from qanta.torch.inference import (
+    CUDA, TORCHTEXT_DEVICE, BatchedInference, top_k_guesses, map_location, maybe_cuda, configure_threads
+)
 
 
 log = qlogging.get(__name__)
 
 
-CUDA = torch.cuda.is_available()
+INFERENCE_BATCH_SIZE = 500
 
 
 def create_save_model(model):
@@ -81,6 +88,26 @@ class DanEncoder(nn.Module):
         return self.encoder(x_array)
 
 
+def quantize_dan_model(model: 'DanModel', fp16_embeddings=False) -> 'DanModel':
+    """
+    Apply int8 dynamic quantization to every nn.Linear in model, which includes the classifier over all pages. Weights
+    are stored as int8 and activations are quantized on the fly, so quantized models only run on CPU.
+
+    :param model: DanModel in eval mode on CPU
+    :param fp16_embeddings: additionally store embedding tables as float16
+    """
+    if not hasattr(torch, 'quantization') or not hasattr(torch.quantization, 'quantize_dynamic'):
+        raise ValueError(f'torch {torch.__version__} does not support dynamic quantization, torch>=1.3 is required')
+    model = model.cpu()
+    model.eval()
+    if fp16_embeddings:
+        for embeddings in (model.text_embeddings, model.unigram_embeddings,
+                           model.bigram_embeddings, model.trigram_embeddings):
+            if embeddings is not None:
+                embeddings.half()
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
 class DanModel(nn.Module):
     def __init__(self, n_classes, *,
                  text_field=None,
@@ -119,7 +146,7 @@ class DanModel(nn.Module):
             if init_embeddings:
                 mean_emb = text_vocab.vectors.mean(0)
                 text_vocab.vectors[text_vocab.stoi[text_field.unk_token]] = mean_emb
-                self.text_embeddings.weight.data = text_vocab.vectors.cuda()
+                self.text_embeddings.weight.data = maybe_cuda(text_vocab.vectors)
 
         if unigram_field is None:
             self.unigram_vocab_size = None
@@ -134,7 +161,7 @@ class DanModel(nn.Module):
             if init_embeddings:
                 mean_emb = unigram_vocab.vectors.mean(0)
                 unigram_vocab.vectors[unigram_vocab.stoi[unigram_field.unk_token]] = mean_emb
-                self.unigram_embeddings.weight.data = unigram_vocab.vectors.cuda()
+                self.unigram_embeddings.weight.data = maybe_cuda(unigram_vocab.vectors)
 
         if bigram_field is None:
             self.bigram_vocab_size = None
@@ -197,7 +224,7 @@ class DanModel(nn.Module):
 
         if self.text_field is not None:
             text_input = input_['text']
-            embed = self.text_embeddings(text_input)
+            embed = self.text_embeddings(text_input).float()
             embed = self._pool(embed, lengths['text'].float(), text_input.size()[0])
             embed = self.dropout(embed)
             encoded = self.encoder(embed)
@@ -206,21 +233,21 @@ class DanModel(nn.Module):
             embedding_list = []
             if self.unigram_field is not None:
                 unigram_input = input_['unigram']
-                embed = self.unigram_embeddings(unigram_input)
+                embed = self.unigram_embeddings(unigram_input).float()
                 embed = self._pool(embed, lengths['unigram'].float, unigram_input.size()[0])
                 embed = self.dropout(embed)
                 embedding_list.append(embed)
 
             if self.bigram_field is not None:
                 bigram_input = input_['bigram']
-                embed = self.bigram_embeddings(bigram_input)
+                embed = self.bigram_embeddings(bigram_input).float()
                 embed = self._pool(embed, lengths['bigram'].float, bigram_input.size()[0])
                 embed = self.dropout(embed)
                 embedding_list.append(embed)
 
             if self.trigram_field is not None:
                 trigram_input = input_['trigram']
-                embed = self.trigram_embeddings(trigram_input)
+                embed = self.trigram_embeddings(trigram_input).float()
                 embed = self._pool(embed, lengths['trigram'].float, trigram_input.size()[0])
                 embed = self.dropout(embed)
                 embedding_list.append(embed)
@@ -258,6 +285,12 @@ class DanGuesser(AbstractGuesser):
             self.pooling = guesser_conf['pooling']
 
             self.random_seed = guesser_conf['random_seed']
+            self.inference = BatchedInference(
+                guesser_conf['inference_batch_size'],
+                autotune=guesser_conf['autotune_inference_batch_size']
+            )
+        else:
+            self.inference = BatchedInference(INFERENCE_BATCH_SIZE)
 
         self.page_field: Optional[Field] = None
         self.qanta_id_field: Optional[Field] = None
@@ -270,6 +303,7 @@ class DanGuesser(AbstractGuesser):
         self.model_file = None
 
         self.model = None
+        self.quantization: Optional[Dict] = None
         self.optimizer = None
         self.criterion = None
         self.scheduler = None
@@ -394,7 +428,7 @@ class DanGuesser(AbstractGuesser):
                 lengths_dict['trigram'] = lengths
 
             page = batch.page
-            qanta_ids = batch.qanta_id.cuda()
+            qanta_ids = maybe_cuda(batch.qanta_id)
 
             if is_train:
                 self.model.zero_grad()
@@ -416,59 +450,58 @@ class DanGuesser(AbstractGuesser):
         return np.mean(batch_accuracies), np.mean(batch_losses), epoch_end - epoch_start
 
     def guess(self, questions: List[QuestionText], max_n_guesses: Optional[int]):
-        if len(questions) == 0:
-            return []
-        batch_size = 500
-        if len(questions) < batch_size:
-            return self._guess_batch(questions, max_n_guesses)
-        else:
-            all_guesses = []
-            for i in range(0, len(questions), batch_size):
-                batch_questions = questions[i:i + batch_size]
-                guesses = self._guess_batch(batch_questions, max_n_guesses)
-                all_guesses.extend(guesses)
-            return all_guesses
+        return self.inference(lambda batch: self._guess_batch(batch, max_n_guesses), questions)
 
     def _guess_batch(self, questions: List[QuestionText], max_n_guesses: Optional[int]):
         if len(questions) == 0:
             return []
+        # Quantized models only run on CPU
+        device = TORCHTEXT_DEVICE if self.quantization is None else -1
         input_dict = {}
         lengths_dict = {}
         if self.text_field is not None:
             examples = [self.text_field.preprocess(q) for q in questions]
-            text, lengths = self.text_field.process(examples, None, False)
+            text, lengths = self.text_field.process(examples, device, False)
             input_dict['text'] = text
             lengths_dict['text'] = lengths
         if self.unigram_field is not None:
             examples = [self.unigram_field.preprocess(q) for q in questions]
-            text, lengths = self.unigram_field.process(examples, None, False)
+            text, lengths = self.unigram_field.process(examples, device, False)
             input_dict['unigram'] = text
             lengths_dict['unigram'] = lengths
         if self.bigram_field is not None:
             examples = [self.bigram_field.preprocess(q) for q in questions]
-            text, lengths = self.bigram_field.process(examples, None, False)
+            text, lengths = self.bigram_field.process(examples, device, False)
             input_dict['bigram'] = text
             lengths_dict['bigram'] = lengths
         if self.trigram_field is not None:
             examples = [self.trigram_field.preprocess(q) for q in questions]
-            text, lengths = self.trigram_field.process(examples, None, False)
+            text, lengths = self.trigram_field.process(examples, device, False)
             input_dict['trigram'] = text
             lengths_dict['trigram'] = lengths
-        qanta_ids = self.qanta_id_field.process([0 for _ in questions]).cuda()
-        guesses = []
+        qanta_ids = self.qanta_id_field.process([0 for _ in questions], device, False)
         out = self.model(input_dict, lengths_dict, qanta_ids)
-        probs = F.softmax(out).data.cpu().numpy()
-        n_examples = probs.shape[0]
-        preds = np.argsort(-probs, axis=1)
-        for i in range(n_examples):
-            guesses.append([])
-            for p in preds[i][:max_n_guesses]:
-                guesses[-1].append((self.i_to_ans[p], probs[i][p]))
-        return guesses
+        return top_k_guesses(F.softmax(out), max_n_guesses, self.i_to_ans)
 
     def save(self, directory: str):
         shutil.copyfile(self.model_file, os.path.join(directory, 'dan.pt'))
         shell(f'rm -f {self.model_file}')
+        self._save_params(directory)
+
+    def save_quantized(self, directory: str, fp16_embeddings=False):
+        """
+        Save an int8 dynamically quantized copy of this guesser to directory, it can be loaded with DanGuesser.load.
+        This guesser and its model are left unchanged.
+        """
+        if self.quantization is not None:
+            raise ValueError('Guesser is already quantized')
+        quantized = copy.copy(self)
+        quantized.model = quantize_dan_model(copy.deepcopy(self.model), fp16_embeddings=fp16_embeddings)
+        quantized.quantization = {'fp16_embeddings': fp16_embeddings}
+        torch.save(quantized.model.state_dict(), os.path.join(directory, 'dan.pt'))
+        quantized._save_params(directory)
+
+    def _save_params(self, directory: str):
         with open(os.path.join(directory, 'dan.pkl'), 'wb') as f:
             cloudpickle.dump({
                 'page_field': self.page_field,
@@ -499,6 +532,7 @@ class DanGuesser(AbstractGuesser):
                 'lowercase': self.lowercase,
                 'pooling': self.pooling,
                 'random_seed': self.random_seed,
+                'quantization': self.quantization,
                 'config_num': self.config_num
             }, f)
 
@@ -539,6 +573,7 @@ class DanGuesser(AbstractGuesser):
         guesser.lowercase = params['lowercase']
         guesser.pooling = params['pooling']
         guesser.random_seed = params['random_seed']
+        guesser.quantization = params.get('quantization')
         guesser.model = DanModel(
             guesser.n_classes,
             text_field=guesser.text_field,
@@ -550,14 +585,69 @@ class DanGuesser(AbstractGuesser):
             n_hidden_units=guesser.n_hidden_units,
             pooling=guesser.pooling
         )
+        quantized = guesser.quantization is not None
+        if quantized:
+            # The quantized state dict only loads into a model with the same quantized structure
+            guesser.model = quantize_dan_model(guesser.model, **guesser.quantization)
         guesser.model.load_state_dict(torch.load(
-            os.path.join(directory, 'dan.pt'), map_location=lambda storage, loc: storage
+            os.path.join(directory, 'dan.pt'), map_location=map_location(force_cpu=not CUDA or quantized)
         ))
         guesser.model.eval()
-        if CUDA:
-            guesser.model = guesser.model.cuda()
+        if not quantized:
+            guesser.model = maybe_cuda(guesser.model)
+        configure_threads()
         return guesser
 
     @classmethod
     def targets(cls):
         return ['dan.pt', 'dan.pkl']
+
+
+def _evaluate_guesser(guesser: DanGuesser, questions: List[str], pages: List[str]):
+    start = time.time()
+    guesses = guesser.guess(questions, 1)
+    elapsed = time.time() - start
+    top_guesses = [g[0][0] if len(g) > 0 else None for g in guesses]
+    accuracy = float(np.mean([g == p for g, p in zip(top_guesses, pages)]))
+    return top_guesses, {
+        'accuracy': accuracy,
+        'seconds': elapsed,
+        'questions_per_second': len(questions) / max(elapsed, 1e-9)
+    }
+
+
+def compare_quantized(directory: str, quantized_directory: str, fold=GUESSER_DEV_FOLD):
+    """
+    Compare the accuracy and CPU latency of a DanGuesser with its quantized export on the first sentence and full
+    text of each question in fold
+
+    :param directory: directory of the original guesser
+    :param quantized_directory: directory of the quantized guesser
+    :param fold: fold to evaluate on
+    :return: report dictionary, also written to quantized_directory/quantization_report_{fold}.json
+    """
+    if CUDA:
+        raise ValueError('Quantized models run on CPU, set QB_FORCE_CPU=1 so that latencies are comparable')
+    questions = get_qanta_database().by_fold()[fold]
+    pages = [q.page for q in questions]
+    report = {'fold': fold, 'n_questions': len(questions)}
+    guessers = {
+        'original': (directory, DanGuesser.load(directory)),
+        'quantized': (quantized_directory, DanGuesser.load(quantized_directory))
+    }
+    for name, (guesser_dir, guesser) in guessers.items():
+        report[name] = {'model_bytes': os.path.getsize(os.path.join(guesser_dir, 'dan.pt'))}
+
+    for text_type, texts in [('first', [q.first_sentence for q in questions]), ('full', [q.text for q in questions])]:
+        top_guesses = {}
+        for name, (_, guesser) in guessers.items():
+            log.info(f'Evaluating {name} guesser on {text_type} {fold} questions')
+            top_guesses[name], report[name][text_type] = _evaluate_guesser(guesser, texts, pages)
+        report[f'{text_type}_agreement'] = float(np.mean([
+            o == q for o, q in zip(top_guesses['original'], top_guesses['quantized'])
+        ]))
+
+    with open(os.path.join(quantized_directory, f'quantization_report_{fold}.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+
+    return report
@@ -1,11 +1,14 @@
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Iterable, Callable
 import subprocess
 import os
 import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
-from elasticsearch_dsl import DocType, Text, Keyword, Search, Index
+from elasticsearch_dsl import DocType, Text, Keyword, Search, MultiSearch, Index
 from elasticsearch_dsl.connections import connections
+from elasticsearch.helpers import streaming_bulk
 import elasticsearch
 import tqdm
 from nltk.tokenize import word_tokenize
@@ -14,7 +17,6 @@ from jinja2 import Environment, PackageLoader
 from qanta.wikipedia.cached_wikipedia import Wikipedia
 from qanta.datasets.abstract import QuestionText
 from qanta.guesser.abstract import AbstractGuesser
-from qanta.spark import create_spark_context
 from qanta.config import conf
 from qanta.util.io import get_tmp_dir, safe_path
 from qanta import qlogging
@@ -73,8 +75,43 @@ def create_doctype(index_name, similarity):
     return Answer
 
 
+def bounded_thread_map(func: Callable, items: Iterable, n_threads: int, window: int) -> Iterable:
+    """
+    Like ThreadPoolExecutor.map, but yields results in order while keeping at most window items in flight so that
+    results are not accumulated in memory faster than they are consumed
+    """
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        futures = []
+        for item in items:
+            futures.append(executor.submit(func, item))
+            if len(futures) >= window:
+                yield futures.pop(0).result()
+        for f in futures:
+            yield f.result()
+
+
+def pooled_connection_kwargs(connection: elasticsearch.Elasticsearch, maxsize: int) -> Dict:
+    """
+    Arguments for creating a connection to the same hosts with the same settings as connection, but with a connection
+    pool of maxsize connections per host
+    """
+    transport = connection.transport
+    return dict(
+        transport.kwargs,
+        hosts=transport.hosts,
+        connection_class=transport.connection_class,
+        serializer=transport.serializer,
+        max_retries=transport.max_retries,
+        retry_on_timeout=transport.retry_on_timeout,
+        retry_on_status=transport.retry_on_status,
+        send_get_body_as=transport.send_get_body_as,
+        maxsize=maxsize
+    )
+
+
 class ElasticSearchIndex:
-    def __init__(self, name='qb', similarity='default', bm25_b=None, bm25_k1=None):
+    def __init__(self, name='qb', similarity='default', bm25_b=None, bm25_k1=None,
+                 bulk_batch_size=500, n_producer_threads=4):
         self.name = name
         self.ix = Index(self.name)
         self.answer_doc = create_doctype(self.name, similarity)
@@ -84,6 +121,8 @@ class ElasticSearchIndex:
             bm25_k1 = 1.2
         self.bm25_b = bm25_b
         self.bm25_k1 = bm25_k1
+        self.bulk_batch_size = bulk_batch_size
+        self.n_producer_threads = n_producer_threads
 
     def delete(self):
         try:
@@ -103,6 +142,46 @@ class ElasticSearchIndex:
         self.ix.open()
         self.answer_doc.init(index=self.name)
 
+    def _doc_action(self, **fields) -> Dict:
+        action = self.answer_doc(**fields).to_dict(include_meta=True)
+        action['_index'] = self.name
+        return action
+
+    def _refresh_interval(self) -> Optional[str]:
+        settings = self.ix.get_settings(name='index.refresh_interval')
+        for index_settings in settings.values():
+            return index_settings['settings'].get('index', {}).get('refresh_interval')
+        return None
+
+    def bulk_index(self, actions: Iterable[Dict], description: str = 'Indexing'):
+        """
+        Index documents using bulk requests of bulk_batch_size documents. Refreshing is disabled while loading and
+        re-enabled afterward since refreshing after every batch dominates indexing time.
+        """
+        es = connections.get_connection()
+        refresh_interval = self._refresh_interval()
+        self.ix.put_settings(body={'index': {'refresh_interval': '-1'}})
+        n_indexed = 0
+        n_failed = 0
+        start_time = time.time()
+        try:
+            results = streaming_bulk(es, actions, chunk_size=self.bulk_batch_size, raise_on_error=False)
+            for ok, item in tqdm.tqdm(results, desc=description, mininterval=1):
+                if ok:
+                    n_indexed += 1
+                else:
+                    n_failed += 1
+                    log.warning(f'Failed to index document: {item}')
+        finally:
+            # None resets the interval to the cluster default when the index did not set one
+            self.ix.put_settings(body={'index': {'refresh_interval': refresh_interval}})
+            self.ix.refresh()
+        elapsed = time.time() - start_time
+        log.info(
+            f'{description}: indexed {n_indexed} documents with {n_failed} failures in {elapsed:.1f}s '
+            f'({n_indexed / max(elapsed, 1e-6):.1f} docs/s)'
+        )
+
     def build_large_docs(self, documents: Dict[str, str], use_wiki=True, use_qb=True, rebuild_index=False):
         if rebuild_index or bool(int(os.getenv('QB_REBUILD_INDEX', 0))):
             log.info(f'Deleting index: {self.name}')
@@ -115,22 +194,22 @@ class ElasticSearchIndex:
             self.init()
             wiki_lookup = Wikipedia()
             log.info('Indexing questions and corresponding wikipedia pages as large docs...')
-            for page in tqdm.tqdm(documents):
-                if use_wiki and page in wiki_lookup:
-                    wiki_content = wiki_lookup[page].text
-                else:
-                    wiki_content = ''
 
-                if use_qb:
-                    qb_content = documents[page]
-                else:
-                    qb_content = ''
+            def actions():
+                for page in documents:
+                    if use_wiki and page in wiki_lookup:
+                        wiki_content = wiki_lookup[page].text
+                    else:
+                        wiki_content = ''
 
-                answer = self.answer_doc(
-                    page=page,
-                    wiki_content=wiki_content, qb_content=qb_content
-                )
-                answer.save(index=self.name)
+                    if use_qb:
+                        qb_content = documents[page]
+                    else:
+                        qb_content = ''
+
+                    yield self._doc_action(page=page, wiki_content=wiki_content, qb_content=qb_content)
+
+            self.bulk_index(actions(), description='Indexing large docs')
 
     def build_many_docs(self, pages, documents, use_wiki=True, use_qb=True, rebuild_index=False):
         if rebuild_index or bool(int(os.getenv('QB_REBUILD_INDEX', 0))):
@@ -145,26 +224,34 @@ class ElasticSearchIndex:
             log.info('Indexing questions and corresponding pages as many docs...')
             if use_qb:
                 log.info('Indexing questions...')
-                for page, doc in tqdm.tqdm(documents):
-                    self.answer_doc(page=page, qb_content=doc).save()
+                self.bulk_index(
+                    (self._doc_action(page=page, qb_content=doc) for page, doc in documents),
+                    description='Indexing questions'
+                )
 
             if use_wiki:
                 log.info('Indexing wikipedia...')
                 wiki_lookup = Wikipedia()
-                for page in tqdm.tqdm(pages):
+
+                def tokenize_page(page):
                     if page in wiki_lookup:
-                        content = word_tokenize(wiki_lookup[page].text)
+                        return page, word_tokenize(wiki_lookup[page].text)
+                    else:
+                        return page, []
+
+                def actions():
+                    tokenized_pages = bounded_thread_map(
+                        tokenize_page, pages, self.n_producer_threads, 4 * self.n_producer_threads
+                    )
+                    for page, content in tokenized_pages:
                         for i in range(0, len(content), 200):
                             chunked_content = content[i:i + 200]
                             if len(chunked_content) > 0:
-                                self.answer_doc(page=page, wiki_content=' '.join(chunked_content)).save()
+                                yield self._doc_action(page=page, wiki_content=' '.join(chunked_content))
 
-    def search(self, text: str, max_n_guesses: int,
-               normalize_score_by_length=False,
-               wiki_boost=1, qb_boost=1):
-        if not self.exists():
-            raise ValueError('The index does not exist, you must create it before searching')
+                self.bulk_index(actions(), description='Indexing wikipedia')
 
+    def _build_search(self, text: str, max_n_guesses: int, wiki_boost=1, qb_boost=1) -> Search:
         if wiki_boost != 1:
             wiki_field = 'wiki_content^{}'.format(wiki_boost)
         else:
@@ -175,10 +262,12 @@ class ElasticSearchIndex:
         else:
             qb_field = 'qb_content'
 
-        s = Search(index=self.name)[0:max_n_guesses].query(
+        return Search(index=self.name)[0:max_n_guesses].query(
             'multi_match', query=text, fields=[wiki_field, qb_field]
         )
-        results = s.execute()
+
+    @staticmethod
+    def _parse_results(text: str, results, normalize_score_by_length=False):
         guess_set = set()
         guesses = []
         if normalize_score_by_length:
@@ -193,6 +282,69 @@ class ElasticSearchIndex:
                 guesses.append((r.page, r.meta.score / query_length))
         return guesses
 
+    def search(self, text: str, max_n_guesses: int,
+               normalize_score_by_length=False,
+               wiki_boost=1, qb_boost=1):
+        if not self.exists():
+            raise ValueError('The index does not exist, you must create it before searching')
+
+        s = self._build_search(text, max_n_guesses, wiki_boost=wiki_boost, qb_boost=qb_boost)
+        results = s.execute()
+        return self._parse_results(text, results, normalize_score_by_length=normalize_score_by_length)
+
+    def multi_search(self, texts: List[str], max_n_guesses: int,
+                     normalize_score_by_length=False, wiki_boost=1, qb_boost=1,
+                     batch_size=50, n_threads=8):
+        """
+        Search for many queries by grouping them into _msearch requests of batch_size queries which are sent
+        concurrently by n_threads threads sharing one connection pool. If a batch request fails the batch is
+        retried with one search request per query, and if a single query in a batch fails only that query is
+        retried.
+        """
+        if not self.exists():
+            raise ValueError('The index does not exist, you must create it before searching')
+
+        connection_alias = f'{self.name}_msearch_{n_threads}'
+        try:
+            connections.get_connection(connection_alias)
+        except KeyError:
+            connections.create_connection(
+                alias=connection_alias, **pooled_connection_kwargs(connections.get_connection(), n_threads)
+            )
+
+        def search_one(text):
+            s = self._build_search(
+                text, max_n_guesses, wiki_boost=wiki_boost, qb_boost=qb_boost
+            ).using(connection_alias)
+            return self._parse_results(text, s.execute(), normalize_score_by_length=normalize_score_by_length)
+
+        def search_batch(batch_texts):
+            ms = MultiSearch(index=self.name, using=connection_alias)
+            for text in batch_texts:
+                ms = ms.add(self._build_search(text, max_n_guesses, wiki_boost=wiki_boost, qb_boost=qb_boost))
+            try:
+                responses = ms.execute(raise_on_error=False)
+            except elasticsearch.exceptions.ElasticsearchException as e:
+                log.warning(f'Multi search of {len(batch_texts)} queries failed, falling back to single searches: {e}')
+                return [search_one(text) for text in batch_texts]
+
+            batch_guesses = []
+            for text, results in zip(batch_texts, responses):
+                if results is None:
+                    batch_guesses.append(search_one(text))
+                else:
+                    batch_guesses.append(
+                        self._parse_results(text, results, normalize_score_by_length=normalize_score_by_length)
+                    )
+            return batch_guesses
+
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+        guesses = []
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            for batch_guesses in executor.map(search_batch, batches):
+                guesses.extend(batch_guesses)
+        return guesses
+
 
 class ElasticSearchGuesser(AbstractGuesser):
     def __init__(self, config_num):
@@ -205,6 +357,9 @@ class ElasticSearchGuesser(AbstractGuesser):
         self.normalize_score_by_length = guesser_conf['normalize_score_by_length']
         self.qb_boost = guesser_conf['qb_boost']
         self.wiki_boost = guesser_conf['wiki_boost']
+        self.bulk_batch_size = guesser_conf['bulk_batch_size']
+        self.n_producer_threads = guesser_conf['n_producer_threads']
+        self.msearch_batch_size = guesser_conf['msearch_batch_size']
         similarity = guesser_conf['similarity']
         self.similarity_name = similarity['name']
         if self.similarity_name == 'BM25':
@@ -215,7 +370,8 @@ class ElasticSearchGuesser(AbstractGuesser):
             self.similarity_b = None
         self.index = ElasticSearchIndex(
             name=f'qb_{self.config_num}', similarity=self.similarity_name,
-            bm25_b=self.similarity_b, bm25_k1=self.similarity_k1
+            bm25_b=self.similarity_b, bm25_k1=self.similarity_k1,
+            bulk_batch_size=self.bulk_batch_size, n_producer_threads=self.n_producer_threads
         )
 
     def parameters(self):
@@ -257,8 +413,12 @@ class ElasticSearchGuesser(AbstractGuesser):
             )
 
         if len(questions) > 1:
-            sc = create_spark_context(configs=[('spark.executor.cores', self.n_cores), ('spark.executor.memory', '20g')])
-            return sc.parallelize(questions, 16 * self.n_cores).map(es_search).collect()
+            return self.index.multi_search(
+                questions, max_n_guesses,
+                normalize_score_by_length=self.normalize_score_by_length,
+                wiki_boost=self.wiki_boost, qb_boost=self.qb_boost,
+                batch_size=self.msearch_batch_size, n_threads=self.n_cores
+            )
         elif len(questions) == 1:
             return [es_search(questions[0])]
         else:
@@ -280,6 +440,8 @@ class ElasticSearchGuesser(AbstractGuesser):
         guesser.normalize_score_by_length = params['normalize_score_by_length']
         guesser.qb_boost = params['qb_boost']
         guesser.wiki_boost = params['wiki_boost']
+        if 'msearch_batch_size' in params:
+            guesser.msearch_batch_size = params['msearch_batch_size']
         guesser.similarity_name = params['similarity_name']
         guesser.similarity_b = params['similarity_b']
         guesser.similarity_k1 = params['similarity_k1']
@@ -296,6 +458,7 @@ class ElasticSearchGuesser(AbstractGuesser):
                 'normalize_score_by_length': self.normalize_score_by_length,
                 'qb_boost': self.qb_boost,
                 'wiki_boost': self.wiki_boost,
+                'msearch_batch_size': self.msearch_batch_size,
                 'config_num': self.config_num,
                 'similarity_name': self.similarity_name,
                 'similarity_k1': self.similarity_k1,
@@ -304,13 +467,16 @@ class ElasticSearchGuesser(AbstractGuesser):
 
     def web_api(self, host='0.0.0.0', port=5000, debug=False):
         from flask import Flask, jsonify, request
+        from qanta.guesser.guess_cache import CachedGuesser, create_guess_cache
 
         app = Flask(__name__)
+        # Clients during live play repeatedly send the same question prefixes
+        cached_guesser = CachedGuesser(self, create_guess_cache())
 
         @app.route('/api/answer_question', methods=['POST'])
         def answer_question():
             text = request.form['text']
-            guess, score = self.guess([text], 1)[0][0]
+            guess, score = cached_guesser.guess([text], 1)[0][0]
             return jsonify({'guess': guess, 'score': float(score)})
 
         @app.route('/api/get_highlights', methods=['POST'])
@@ -407,7 +573,7 @@ class ElasticSearchGuesser(AbstractGuesser):
             text = request.form['text']
             answer = request.form['answer']
             answer = answer.replace(" ", "_").lower()
-            guesses = self.guess([text], 20)[0]
+            guesses = cached_guesser.guess([text], 20)[0]
 
             score_fn = []
             sum_normalize = 0.0
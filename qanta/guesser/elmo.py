@@ -22,6 +22,7 @@ from qanta.torch import (
     BaseLogger, TerminateOnNaN, EarlyStopping, ModelCheckpoint,
     MaxEpochStopping, TrainingManager
 )
+from qanta.torch.inference import CUDA, BatchedInference, top_k_guesses, map_location, maybe_cuda, configure_threads
 from qanta import qlogging
 
 
@@ -30,7 +31,7 @@ log = qlogging.get(__name__)
 ELMO_OPTIONS_FILE = "https://s3-us-west-2.amazonaws.com/allennlp/models/elmo/2x4096_512_2048cnn_2xhighway/elmo_2x4096_512_2048cnn_2xhighway_options.json"
 ELMO_WEIGHTS_FILE = "https://s3-us-west-2.amazonaws.com/allennlp/models/elmo/2x4096_512_2048cnn_2xhighway/elmo_2x4096_512_2048cnn_2xhighway_weights.hdf5"
 ELMO_DIM = 1024
-CUDA = torch.cuda.is_available()
+INFERENCE_BATCH_SIZE = 128
 
 
 def create_save_model(model):
@@ -66,10 +67,7 @@ def batchify(x_data, y_data, batch_size=128, shuffle=False):
     for i in range(0, len(x_data), batch_size):
         start, stop = i, i + batch_size
         x_batch = batch_to_ids(x_data[start:stop])
-        if CUDA:
-            y_batch = Variable(torch.from_numpy(np.array(y_data[start:stop])).cuda())
-        else:
-            y_batch = Variable(torch.from_numpy(np.array(y_data[start:stop])))
+        y_batch = Variable(maybe_cuda(torch.from_numpy(np.array(y_data[start:stop]))))
         batches.append((x_batch, y_batch))
 
     if shuffle:
@@ -84,8 +82,13 @@ class ElmoGuesser(AbstractGuesser):
         if config_num is not None:
             guesser_conf = conf['guessers']['qanta.guesser.elmo.ElmoGuesser'][self.config_num]
             self.random_seed = guesser_conf['random_seed']
+            self.inference = BatchedInference(
+                guesser_conf['inference_batch_size'],
+                autotune=guesser_conf['autotune_inference_batch_size']
+            )
         else:
             self.random_seed = None
+            self.inference = BatchedInference(INFERENCE_BATCH_SIZE)
 
         self.model = None
         self.i_to_class = None
@@ -147,7 +150,7 @@ class ElmoGuesser(AbstractGuesser):
         for x_batch, y_batch in batches:
             if train:
                 self.model.zero_grad()
-            out = self.model(x_batch.cuda())
+            out = self.model(maybe_cuda(x_batch))
             _, preds = torch.max(out, 1)
             accuracy = torch.mean(torch.eq(preds, y_batch).float()).data[0]
             batch_loss = self.criterion(out, y_batch)
@@ -162,22 +165,14 @@ class ElmoGuesser(AbstractGuesser):
         return np.mean(batch_accuracies), np.mean(batch_losses), epoch_end - epoch_start
 
     def guess(self, questions: List[QuestionText], max_n_guesses: Optional[int]) -> List[List[Tuple[Page, float]]]:
-        y_data = np.zeros((len(questions)))
-        x_data = [tokenize_question(q) for q in questions]
-        batches = batchify(x_data, y_data, shuffle=False)
-        guesses = []
-        for x_batch, y_batch in batches:
-            out = self.model(x_batch.cuda())
-            probs = F.softmax(out).data.cpu().numpy()
-            preds = np.argsort(-probs, axis=1)
-            n_examples = probs.shape[0]
-            for i in range(n_examples):
-                example_guesses = []
-                for p in preds[i][:max_n_guesses]:
-                    example_guesses.append((self.i_to_class[p], probs[i][p]))
-                guesses.append(example_guesses)
-
-        return guesses
+        return self.inference(lambda batch: self._guess_batch(batch, max_n_guesses), questions)
+
+    def _guess_batch(self, questions: List[QuestionText], max_n_guesses: Optional[int]):
+        if len(questions) == 0:
+            return []
+        x_batch = batch_to_ids([tokenize_question(q) for q in questions])
+        out = self.model(maybe_cuda(x_batch))
+        return top_k_guesses(F.softmax(out), max_n_guesses, self.i_to_class)
 
     @classmethod
     def targets(cls) -> List[str]:
@@ -194,11 +189,11 @@ class ElmoGuesser(AbstractGuesser):
         guesser.random_seed = params['random_seed']
         guesser.model = ElmoModel(len(guesser.i_to_class))
         guesser.model.load_state_dict(torch.load(
-            os.path.join(directory, 'elmo.pt'), map_location=lambda storage, loc: storage
+            os.path.join(directory, 'elmo.pt'), map_location=map_location()
         ))
         guesser.model.eval()
-        if CUDA:
-            guesser.model = guesser.model.cuda()
+        guesser.model = maybe_cuda(guesser.model)
+        configure_threads()
         return guesser
 
     def save(self, directory: str) -> None:
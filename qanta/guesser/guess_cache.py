@@ -0,0 +1,255 @@
+"""
+Caches of guesses for serving.
+
+During live play many clients send the same question prefixes, so guesses are cached by guesser and whitespace
+normalized text. An entry computed for n guesses also answers requests for fewer guesses. GuessCache keeps entries in
+memory with LRU eviction and an optional time to live, and SqliteGuessCache stores them in a sqlite database so that
+every worker process of a server shares one cache.
+"""
+from typing import List, Tuple, Optional, Dict
+from collections import OrderedDict
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+from qanta.config import conf
+from qanta import qlogging
+
+
+log = qlogging.get(__name__)
+
+
+WHITESPACE_REGEX = re.compile(r'\s+')
+DEFAULT_MAX_SIZE = 100000
+# The sqlite cache is trimmed to max_size once per this many insertions rather than on every insertion
+SQLITE_EVICT_INTERVAL = 1000
+
+Guesses = List[Tuple[str, float]]
+
+
+def normalize_text(text: str) -> str:
+    return WHITESPACE_REGEX.sub(' ', text).strip()
+
+
+def cache_key(guesser_name: str, text: str) -> str:
+    return hashlib.sha1(f'{guesser_name}\x1f{normalize_text(text)}'.encode('utf-8')).hexdigest()
+
+
+def _covers(entry_n_guesses: Optional[int], n_guesses: Optional[int]) -> bool:
+    # None means all guesses were requested
+    if entry_n_guesses is None:
+        return True
+    return n_guesses is not None and entry_n_guesses >= n_guesses
+
+
+class GuessCache:
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE, ttl_seconds: Optional[float] = None):
+        """
+        In memory LRU cache of guesses which is safe to use from multiple threads
+
+        :param max_size: maximum number of entries, the least recently used entry is evicted past it
+        :param ttl_seconds: seconds after which an entry expires, None to never expire entries
+        """
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, n_guesses: Optional[int]) -> Optional[Guesses]:
+        """
+        Return the first n_guesses cached guesses for key, or None if there is no unexpired entry with at least
+        n_guesses guesses
+        """
+        guesses = self._get(key, n_guesses)
+        with self._lock:
+            if guesses is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return guesses
+
+    def _get(self, key: str, n_guesses: Optional[int]) -> Optional[Guesses]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, entry_n_guesses, guesses = entry
+            if expires is not None and time.monotonic() > expires:
+                del self._entries[key]
+                self.expirations += 1
+                return None
+            if not _covers(entry_n_guesses, n_guesses):
+                return None
+            self._entries.move_to_end(key)
+            return guesses[:n_guesses]
+
+    def put(self, key: str, n_guesses: Optional[int], guesses: Guesses) -> None:
+        expires = None if self.ttl_seconds is None else time.monotonic() + self.ttl_seconds
+        with self._lock:
+            self._entries[key] = (expires, n_guesses, guesses)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        n_requests = self.hits + self.misses
+        return {
+            'size': len(self),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / n_requests if n_requests > 0 else 0,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+
+class SqliteGuessCache(GuessCache):
+    def __init__(self, path: str, max_size: int = DEFAULT_MAX_SIZE, ttl_seconds: Optional[float] = None):
+        """
+        Guess cache stored in a sqlite database at path, which processes on the same machine can share. Hit and miss
+        counts are per process.
+        """
+        super().__init__(max_size=max_size, ttl_seconds=ttl_seconds)
+        self.path = path
+        self._local = threading.local()
+        self._n_puts = 0
+        conn = self._connection()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS guesses '
+            '(key TEXT PRIMARY KEY, n_guesses INTEGER, guesses TEXT, created REAL, accessed REAL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS guesses_accessed ON guesses (accessed)')
+        conn.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can not be shared between threads or across fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _get(self, key: str, n_guesses: Optional[int]) -> Optional[Guesses]:
+        conn = self._connection()
+        row = conn.execute('SELECT n_guesses, guesses, created FROM guesses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        entry_n_guesses, guesses, created = row
+        now = time.time()
+        if self.ttl_seconds is not None and now > created + self.ttl_seconds:
+            conn.execute('DELETE FROM guesses WHERE key = ?', (key,))
+            conn.commit()
+            with self._lock:
+                self.expirations += 1
+            return None
+        if not _covers(entry_n_guesses, n_guesses):
+            return None
+        conn.execute('UPDATE guesses SET accessed = ? WHERE key = ?', (now, key))
+        conn.commit()
+        return [tuple(g) for g in json.loads(guesses)[:n_guesses]]
+
+    def put(self, key: str, n_guesses: Optional[int], guesses: Guesses) -> None:
+        conn = self._connection()
+        now = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO guesses VALUES (?, ?, ?, ?, ?)',
+            (key, n_guesses, json.dumps(guesses), now, now)
+        )
+        conn.commit()
+        with self._lock:
+            self._n_puts += 1
+            evict = self._n_puts % SQLITE_EVICT_INTERVAL == 0
+        if evict:
+            self._evict(conn)
+
+    def _evict(self, conn: sqlite3.Connection):
+        cursor = conn.execute(
+            'DELETE FROM guesses WHERE key IN '
+            '(SELECT key FROM guesses ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+            (self.max_size,)
+        )
+        conn.commit()
+        with self._lock:
+            self.evictions += cursor.rowcount
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM guesses').fetchone()[0]
+
+    def clear(self):
+        conn = self._connection()
+        conn.execute('DELETE FROM guesses')
+        conn.commit()
+
+
+def create_guess_cache() -> GuessCache:
+    """
+    Create the guess cache described by the guess_cache section of the configuration
+    """
+    cache_conf = conf['guess_cache']
+    if cache_conf['sqlite_path'] is None:
+        return GuessCache(max_size=cache_conf['max_size'], ttl_seconds=cache_conf['ttl_seconds'])
+    else:
+        return SqliteGuessCache(
+            cache_conf['sqlite_path'], max_size=cache_conf['max_size'], ttl_seconds=cache_conf['ttl_seconds']
+        )
+
+
+class CachedGuesser:
+    def __init__(self, guesser, cache: GuessCache, name: Optional[str] = None):
+        """
+        Wrap anything with a guess(questions, max_n_guesses) method so that guesses are read from cache when
+        possible. Only the questions that miss the cache are passed to the wrapped guesser, as a single batch.
+
+        :param guesser: guesser or MicroBatcher to wrap
+        :param cache: cache to use, may be shared by several guessers
+        :param name: name distinguishing this guesser's entries in a shared cache, by default its class name
+        """
+        self.guesser = guesser
+        self.cache = cache
+        self.name = type(guesser).__name__ if name is None else name
+
+    def guess(self, questions: List[str], max_n_guesses: Optional[int]) -> List[Guesses]:
+        results = [None] * len(questions)
+        missed = OrderedDict()
+        for i, text in enumerate(questions):
+            key = cache_key(self.name, text)
+            guesses = self.cache.get(key, max_n_guesses)
+            if guesses is None:
+                missed.setdefault(key, []).append(i)
+            else:
+                results[i] = guesses
+
+        if len(missed) > 0:
+            miss_questions = [questions[indices[0]] for indices in missed.values()]
+            computed = self.guesser.guess(miss_questions, max_n_guesses)
+            for (key, indices), guesses in zip(missed.items(), computed):
+                guesses = [(page, float(score)) for page, score in guesses]
+                self.cache.put(key, max_n_guesses, guesses)
+                for i in indices:
+                    results[i] = guesses
+        return results
+
+    def __getattr__(self, attr):
+        if attr == 'guesser':
+            raise AttributeError(attr)
+        return getattr(self.guesser, attr)
@@ -0,0 +1,184 @@
+"""
+Columnar on-disk storage for guesses produced by AbstractGuesser.generate_guesses.
+
+Each file stores the guesses of one guesser for one fold and output type. The file starts with a small JSON header
+followed by one contiguous array per column so that each column can be memory mapped independently, using the store
+layout of qanta.util.columnar. Rows are sorted by qanta_id which makes reading a range of questions a binary search
+instead of a scan.
+
+Columns:
+    qanta_id: int32
+    proto_id: int32 code into the header proto_ids table, -1 if the question has no protobowl id
+    char_index: int32
+    guess: int32 code into the header pages table
+    score: float32
+
+The fold and guesser columns of the DataFrame representation are constant per file so they are stored in the header.
+"""
+from typing import Optional, List, Tuple, Dict
+
+import numpy as np
+import pandas as pd
+
+from qanta.util.columnar import write_columns, read_header, map_column
+
+
+MAGIC = b'QBGUESS1'
+COLUMNS = [
+    ('qanta_id', '<i4'),
+    ('proto_id', '<i4'),
+    ('char_index', '<i4'),
+    ('guess', '<i4'),
+    ('score', '<f4')
+]
+DF_COLUMNS = ['qanta_id', 'proto_id', 'char_index', 'guess', 'score', 'fold', 'guesser']
+
+
+def _encode(values) -> Tuple[np.ndarray, List]:
+    codes, uniques = pd.factorize(values)
+    return codes.astype(np.int32), [u.item() if isinstance(u, np.generic) else u for u in uniques]
+
+
+def write_guesses(path: str, guess_df: pd.DataFrame, fold: str, guesser: Optional[str] = None) -> None:
+    """
+    Write guesses for a single fold to path in the columnar format
+    :param path: output file
+    :param guess_df: dataframe in the format produced by AbstractGuesser.generate_guesses
+    :param fold: fold of the guesses, stored in the header
+    :param guesser: name of the guesser, by default inferred from the guesser column
+    """
+    if guesser is None:
+        guessers = guess_df.guesser.unique()
+        guesser = guessers[0] if len(guessers) > 0 else None
+
+    order = np.argsort(guess_df.qanta_id.values, kind='mergesort')
+    proto_codes, proto_ids = _encode(guess_df.proto_id.values[order])
+    page_codes, pages = _encode(guess_df.guess.values[order])
+    arrays = {
+        'qanta_id': guess_df.qanta_id.values[order],
+        'proto_id': proto_codes,
+        'char_index': guess_df.char_index.values[order],
+        'guess': page_codes,
+        'score': guess_df.score.values[order]
+    }
+
+    _write_store(path, arrays, fold, guesser, pages, proto_ids)
+
+
+def _write_store(path: str, arrays, fold: str, guesser: Optional[str], pages: List[str], proto_ids: List) -> None:
+    header = {
+        'n_rows': len(arrays['qanta_id']),
+        'fold': fold,
+        'guesser': guesser,
+        'pages': pages,
+        'proto_ids': proto_ids
+    }
+    write_columns(path, MAGIC, header, {name: np.asarray(arrays[name], dtype=dtype) for name, dtype in COLUMNS})
+
+
+def _remap_codes(codes: np.ndarray, values: List, lookup: Dict, merged_values: List) -> np.ndarray:
+    remap = np.empty(len(values) + 1, dtype=np.int32)
+    for i, v in enumerate(values):
+        if v not in lookup:
+            lookup[v] = len(merged_values)
+            merged_values.append(v)
+        remap[i] = lookup[v]
+    remap[-1] = -1
+    return remap[codes]
+
+
+def merge_guesses(input_paths: List[str], output_path: str) -> None:
+    """
+    Merge several guess files for the same fold and guesser, such as shards written by parallel workers, into one
+    file without decoding pages into python strings
+    """
+    if len(input_paths) == 0:
+        raise ValueError('At least one input path is required')
+    stores = [GuessStore(p) for p in input_paths]
+    # Shards without rows do not know their guesser
+    guessers = {s.guesser for s in stores if s.guesser is not None}
+    if len(guessers) > 1:
+        raise ValueError(f'Cannot merge guesses of different guessers: {sorted(guessers)}')
+    guesser = guessers.pop() if len(guessers) > 0 else None
+    pages = []
+    page_lookup = {}
+    proto_ids = []
+    proto_lookup = {}
+    columns = {name: [] for name, _ in COLUMNS}
+    for store in stores:
+        columns['qanta_id'].append(np.array(store.column('qanta_id')))
+        columns['char_index'].append(np.array(store.column('char_index')))
+        columns['score'].append(np.array(store.column('score')))
+        columns['guess'].append(_remap_codes(store.column('guess'), store.pages, page_lookup, pages))
+        columns['proto_id'].append(_remap_codes(store.column('proto_id'), store.proto_ids, proto_lookup, proto_ids))
+
+    arrays = {name: np.concatenate(values) for name, values in columns.items()}
+    order = np.argsort(arrays['qanta_id'], kind='mergesort')
+    arrays = {name: values[order] for name, values in arrays.items()}
+    _write_store(output_path, arrays, stores[0].fold, guesser, pages, proto_ids)
+
+
+class GuessStore:
+    def __init__(self, path: str):
+        """
+        Read only view of a guess file written by write_guesses. Columns are memory mapped lazily so opening a store
+        only reads the header.
+        """
+        self.path = path
+        header, self.data_start = read_header(path, MAGIC, 'guess store file')
+
+        self.n_rows: int = header['n_rows']
+        self.fold: str = header['fold']
+        self.guesser: Optional[str] = header['guesser']
+        self.pages: List[str] = header['pages']
+        self.proto_ids: List = header['proto_ids']
+        self._column_info = header['columns']
+        self._columns = {}
+
+    def __len__(self):
+        return self.n_rows
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        Return a memory mapped array of the encoded values in a column. For guess and proto_id these are codes into
+        GuessStore.pages and GuessStore.proto_ids
+        """
+        if name not in self._columns:
+            self._columns[name] = map_column(self.path, self.data_start, self._column_info[name], self.n_rows)
+        return self._columns[name]
+
+    def row_range(self, min_qanta_id: Optional[int] = None, max_qanta_id: Optional[int] = None) -> slice:
+        """
+        Return the slice of rows with min_qanta_id <= qanta_id <= max_qanta_id, both bounds are optional
+        """
+        qanta_ids = self.column('qanta_id')
+        start = 0 if min_qanta_id is None else int(np.searchsorted(qanta_ids, min_qanta_id, side='left'))
+        stop = self.n_rows if max_qanta_id is None else int(np.searchsorted(qanta_ids, max_qanta_id, side='right'))
+        return slice(start, stop)
+
+    def to_df(self, min_qanta_id: Optional[int] = None, max_qanta_id: Optional[int] = None,
+              columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Decode the requested rows and columns into a DataFrame matching the format of
+        AbstractGuesser.generate_guesses. Pages and protobowl ids are decoded through their lookup tables so equal
+        values share a single python object.
+        """
+        if columns is None:
+            columns = DF_COLUMNS
+        rows = self.row_range(min_qanta_id=min_qanta_id, max_qanta_id=max_qanta_id)
+        n_rows = rows.stop - rows.start
+        data = {}
+        for name in columns:
+            if name == 'guess':
+                pages = np.array(self.pages + [None], dtype=object)
+                data[name] = pages[self.column('guess')[rows]]
+            elif name == 'proto_id':
+                proto_ids = np.array(self.proto_ids + [None], dtype=object)
+                data[name] = proto_ids[self.column('proto_id')[rows]]
+            elif name == 'fold':
+                data[name] = np.full(n_rows, self.fold, dtype=object)
+            elif name == 'guesser':
+                data[name] = np.full(n_rows, self.guesser, dtype=object)
+            else:
+                data[name] = np.array(self.column(name)[rows])
+        return pd.DataFrame(data, columns=columns)
@@ -26,12 +26,15 @@ from qanta.torch import (
     BaseLogger, TerminateOnNaN, EarlyStopping, ModelCheckpoint,
     MaxEpochStopping, TrainingManager
 )
+from qanta.torch.inference import (
+    CUDA, TORCHTEXT_DEVICE, BatchedInference, top_k_guesses, map_location, maybe_cuda, configure_threads
+)
 
 
 log = qlogging.get(__name__)
 
 
-CUDA = torch.cuda.is_available()
+INFERENCE_BATCH_SIZE = 128
 
 
 def create_save_model(model):
@@ -85,7 +88,7 @@ class RnnModel(nn.Module):
         if init_embeddings:
             mean_emb = text_vocab.vectors.mean(0)
             text_vocab.vectors[text_vocab.stoi[text_field.unk_token]] = mean_emb
-            self.text_embeddings.weight.data = text_vocab.vectors.cuda()
+            self.text_embeddings.weight.data = maybe_cuda(text_vocab.vectors)
 
         self.rnn = nn.GRU(
             self.emb_dim, n_hidden_units, n_hidden_layers,
@@ -165,6 +168,12 @@ class RnnGuesser(AbstractGuesser):
             self.lowercase = guesser_conf['lowercase']
 
             self.random_seed = guesser_conf['random_seed']
+            self.inference = BatchedInference(
+                guesser_conf['inference_batch_size'],
+                autotune=guesser_conf['autotune_inference_batch_size']
+            )
+        else:
+            self.inference = BatchedInference(INFERENCE_BATCH_SIZE)
 
         self.page_field: Optional[Field] = None
         self.qanta_id_field: Optional[Field] = None
@@ -269,7 +278,7 @@ class RnnGuesser(AbstractGuesser):
                 hidden_init = self.model.init_hidden(batch_size)
 
             page = batch.page
-            qanta_ids = batch.qanta_id.cuda()
+            qanta_ids = maybe_cuda(batch.qanta_id)
 
             if is_train:
                 self.model.zero_grad()
@@ -293,18 +302,7 @@ class RnnGuesser(AbstractGuesser):
         return np.mean(batch_accuracies), np.mean(batch_losses), epoch_end - epoch_start
 
     def guess(self, questions: List[QuestionText], max_n_guesses: Optional[int]):
-        if len(questions) == 0:
-            return []
-        batch_size = 128
-        if len(questions) < batch_size:
-            return self._guess_batch(questions, max_n_guesses)
-        else:
-            all_guesses = []
-            for i in range(0, len(questions), batch_size):
-                batch_questions = questions[i:i + batch_size]
-                guesses = self._guess_batch(batch_questions, max_n_guesses)
-                all_guesses.extend(guesses)
-            return all_guesses
+        return self.inference(lambda batch: self._guess_batch(batch, max_n_guesses), questions)
 
     def _guess_batch(self, questions: List[QuestionText], max_n_guesses: Optional[int]):
         if len(questions) == 0:
@@ -317,23 +315,15 @@ class RnnGuesser(AbstractGuesser):
         rev_order = np.argsort(order)
         ordered_examples = padded_examples[order]
         ordered_lengths = lengths[order]
-        text, lengths = self.text_field.numericalize((ordered_examples, ordered_lengths), device=None, train=False)
+        text, lengths = self.text_field.numericalize(
+            (ordered_examples, ordered_lengths), device=TORCHTEXT_DEVICE, train=False
+        )
         lengths = list(lengths.cpu().numpy())
 
-        qanta_ids = self.qanta_id_field.process([0 for _ in questions]).cuda()
-        guesses = []
+        qanta_ids = self.qanta_id_field.process([0 for _ in questions], TORCHTEXT_DEVICE, False)
         hidden_init = self.model.init_hidden(len(questions))
         out, _ = self.model(text, lengths, hidden_init, qanta_ids)
-        ordered_probs = F.softmax(out).data.cpu().numpy()
-        probs = ordered_probs[rev_order]
-
-        n_examples = probs.shape[0]
-        preds = np.argsort(-probs, axis=1)
-        for i in range(n_examples):
-            guesses.append([])
-            for p in preds[i][:max_n_guesses]:
-                guesses[-1].append((self.i_to_ans[p], probs[i][p]))
-        return guesses
+        return top_k_guesses(F.softmax(out), max_n_guesses, self.i_to_ans, row_order=rev_order)
 
     def save(self, directory: str):
         shutil.copyfile(self.model_file, os.path.join(directory, 'rnn.pt'))
@@ -390,11 +380,11 @@ class RnnGuesser(AbstractGuesser):
             n_hidden_units=guesser.n_hidden_units
         )
         guesser.model.load_state_dict(torch.load(
-            os.path.join(directory, 'rnn.pt'), map_location=lambda storage, loc: storage
+            os.path.join(directory, 'rnn.pt'), map_location=map_location()
         ))
         guesser.model.eval()
-        if CUDA:
-            guesser.model = guesser.model.cuda()
+        guesser.model = maybe_cuda(guesser.model)
+        configure_threads()
         return guesser
 
     @classmethod
@@ -0,0 +1,413 @@
+"""
+HTTP serving of guessers.
+
+Each guesser is wrapped in a MicroBatcher which coalesces guesses requested concurrently by different HTTP requests
+into a single call to AbstractGuesser.guess. Batched calls are much cheaper per question than batches of one for the
+torch guessers and for elasticsearch which sends them as one msearch. The flask app can be run by the development
+server or, for production, by gunicorn with several worker processes and threads per worker so that concurrent
+requests within a worker can share a batch.
+"""
+from typing import List, Tuple, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+import os
+import math
+import time
+import queue
+import threading
+
+from qanta import qlogging
+
+
+log = qlogging.get(__name__)
+
+
+DEFAULT_MAX_BATCH_SIZE = 64
+DEFAULT_MAX_WAIT_MS = 5
+MAX_N_GUESSES = 100
+NORMALIZATIONS = ['none', 'sum', 'softmax', 'rank']
+
+
+class PendingGuess:
+    __slots__ = ['text', 'n_guesses', 'event', 'result', 'error']
+
+    def __init__(self, text: str, n_guesses: int):
+        self.text = text
+        self.n_guesses = n_guesses
+        self.event = threading.Event()
+        self.result: Optional[List[Tuple[str, float]]] = None
+        self.error: Optional[Exception] = None
+
+
+class MicroBatcher:
+    def __init__(self, guesser, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_wait_ms: float = DEFAULT_MAX_WAIT_MS):
+        """
+        Queue of questions to guess on which a background thread drains in batches. A batch is sent to the guesser
+        once it has max_batch_size questions or max_wait_ms have passed since its first question arrived.
+
+        :param guesser: guesser to batch calls to guess for
+        :param max_batch_size: maximum number of questions per call to guess
+        :param max_wait_ms: maximum time the first question of a batch waits for more questions
+        """
+        self.guesser = guesser
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        # Threads do not survive fork, so each server process that the app is preloaded into starts its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+
+    def guess(self, questions: List[str], n_guesses: int,
+              timeout: Optional[float] = None) -> List[List[Tuple[str, float]]]:
+        """
+        Guess on questions in the next batches and block until the guesses are available
+
+        :param questions: question texts
+        :param n_guesses: number of guesses to return per question
+        :param timeout: seconds to wait for each question before raising TimeoutError, None waits indefinitely
+        """
+        self._ensure_started()
+        pending = [PendingGuess(text, n_guesses) for text in questions]
+        for p in pending:
+            self._queue.put(p)
+        for p in pending:
+            if not p.event.wait(timeout):
+                raise TimeoutError(f'No guesses after {timeout} seconds')
+            if p.error is not None:
+                raise p.error
+        return [p.result for p in pending]
+
+    def _next_batch(self) -> List[PendingGuess]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            n_guesses = max(p.n_guesses for p in batch)
+            try:
+                guesses = self.guesser.guess([p.text for p in batch], n_guesses)
+                for p, question_guesses in zip(batch, guesses):
+                    p.result = [(page, float(score)) for page, score in question_guesses[:p.n_guesses]]
+            except Exception as e:
+                log.exception(f'Guessing on a batch of {len(batch)} questions failed')
+                for p in batch:
+                    p.error = e
+            for p in batch:
+                p.event.set()
+
+
+def parse_n_guesses(value) -> int:
+    """
+    Parse the n_guesses field of a request, raising ValueError if it is not an integer in [1, MAX_N_GUESSES]
+    """
+    n_guesses = int(value)
+    if n_guesses < 1 or n_guesses > MAX_N_GUESSES:
+        raise ValueError(f'n_guesses must be between 1 and {MAX_N_GUESSES}')
+    return n_guesses
+
+
+def format_guesses(guesses: List[Tuple[str, float]]) -> List[Dict]:
+    return [{'guess': guess, 'score': score} for guess, score in guesses]
+
+
+def normalize_guesses(guesses: List[Tuple[str, float]], normalization: str) -> List[Tuple[str, float]]:
+    """
+    Put the scores of guessers on a comparable scale before combining them
+
+    :param guesses: guesses sorted by decreasing score
+    :param normalization: one of none, sum (divide by the sum of scores if it is positive), softmax, or rank
+        (1 / rank)
+    """
+    if normalization == 'none' or len(guesses) == 0:
+        return guesses
+    elif normalization == 'sum':
+        total = sum(score for _, score in guesses)
+        if total <= 0:
+            return guesses
+        return [(guess, score / total) for guess, score in guesses]
+    elif normalization == 'softmax':
+        max_score = max(score for _, score in guesses)
+        exp_scores = [math.exp(score - max_score) for _, score in guesses]
+        total = sum(exp_scores)
+        return [(guess, e / total) for (guess, _), e in zip(guesses, exp_scores)]
+    elif normalization == 'rank':
+        return [(guess, 1 / (rank + 1)) for rank, (guess, _) in enumerate(guesses)]
+    else:
+        raise ValueError(f'Unknown normalization "{normalization}", options are: {NORMALIZATIONS}')
+
+
+class GuesserEnsemble:
+    def __init__(self, guessers: Dict, weights: Optional[Dict[str, float]] = None,
+                 normalization: str = 'softmax', n_guesses_per_guesser: int = 20, max_concurrent_requests: int = 8):
+        """
+        Combine the guesses of several guessers by summing their normalized, weighted scores per page. Each guesser
+        is called from its own thread so slow guessers such as elasticsearch and vw overlap, and guessers wrapped in
+        a MicroBatcher batch the questions of concurrent ensemble requests.
+
+        :param guessers: mapping from guesser name to anything with a guess(questions, max_n_guesses) method
+        :param weights: weight of each guesser's scores, guessers that are not listed have weight 1
+        :param normalization: default normalization, see normalize_guesses
+        :param n_guesses_per_guesser: minimum number of guesses to request from each guesser before merging
+        :param max_concurrent_requests: number of ensemble requests that call the guessers at the same time, usually
+            the number of request threads of the server
+        """
+        self.guessers = guessers
+        self.weights = {} if weights is None else weights
+        self.normalization = normalization
+        self.n_guesses_per_guesser = n_guesses_per_guesser
+        self.max_concurrent_requests = max_concurrent_requests
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Like MicroBatcher, each forked server process needs its own threads
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    # A thread per guesser for every concurrent request so that requests do not queue behind each
+                    # other and their calls to the same guesser reach its MicroBatcher together
+                    n_threads = max(len(self.guessers), 1) * max(self.max_concurrent_requests, 1)
+                    self._executor = ThreadPoolExecutor(max_workers=n_threads)
+                    self._pid = os.getpid()
+        return self._executor
+
+    @staticmethod
+    def _timed_guess(guesser, questions, n_guesses):
+        start = time.time()
+        try:
+            return guesser.guess(questions, n_guesses), None, time.time() - start
+        except Exception as e:
+            log.exception('Ensemble guesser failed')
+            return None, str(e), time.time() - start
+
+    def guess(self, questions: List[str], n_guesses: int, normalization: Optional[str] = None,
+              weights: Optional[Dict[str, float]] = None) -> Tuple[List[List[Tuple[str, float]]], Dict[str, Dict]]:
+        """
+        :param questions: question texts
+        :param n_guesses: number of merged guesses to return per question
+        :param normalization: overrides the default normalization
+        :param weights: overrides the weights of the listed guessers
+        :return: merged guesses for each question, and the weight, latency in milliseconds, and error if it failed
+            of each guesser
+        """
+        if normalization is None:
+            normalization = self.normalization
+        if normalization not in NORMALIZATIONS:
+            raise ValueError(f'Unknown normalization "{normalization}", options are: {NORMALIZATIONS}')
+        guesser_weights = {name: self.weights.get(name, 1.0) for name in self.guessers}
+        if weights is not None:
+            guesser_weights.update({name: w for name, w in weights.items() if name in guesser_weights})
+
+        executor = self._get_executor()
+        guesser_n_guesses = max(n_guesses, self.n_guesses_per_guesser)
+        futures = {
+            name: executor.submit(self._timed_guess, g, questions, guesser_n_guesses)
+            for name, g in self.guessers.items()
+        }
+
+        merged = [{} for _ in questions]
+        report = {}
+        for name, future in futures.items():
+            guesses, error, elapsed = future.result()
+            report[name] = {'weight': guesser_weights[name], 'latency_ms': 1000 * elapsed}
+            if error is not None:
+                report[name]['error'] = error
+                continue
+            weight = guesser_weights[name]
+            for scores, question_guesses in zip(merged, guesses):
+                for guess, score in normalize_guesses(question_guesses, normalization):
+                    scores[guess] = scores.get(guess, 0) + weight * float(score)
+
+        results = [
+            sorted(scores.items(), key=lambda x: x[1], reverse=True)[:n_guesses]
+            for scores in merged
+        ]
+        return results, report
+
+
+def create_app(guessers: Dict, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+               max_wait_ms: float = DEFAULT_MAX_WAIT_MS, cache=None, ensemble_weights=None,
+               ensemble_normalization='softmax', ensemble_n_guesses_per_guesser=20, threads=8):
+    """
+    Create a flask app serving guessers with the endpoints:
+
+    POST /api/guesser with form fields guesser_name, text, and optionally n_guesses (default 1). Returns the top
+    guess and score as guess and score, and all n_guesses guesses as guesses.
+
+    POST /api/guesser/batch with a JSON body {"guesser_name": str, "questions": [str], "n_guesses": int}. Returns
+    {"guesses": [[{"guess": str, "score": float}]]} with one list per question.
+
+    POST /api/ensemble with a JSON body {"questions": [str], "n_guesses": int} and optionally "normalization" and
+    "weights" overriding the defaults. Guesses with every loaded guesser concurrently and returns the merged guesses
+    as {"guesses": [[{"guess": str, "score": float}]], "guessers": {name: {"weight", "latency_ms"}}}, where a
+    guesser that failed also has an "error" and does not contribute to the merged guesses.
+
+    GET /api/guess_cache/stats returns the hit, miss, and eviction counts of the guess cache if there is one.
+
+    :param guessers: mapping from guesser name to loaded guesser
+    :param max_batch_size: maximum number of questions per guess call
+    :param max_wait_ms: maximum time a question waits for others to batch with
+    :param cache: optional GuessCache, cached questions are answered without waiting for a batch
+    :param ensemble_weights: default weight of each guesser in the ensemble, 1 if not listed
+    :param ensemble_normalization: default score normalization of the ensemble
+    :param ensemble_n_guesses_per_guesser: minimum number of guesses from each guesser merged by the ensemble
+    :param threads: number of request threads per server process, the ensemble runs this many requests concurrently
+    """
+    from flask import Flask, jsonify, request
+    from qanta.guesser.guess_cache import CachedGuesser
+
+    app = Flask(__name__)
+    batchers = {
+        name: MicroBatcher(g, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+        for name, g in guessers.items()
+    }
+    if cache is not None:
+        batchers = {name: CachedGuesser(b, cache, name=name) for name, b in batchers.items()}
+    ensemble = GuesserEnsemble(
+        batchers, weights=ensemble_weights, normalization=ensemble_normalization,
+        n_guesses_per_guesser=ensemble_n_guesses_per_guesser, max_concurrent_requests=threads
+    )
+
+    def error(message):
+        response = jsonify({'errors': message})
+        response.status_code = 400
+        return response
+
+    def invalid_guesser(g_name):
+        return error(f'Guesser "{g_name}" invalid, options are: "{list(guessers.keys())}"')
+
+    @app.route('/api/guesser', methods=['POST'])
+    def guess():
+        if 'guesser_name' not in request.form:
+            return error('Missing expected field "guesser_name"')
+
+        if 'text' not in request.form:
+            return error('Missing expected field "text"')
+
+        g_name = request.form['guesser_name']
+        if g_name not in batchers:
+            return invalid_guesser(g_name)
+        try:
+            n_guesses = parse_n_guesses(request.form.get('n_guesses', 1))
+        except ValueError as e:
+            return error(str(e))
+
+        guesses = batchers[g_name].guess([request.form['text']], n_guesses)[0]
+        if len(guesses) == 0:
+            return jsonify({'guess': None, 'score': None, 'guesses': []})
+        guess, score = guesses[0]
+        return jsonify({'guess': guess, 'score': score, 'guesses': format_guesses(guesses)})
+
+    @app.route('/api/guesser/batch', methods=['POST'])
+    def guess_batch():
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            return error('Expected a JSON object body')
+
+        if 'guesser_name' not in body:
+            return error('Missing expected field "guesser_name"')
+
+        questions = body.get('questions')
+        if not isinstance(questions, list) or not all(isinstance(q, str) for q in questions):
+            return error('Expected field "questions" to be a list of strings')
+
+        g_name = body['guesser_name']
+        if g_name not in batchers:
+            return invalid_guesser(g_name)
+        try:
+            n_guesses = parse_n_guesses(body.get('n_guesses', 1))
+        except (ValueError, TypeError) as e:
+            return error(str(e))
+
+        guesses = batchers[g_name].guess(questions, n_guesses)
+        return jsonify({'guesses': [format_guesses(g) for g in guesses]})
+
+    @app.route('/api/ensemble', methods=['POST'])
+    def guess_ensemble():
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            return error('Expected a JSON object body')
+
+        questions = body.get('questions')
+        if not isinstance(questions, list) or not all(isinstance(q, str) for q in questions):
+            return error('Expected field "questions" to be a list of strings')
+
+        weights = body.get('weights')
+        if weights is not None and (
+                not isinstance(weights, dict) or
+                not all(isinstance(w, (int, float)) for w in weights.values())):
+            return error('Expected field "weights" to map guesser names to numbers')
+        try:
+            n_guesses = parse_n_guesses(body.get('n_guesses', 1))
+            guesses, report = ensemble.guess(
+                questions, n_guesses, normalization=body.get('normalization'), weights=weights
+            )
+        except (ValueError, TypeError) as e:
+            return error(str(e))
+        return jsonify({'guesses': [format_guesses(g) for g in guesses], 'guessers': report})
+
+    @app.route('/api/guess_cache/stats', methods=['GET'])
+    def guess_cache_stats():
+        if cache is None:
+            return error('The guess cache is disabled')
+        return jsonify(cache.stats())
+
+    return app
+
+
+def serve(app, host='0.0.0.0', port=5000, debug=False, production=False, workers=1, threads=8):
+    """
+    Run app with the flask development server, or with gunicorn if production is True
+
+    :param workers: number of gunicorn worker processes. The app is loaded before forking so workers share the
+        memory of loaded models, guessers on GPU should use a single worker
+    :param threads: number of request threads per gunicorn worker, concurrent requests in a worker are batched
+    """
+    if not production:
+        app.run(host=host, port=port, debug=debug, threaded=True)
+        return
+
+    from gunicorn.app.base import BaseApplication
+
+    class GuesserApplication(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    log.info(f'Serving on {host}:{port} with {workers} gunicorn workers and {threads} threads per worker')
+    GuesserApplication({
+        'bind': f'{host}:{port}',
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread',
+        'preload_app': True,
+        'timeout': 120
+    }).run()
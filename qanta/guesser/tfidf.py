@@ -1,13 +1,47 @@
 from typing import List, Optional, Dict, Tuple
 import os
+import re
 from collections import defaultdict
 import pickle
+from concurrent.futures import ThreadPoolExecutor
 
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
 import numpy as np
+from scipy import sparse
 
 from qanta.guesser.abstract import AbstractGuesser
 from qanta.datasets.abstract import QuestionText
+from qanta.config import conf
+
+
+DEFAULT_TOKEN_PATTERN = CountVectorizer().token_pattern
+
+
+def _cumulative_counts(rows: np.ndarray, cols: np.ndarray, groups: np.ndarray, group_ends: np.ndarray):
+    """
+    Expand count increments into the running counts of every row. Each (row, col) increment adds 1 to col in that
+    row and every later row of the same group, up to the exclusive row group_ends[group].
+
+    :return: rows, cols, and counts of the nonzero running counts
+    """
+    if len(rows) == 0:
+        return rows, cols, np.zeros(0, dtype=np.float64)
+    order = np.lexsort((rows, cols, groups))
+    rows, cols, groups = rows[order], cols[order], groups[order]
+    n = len(rows)
+    new_key = np.ones(n, dtype=np.bool_)
+    new_key[1:] = (cols[1:] != cols[:-1]) | (groups[1:] != groups[:-1])
+    key_starts = np.flatnonzero(new_key)
+    # The count after the k-th increment of a (group, col) pair is k + 1 until its next increment or the group end
+    counts = np.arange(n) - np.repeat(key_starts, np.diff(np.append(key_starts, n))) + 1
+    next_rows = np.empty(n, dtype=rows.dtype)
+    next_rows[:-1] = rows[1:]
+    last_of_key = np.append(new_key[1:], True)
+    next_rows[last_of_key] = group_ends[groups[last_of_key]]
+    lengths = next_rows - rows
+    run_starts = np.cumsum(lengths) - lengths
+    expanded_rows = np.repeat(rows, lengths) + np.arange(lengths.sum()) - np.repeat(run_starts, lengths)
+    return expanded_rows, np.repeat(cols, lengths), np.repeat(counts, lengths).astype(np.float64)
 
 
 class TfidfGuesser(AbstractGuesser):
@@ -16,6 +50,14 @@ class TfidfGuesser(AbstractGuesser):
         self.tfidf_vectorizer = None
         self.tfidf_matrix = None
         self.i_to_ans = None
+        self._answer_matrix_t = None
+        if self.config_num is not None:
+            guesser_conf = conf['guessers']['qanta.guesser.tfidf.TfidfGuesser'][self.config_num]
+            self.chunk_size = guesser_conf['chunk_size']
+            self.n_threads = guesser_conf['n_threads']
+        else:
+            self.chunk_size = 256
+            self.n_threads = 1
 
     def train(self, training_data) -> None:
         questions = training_data[0]
@@ -39,15 +81,136 @@ class TfidfGuesser(AbstractGuesser):
 
     def guess(self, questions: List[QuestionText], max_n_guesses: Optional[int]) -> List[List[Tuple[str, float]]]:
         representations = self.tfidf_vectorizer.transform(questions)
-        guess_matrix = self.tfidf_matrix.dot(representations.T).T
-        guess_scores = guess_matrix.max(axis=1).toarray().reshape(-1)
-        guess_indices = np.array(guess_matrix.argmax(axis=1)).reshape(-1)
+        return self._guess_representations(representations, max_n_guesses)
+
+    def _guess_representations(self, representations, max_n_guesses: Optional[int]) -> List[List[Tuple[str, float]]]:
+        """
+        Score questions against all answers in chunks of self.chunk_size questions so that at most
+        chunk_size x n_answers dense scores are in memory per thread, keeping only the top max_n_guesses per question
+        """
+        if self._answer_matrix_t is None:
+            self._answer_matrix_t = self.tfidf_matrix.T.tocsr()
+        representations = representations.tocsr()
+        n_questions = representations.shape[0]
+        n_answers = self.tfidf_matrix.shape[0]
+        if max_n_guesses is None:
+            k = n_answers
+        else:
+            k = min(max_n_guesses, n_answers)
+
+        def score_chunk(start):
+            stop = min(start + self.chunk_size, n_questions)
+            scores = representations[start:stop].dot(self._answer_matrix_t).toarray()
+            if k < n_answers:
+                top_indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            else:
+                top_indices = np.tile(np.arange(n_answers), (stop - start, 1))
+            rows = np.arange(stop - start)[:, np.newaxis]
+            top_scores = scores[rows, top_indices]
+            order = np.argsort(-top_scores, axis=1)
+            return top_indices[rows, order], top_scores[rows, order]
+
+        chunk_starts = range(0, n_questions, self.chunk_size)
+        if self.n_threads > 1:
+            with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+                chunk_results = list(executor.map(score_chunk, chunk_starts))
+        else:
+            chunk_results = [score_chunk(start) for start in chunk_starts]
+
         guesses = []
-        for i in range(len(questions)):
-            idx = guess_indices[i]
-            score = guess_scores[i]
-            guesses.append([(self.i_to_ans[idx], score)])
+        for top_indices, top_scores in chunk_results:
+            for indices, scores in zip(top_indices, top_scores):
+                guesses.append([(self.i_to_ans[idx], score) for idx, score in zip(indices, scores)])
+
+        return guesses
+
+    def _supports_incremental(self) -> bool:
+        vectorizer = self.tfidf_vectorizer
+        # Partial tokens at a prefix boundary are only handled for the default pattern of 2+ word characters
+        return (
+            vectorizer.analyzer == 'word' and vectorizer.tokenizer is None and vectorizer.preprocessor is None
+            and vectorizer.strip_accents is None and vectorizer.stop_words is None
+            and vectorizer.token_pattern == DEFAULT_TOKEN_PATTERN
+        )
+
+    def guess_incremental(self, questions: List[QuestionText], char_indices: List[List[int]],
+                          max_n_guesses: Optional[int]) -> List[List[List[Tuple[str, float]]]]:
+        """
+        Tokenize each question once and record the ngrams of tokens completed since the previous prefix, then expand
+        these increments into the term counts of every prefix with array operations. A token cut by the prefix
+        boundary is handled separately since TfidfVectorizer would see it as a shorter token. Falls back to the
+        default implementation if the vectorizer uses custom preprocessing or tokenization that this does not
+        replicate.
+        """
+        if not self._supports_incremental():
+            return super().guess_incremental(questions, char_indices, max_n_guesses)
+
+        vectorizer = self.tfidf_vectorizer
+        vocabulary = vectorizer.vocabulary_
+        token_pattern = re.compile(vectorizer.token_pattern)
+        min_n, max_n = vectorizer.ngram_range
+        lowercase = vectorizer.lowercase
+
+        def ngrams_ending_with(tokens):
+            n_tokens = len(tokens)
+            for n in range(min_n, min(max_n, n_tokens) + 1):
+                term = ' '.join(tokens[n_tokens - n:])
+                if term in vocabulary:
+                    yield vocabulary[term]
 
+        def normalize(token):
+            return token.lower() if lowercase else token
+
+        increment_rows = []
+        increment_cols = []
+        increment_groups = []
+        partial_rows = []
+        partial_cols = []
+        group_ends = []
+        n_rows = 0
+        for group, (text, indices) in enumerate(zip(questions, char_indices)):
+            spans = [m.span() for m in token_pattern.finditer(text)]
+            tokens = []
+            t = 0
+            for char_ix in indices:
+                while t < len(spans) and spans[t][1] <= char_ix:
+                    start, end = spans[t]
+                    tokens.append(normalize(text[start:end]))
+                    for term_ix in ngrams_ending_with(tokens):
+                        increment_rows.append(n_rows)
+                        increment_cols.append(term_ix)
+                        increment_groups.append(group)
+                    t += 1
+
+                if t < len(spans) and char_ix - spans[t][0] >= 2:
+                    partial_token = normalize(text[spans[t][0]:char_ix])
+                    for term_ix in ngrams_ending_with(tokens + [partial_token]):
+                        partial_rows.append(n_rows)
+                        partial_cols.append(term_ix)
+                n_rows += 1
+            group_ends.append(n_rows)
+
+        rows, cols, values = _cumulative_counts(
+            np.array(increment_rows, dtype=np.int64), np.array(increment_cols, dtype=np.int64),
+            np.array(increment_groups, dtype=np.int64), np.array(group_ends, dtype=np.int64)
+        )
+        # Partial tokens only count in their own prefix, duplicate (row, col) entries are summed when converting to csr
+        counts = sparse.coo_matrix(
+            (
+                np.concatenate([values, np.ones(len(partial_rows))]),
+                (np.concatenate([rows, partial_rows]).astype(np.int64),
+                 np.concatenate([cols, partial_cols]).astype(np.int64))
+            ),
+            shape=(n_rows, len(vocabulary))
+        ).tocsr()
+        representations = vectorizer._tfidf.transform(counts, copy=False)
+        flat_guesses = self._guess_representations(representations, max_n_guesses)
+
+        guesses = []
+        position = 0
+        for indices in char_indices:
+            guesses.append(flat_guesses[position:position + len(indices)])
+            position += len(indices)
         return guesses
 
     def save(self, directory: str) -> None:
@@ -56,7 +219,9 @@ class TfidfGuesser(AbstractGuesser):
                 'config_num': self.config_num,
                 'i_to_ans': self.i_to_ans,
                 'tfidf_vectorizer': self.tfidf_vectorizer,
-                'tfidf_matrix': self.tfidf_matrix
+                'tfidf_matrix': self.tfidf_matrix,
+                'chunk_size': self.chunk_size,
+                'n_threads': self.n_threads
             }, f)
 
     @classmethod
@@ -67,6 +232,9 @@ class TfidfGuesser(AbstractGuesser):
             guesser.tfidf_vectorizer = params['tfidf_vectorizer']
             guesser.tfidf_matrix = params['tfidf_matrix']
             guesser.i_to_ans = params['i_to_ans']
+            if 'chunk_size' in params:
+                guesser.chunk_size = params['chunk_size']
+                guesser.n_threads = params['n_threads']
             return guesser
 
     @classmethod
@@ -1,10 +1,20 @@
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Iterable, Iterator, Dict
 from pprint import pformat
+from multiprocessing import Pool
 import tempfile
 import pickle
 import os
 import random
 import re
+import time
+import atexit
+import contextlib
+import socket
+import subprocess
+import threading
+
+import numpy as np
+
 from qanta.datasets.abstract import Page, TrainingData, QuestionText
 from qanta.guesser.abstract import AbstractGuesser
 from qanta.util.io import shell, safe_path, get_tmp_dir, get_tmp_filename
@@ -19,6 +29,202 @@ def format_question(text):
     return re.sub(r'[^a-z0-9 ]+', '', text.lower())
 
 
+def iter_examples(training_data: TrainingData, label_to_i: Dict[Page, int]) -> Iterator[Tuple[str, int]]:
+    for q, ans in zip(training_data[0], training_data[1]):
+        label = label_to_i[ans]
+        for sent in q:
+            yield sent, label
+
+
+def format_examples(examples: List[Tuple[str, int]]) -> List[str]:
+    return [f'{label} |words {format_question(x)}\n' for x, label in examples]
+
+
+def _batches(items: Iterable, batch_size: int) -> Iterator[List]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def format_lines(examples: Iterable[Tuple[str, int]], n_workers: int, batch_size=10000) -> Iterator[str]:
+    """
+    Lazily convert (text, label) pairs to vw input lines, formatting batches in n_workers processes if n_workers > 1
+    """
+    batches = _batches(examples, batch_size)
+    if n_workers > 1:
+        with Pool(n_workers) as pool:
+            for lines in pool.imap(format_examples, batches):
+                yield from lines
+    else:
+        for batch in batches:
+            yield from format_examples(batch)
+
+
+def external_shuffle(lines: Iterable[str], buffer_size: int, temp_dir: str, rng: random.Random) -> Iterator[str]:
+    """
+    Shuffle lines while holding at most buffer_size of them in memory. Lines are buffered and shuffled in chunks which
+    are spilled to temporary files, then the chunks are merged by drawing each line from a chunk with probability
+    proportional to the lines it has left, which produces a uniformly random permutation.
+
+    :param lines: newline terminated lines
+    :param buffer_size: maximum number of lines held in memory
+    :param temp_dir: directory for spilled chunks
+    :param rng: random number generator
+    """
+    chunk_paths = []
+    chunk_sizes = []
+    buffer = []
+
+    def spill():
+        rng.shuffle(buffer)
+        with tempfile.NamedTemporaryFile('w', delete=False, dir=temp_dir, suffix='.shuffle') as f:
+            f.writelines(buffer)
+            chunk_paths.append(f.name)
+        chunk_sizes.append(len(buffer))
+        buffer.clear()
+
+    try:
+        for line in lines:
+            buffer.append(line)
+            if len(buffer) >= buffer_size:
+                spill()
+
+        if len(chunk_paths) == 0:
+            rng.shuffle(buffer)
+            yield from buffer
+            return
+
+        if len(buffer) > 0:
+            spill()
+        log.info(f'Merging {len(chunk_paths)} shuffled chunks of at most {buffer_size} lines')
+        handles = [open(path) for path in chunk_paths]
+        try:
+            remaining = list(chunk_sizes)
+            total = sum(remaining)
+            while total > 0:
+                r = rng.randrange(total)
+                i = 0
+                while r >= remaining[i]:
+                    r -= remaining[i]
+                    i += 1
+                yield handles[i].readline()
+                remaining[i] -= 1
+                total -= 1
+        finally:
+            for h in handles:
+                h.close()
+    finally:
+        for path in chunk_paths:
+            os.remove(path)
+
+
+def find_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+class VWDaemon:
+    def __init__(self, model_file: str, probabilities: bool, startup_timeout: float = 120):
+        """
+        Long running vw process serving predictions for a model over a local socket so that each guess call does not
+        pay for starting vw and loading the model. The process is started lazily on the first prediction and stopped
+        by close or at interpreter exit.
+
+        :param model_file: vw model to load
+        :param probabilities: return the probability of every class instead of only the predicted label
+        :param startup_timeout: seconds to wait for vw to load the model and accept connections
+        """
+        self.model_file = model_file
+        self.probabilities = probabilities
+        self.startup_timeout = startup_timeout
+        self.port = None
+        self.process = None
+        self.connection = None
+        self._reader = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.port = find_free_port()
+        command = [
+            'vw', '-t', '-i', self.model_file, '--quiet',
+            '--daemon', '--foreground', '--num_children', '1', '--port', str(self.port)
+        ]
+        if self.probabilities:
+            command.append('--probabilities')
+        log.info(f'Starting vw daemon: {" ".join(command)}')
+        self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+        self._pid = os.getpid()
+        deadline = time.time() + self.startup_timeout
+        while True:
+            if self.process.poll() is not None:
+                raise ValueError(f'vw daemon exited with code {self.process.returncode}')
+            try:
+                self.connection = socket.create_connection(('localhost', self.port))
+                break
+            except ConnectionRefusedError:
+                if time.time() > deadline:
+                    self.close()
+                    raise TimeoutError(f'vw daemon did not accept connections within {self.startup_timeout}s')
+                time.sleep(.1)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = self.connection.makefile('r', encoding='utf-8')
+        atexit.register(self.close)
+
+    def predict(self, examples: List[str]) -> List[str]:
+        """
+        Send examples in vw input format, one per element without trailing newlines, and return the raw prediction
+        line for each
+        """
+        if len(examples) == 0:
+            return []
+        with self._lock:
+            # A forked process must not share the parent's connection
+            if self.connection is None or self._pid != os.getpid():
+                self.start()
+            payload = ''.join(e + '\n' for e in examples).encode('utf-8')
+            # Writing from a separate thread lets vw stream predictions back while later examples are still being
+            # sent, otherwise a large batch deadlocks once both socket buffers are full
+            writer = threading.Thread(target=self.connection.sendall, args=(payload,))
+            writer.start()
+            predictions = []
+            for _ in examples:
+                line = self._reader.readline()
+                if line == '':
+                    writer.join()
+                    self._close()
+                    raise ValueError('vw daemon closed the connection')
+                predictions.append(line)
+            writer.join()
+            return predictions
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if self.process is not None and self._pid == os.getpid():
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+
+
 class VWGuesser(AbstractGuesser):
     def __init__(self, config_num):
         super().__init__(config_num)
@@ -26,6 +232,7 @@ class VWGuesser(AbstractGuesser):
         self.i_to_label = None
         self.max_label = None
         self.model_file = None
+        self.daemon: Optional[VWDaemon] = None
         if self.config_num is not None:
             guesser_conf = conf['guessers']['qanta.guesser.vw.VWGuesser'][self.config_num]
             self.multiclass_one_against_all = guesser_conf['multiclass_one_against_all']
@@ -39,6 +246,11 @@ class VWGuesser(AbstractGuesser):
             self.ngrams = guesser_conf['ngrams']
             self.skips = guesser_conf['skips']
             self.random_seed = guesser_conf['random_seed']
+            self.shuffle_buffer_size = guesser_conf['shuffle_buffer_size']
+            self.format_workers = guesser_conf['format_workers']
+            self.pipe_training_data = guesser_conf['pipe_training_data']
+            self.use_daemon = guesser_conf['use_daemon']
+            self.daemon_batch_size = guesser_conf['daemon_batch_size']
             if not (self.multiclass_one_against_all != self.multiclass_online_trees):
                 raise ValueError('The options multiclass_one_against_all and multiclass_online_trees are XOR')
 
@@ -110,50 +322,76 @@ class VWGuesser(AbstractGuesser):
         guesser.random_seed = data['random_seed']
         return guesser
 
+    @property
+    def probabilities(self):
+        # vw only computes class probabilities for one against all with logistic loss
+        return self.multiclass_one_against_all
+
     def guess(self,
               questions: List[QuestionText],
               max_n_guesses: Optional[int]) -> List[List[Tuple[Page, float]]]:
+        examples = [f'1 |words {format_question(q)}' for q in questions]
+        if self.use_daemon:
+            if self.daemon is None:
+                self.daemon = VWDaemon(self.model_file, self.probabilities)
+            lines = []
+            for i in range(0, len(examples), self.daemon_batch_size):
+                lines.extend(self.daemon.predict(examples[i:i + self.daemon_batch_size]))
+        else:
+            lines = self._predict_file(examples)
+        return [self._parse_prediction(line, max_n_guesses) for line in lines]
+
+    def _predict_file(self, examples: List[str]) -> List[str]:
         temp_dir = get_tmp_dir()
         with tempfile.NamedTemporaryFile('w', delete=False, dir=temp_dir) as f:
             file_name = f.name
-            for q in questions:
-                features = format_question(q)
-                f.write(f'1 |words {features}\n')
-        shell(f'vw -t -i {self.model_file} -p {file_name}_preds -d {file_name}')
-        predictions = []
+            for e in examples:
+                f.write(e + '\n')
+        probabilities_flag = '--probabilities' if self.probabilities else ''
+        shell(f'vw -t -i {self.model_file} {probabilities_flag} -p {file_name}_preds -d {file_name}')
         with open(f'{file_name}_preds') as f:
-            for line in f:
-                label = int(line)
-                predictions.append([(self.i_to_label[label], 0)])
-        shell(f'rm -f {file_name}.preds {file_name}')
-        return predictions
+            lines = f.readlines()
+        shell(f'rm -f {file_name}_preds {file_name}')
+        return lines
+
+    def _parse_prediction(self, line: str, max_n_guesses: Optional[int]) -> List[Tuple[Page, float]]:
+        if not self.probabilities:
+            return [(self.i_to_label[int(float(line.split()[0]))], 0)]
+
+        # Parse every label:prob token of the line at once into a (n_classes, 2) array
+        predictions = np.array(line.replace(':', ' ').split(), dtype=np.float64).reshape(-1, 2)
+        labels = predictions[:, 0].astype(np.int64)
+        probs = predictions[:, 1]
+        n_classes = len(probs)
+        k = n_classes if max_n_guesses is None else min(max_n_guesses, n_classes)
+        if k < n_classes:
+            top = np.argpartition(-probs, k - 1)[:k]
+        else:
+            top = np.arange(n_classes)
+        top = top[np.argsort(-probs[top], kind='mergesort')]
+        return [(self.i_to_label[label], prob) for label, prob in zip(labels[top].tolist(), probs[top].tolist())]
+
+    def close(self):
+        if self.daemon is not None:
+            self.daemon.close()
+            self.daemon = None
 
     def train(self, training_data: TrainingData) -> None:
         log.info(f'Config:\n{pformat(self.parameters())}')
-        questions = training_data[0]
         answers = training_data[1]
 
-        x_data = []
-        y_data = []
-        for q, ans in zip(questions, answers):
-            for sent in q:
-                x_data.append(sent)
-                y_data.append(ans)
-
         label_set = set(answers)
         self.label_to_i = {label: i for i, label in enumerate(label_set, 1)}
         self.i_to_label = {i: label for label, i in self.label_to_i.items()}
         self.max_label = len(self.label_to_i)
 
         temp_dir = get_tmp_dir()
-        with tempfile.NamedTemporaryFile('w', delete=False, dir=temp_dir) as f:
-            file_name = f.name
-            zipped = list(zip(x_data, y_data))
-            random.shuffle(zipped)
-            for x, y in zipped:
-                features = format_question(x)
-                label = self.label_to_i[y]
-                f.write('{label} |words {features}\n'.format(label=label, features=features))
+        rng = random.Random(self.random_seed)
+        lines = external_shuffle(
+            format_lines(iter_examples(training_data, self.label_to_i), self.format_workers),
+            self.shuffle_buffer_size, temp_dir, rng
+        )
+        file_name = get_tmp_filename(dir=temp_dir)
 
         if self.multiclass_online_trees:
             multiclass_flag = '--log_multi'
@@ -168,10 +406,9 @@ class VWGuesser(AbstractGuesser):
             '-k',
             f'{multiclass_flag}',
             f'{self.max_label}',
-            f'-d {file_name}',
             f'-f {self.model_file}.vw',
             '--loss_function logistic',
-            '-c',
+            f'--cache_file {file_name}.cache',
             f'--passes {self.passes}',
             f'-b {self.bits}',
             f'-l {self.learning_rate}',
@@ -191,10 +428,35 @@ class VWGuesser(AbstractGuesser):
         if self.l2 != 0:
             options.append(f'--l2 {self.l2}')
 
-        command = ' '.join(options)
-        log.info(f'Running:\n{command}')
+        if self.probabilities:
+            options.append('--probabilities')
 
         try:
-            shell(command)
+            if self.pipe_training_data:
+                command = ' '.join(options)
+                log.info(f'Running with training data on stdin:\n{command}')
+                process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, universal_newlines=True)
+                try:
+                    process.stdin.writelines(lines)
+                    process.stdin.close()
+                except BrokenPipeError:
+                    # vw exited before reading all of its input, the exit code checked below says why
+                    log.warning('vw stopped reading training data before all of it was written')
+                    with contextlib.suppress(BrokenPipeError):
+                        process.stdin.close()
+                except BaseException:
+                    process.kill()
+                    process.wait()
+                    raise
+                return_code = process.wait()
+                if return_code != 0:
+                    raise subprocess.CalledProcessError(return_code, command)
+            else:
+                with open(file_name, 'w') as f:
+                    f.writelines(lines)
+                options.append(f'-d {file_name}')
+                command = ' '.join(options)
+                log.info(f'Running:\n{command}')
+                shell(command)
         finally:
             shell(f'rm -f {file_name} {file_name}.cache')
@@ -1,6 +1,7 @@
 import pickle
 import os
 import time
+from multiprocessing import Pool
 
 import luigi
 from luigi import LocalTarget, Task, WrapperTask
@@ -9,12 +10,40 @@ from qanta.config import conf
 from qanta.util import constants as c
 from qanta.util.io import shell
 from qanta.guesser.abstract import AbstractGuesser, get_class
+from qanta.guesser.guess_store import write_guesses, merge_guesses
 from qanta.pipeline.preprocess import DownloadData
 from qanta import qlogging
 
 log = qlogging.get(__name__)
 
 
+GUESS_OUTPUT_TYPES = ['char', 'full', 'first']
+
+
+def shard_guess_path(directory: str, fold: str, output_type: str, shard_index: int) -> str:
+    return AbstractGuesser.guess_path(directory, fold, output_type) + f'.shard{shard_index}'
+
+
+def generate_guess_shard(guesser_module: str, guesser_class: str, guesser_directory: str,
+                         n_guesses: int, fold: str, char_skip: int, shard_index: int, n_shards: int):
+    """
+    Worker for GenerateGuesses which loads the guesser once and writes guesses of every output type for the
+    questions in one shard of the fold
+    """
+    guesser_class = get_class(guesser_module, guesser_class)
+    guesser_instance = guesser_class.load(guesser_directory)  # type: AbstractGuesser
+    for output_type in GUESS_OUTPUT_TYPES:
+        start_time = time.time()
+        guess_df = guesser_instance.generate_guesses(
+            n_guesses, [fold], char_skip=char_skip,
+            full_question=output_type == 'full', first_sentence=output_type == 'first',
+            shard=(shard_index, n_shards)
+        )
+        write_guesses(shard_guess_path(guesser_directory, fold, output_type, shard_index), guess_df, fold)
+        elapsed = time.time() - start_time
+        log.info(f'Shard {shard_index}/{n_shards} of {fold} {output_type} guesses took {elapsed}s')
+
+
 class EmptyTask(luigi.Task):
     def complete(self):
         return True
@@ -105,50 +134,65 @@ class GenerateGuesses(Task):
         guesser_directory = AbstractGuesser.output_path(
             self.guesser_module, self.guesser_class, self.config_num, ''
         )
-        guesser_instance = guesser_class.load(guesser_directory)  # type: AbstractGuesser
 
         if self.fold in {c.GUESSER_TRAIN_FOLD, c.GUESSER_DEV_FOLD}:
             char_skip = conf['guesser_char_skip']
         else:
             char_skip = conf['buzzer_char_skip']
 
-        log.info(f'Generating and saving guesses for {self.fold} fold with char_skip={char_skip}...')
-        start_time = time.time()
-        guess_df = guesser_instance.generate_guesses(self.n_guesses, [self.fold], char_skip=char_skip)
-        end_time = time.time()
-        elapsed = end_time - start_time
-        log.info(f'Guessing on {self.fold} fold took {elapsed}s, saving guesses...')
-        guesser_class.save_guesses(guess_df, guesser_directory, [self.fold], 'char')
-        log.info('Done saving guesses')
+        n_workers = conf['guess_generation_workers']
+        if n_workers > 1:
+            self.run_sharded(guesser_directory, char_skip, n_workers)
+            return
 
-        log.info(f'Generating and saving guesses for {self.fold} fold with full question...')
-        start_time = time.time()
-        guess_df = guesser_instance.generate_guesses(self.n_guesses, [self.fold], full_question=True)
-        end_time = time.time()
-        elapsed = end_time - start_time
-        log.info(f'Guessing on {self.fold} fold took {elapsed}s, saving guesses...')
-        guesser_class.save_guesses(guess_df, guesser_directory, [self.fold], 'full')
-        log.info('Done saving guesses')
+        guesser_instance = guesser_class.load(guesser_directory)  # type: AbstractGuesser
 
-        log.info(f'Generating and saving guesses for {self.fold} fold with first sentence')
+        for output_type in GUESS_OUTPUT_TYPES:
+            log.info(f'Generating and saving {output_type} guesses for {self.fold} fold with char_skip={char_skip}...')
+            start_time = time.time()
+            guess_df = guesser_instance.generate_guesses(
+                self.n_guesses, [self.fold], char_skip=char_skip,
+                full_question=output_type == 'full', first_sentence=output_type == 'first'
+            )
+            elapsed = time.time() - start_time
+            log.info(f'Guessing on {self.fold} fold took {elapsed}s, saving guesses...')
+            guesser_class.save_guesses(guess_df, guesser_directory, [self.fold], output_type)
+            log.info('Done saving guesses')
+
+    def run_sharded(self, guesser_directory: str, char_skip: int, n_workers: int):
+        log.info(
+            f'Generating and saving guesses for {self.fold} fold with char_skip={char_skip} '
+            f'sharded over {n_workers} workers...'
+        )
         start_time = time.time()
-        guess_df = guesser_instance.generate_guesses(self.n_guesses, [self.fold], first_sentence=True)
-        end_time = time.time()
-        elapsed = end_time - start_time
-        log.info(f'Guessing on {self.fold} fold took {elapsed}s, saving guesses...')
-        guesser_class.save_guesses(guess_df, guesser_directory, [self.fold], 'first')
+        shard_args = [
+            (self.guesser_module, self.guesser_class, guesser_directory,
+             self.n_guesses, self.fold, char_skip, shard_index, n_workers)
+            for shard_index in range(n_workers)
+        ]
+        with Pool(n_workers) as pool:
+            pool.starmap(generate_guess_shard, shard_args)
+        elapsed = time.time() - start_time
+        log.info(f'Guessing on {self.fold} fold took {elapsed}s, merging shards...')
+
+        for output_type in GUESS_OUTPUT_TYPES:
+            shard_paths = [
+                shard_guess_path(guesser_directory, self.fold, output_type, shard_index)
+                for shard_index in range(n_workers)
+            ]
+            merge_guesses(shard_paths, AbstractGuesser.guess_path(guesser_directory, self.fold, output_type))
+            for path in shard_paths:
+                os.remove(path)
         log.info('Done saving guesses')
 
     def output(self):
-        files = [
-            f'guesses_char_{self.fold}.pickle',
-            f'guesses_full_{self.fold}.pickle',
-            f'guesses_first_{self.fold}.pickle'
-        ]
+        guesser_directory = AbstractGuesser.output_path(
+            self.guesser_module, self.guesser_class, self.config_num, ''
+        )
         return [
-            LocalTarget(AbstractGuesser.output_path(
-                self.guesser_module, self.guesser_class, self.config_num, f
-        )) for f in files]
+            LocalTarget(AbstractGuesser.guess_path(guesser_directory, self.fold, output_type))
+            for output_type in GUESS_OUTPUT_TYPES
+        ]
 
 
 class GenerateAllGuesses(WrapperTask):
@@ -250,23 +294,14 @@ class GuesserPerformance(Task):
         param_path = AbstractGuesser.output_path(
             self.guesser_module, self.guesser_class, self.config_num, f'guesser_params.pickle'
         )
-        guesses_files = []
         if os.path.exists(c.QANTA_EXPO_DATASET_PATH):
             folds = [c.GUESSER_DEV_FOLD, c.GUESSER_TEST_FOLD, c.EXPO_FOLD]
         else:
             folds = [c.GUESSER_DEV_FOLD, c.GUESSER_TEST_FOLD]
 
-        for f in folds:
-            guesses_files.extend([
-                f'guesses_char_{f}.pickle',
-                f'guesses_full_{f}.pickle',
-                f'guesses_first_{f}.pickle'
-            ])
-
         guesses_paths = [
-            AbstractGuesser.output_path(
-                self.guesser_module, self.guesser_class, self.config_num, f)
-            for f in guesses_files
+            AbstractGuesser.guess_path(guesser_directory, f, output_type)
+            for f in folds for output_type in GUESS_OUTPUT_TYPES
         ]
 
         log.info(f'Running: "cp {param_path} {reporting_directory}"')
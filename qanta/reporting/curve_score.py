@@ -1,13 +1,11 @@
 import os
+import json
 import pickle
 import numpy as np
 import pandas as pd
 import matplotlib
 matplotlib.use('agg')
 from plotnine import ggplot, aes, geom_point, stat_function, labs
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import PolynomialFeatures
-from sklearn.linear_model import LinearRegression
 from qanta.datasets.protobowl import load_protobowl
 
 report_dir = 'output/reporting'
@@ -15,66 +13,95 @@ if not os.path.isdir(report_dir):
     os.mkdir(report_dir)
 
 
+DEGREE = 3
+
+
+def curve_points(relative_positions, results):
+    '''points of the curve the score is fit to. Records are sorted by
+        position and grouped in buckets of 0.001, each bucket gets the
+        fraction of all records that are correct and come before the last
+        record in the bucket, subtracted from one
+
+    Args:
+        relative_positions: relative buzz position of each record
+        results: whether each record is correct
+    Returns:
+        bucket positions and curve values as arrays
+    '''
+    relative_positions = np.asarray(relative_positions, dtype=np.float64)
+    results = np.asarray(results, dtype=np.int64)
+    order = np.argsort(relative_positions, kind='stable')
+    positions = relative_positions[order]
+    correct_before = np.cumsum(results[order]) - results[order]
+    buckets = (positions * 1000).astype(np.int64)
+    last_in_bucket = np.flatnonzero(np.r_[buckets[1:] != buckets[:-1], True])
+    X = buckets[last_in_bucket] / 1000
+    y = 1 - correct_before[last_in_bucket] / len(positions)
+    return X, y
+
+
 class CurveScore:
 
     def __init__(self):
-        ckp_dir = os.path.join(report_dir, 'curve_pipeline.pkl')
+        ckp_dir = os.path.join(report_dir, 'curve_coefficients.json')
+        legacy_ckp_dir = os.path.join(report_dir, 'curve_pipeline.pkl')
         if os.path.isfile(ckp_dir):
-            print('loading pipeline')
-            with open(ckp_dir, 'rb') as f:
-                self.pipeline = pickle.load(f)
+            print('loading curve')
+            with open(ckp_dir) as f:
+                self.coefficients = np.asarray(json.load(f)['coefficients'])
         else:
-            print('fitting pipeline')
-            self.pipeline = self.fit_curve()
-            with open(ckp_dir, 'wb') as f:
-                pickle.dump(self.pipeline, f)
+            if os.path.isfile(legacy_ckp_dir):
+                print('loading pipeline')
+                with open(legacy_ckp_dir, 'rb') as f:
+                    self.coefficients = self.pipeline_coefficients(pickle.load(f))
+            else:
+                print('fitting curve')
+                self.coefficients = self.fit_curve()
+            with open(ckp_dir, 'w') as f:
+                json.dump({'coefficients': self.coefficients.tolist()}, f)
+
+    @staticmethod
+    def pipeline_coefficients(pipeline):
+        '''coefficients of the sklearn polynomial regression pipeline that
+            was previously used to represent the curve'''
+        linear_regression = pipeline.steps[1][1]
+        return np.r_[linear_regression.intercept_, linear_regression.coef_]
 
     def get_weight(self, x):
-        return self.pipeline.predict(np.asarray([[x]]))[0]
+        '''weight of buzzing at relative position x, which can be a number or
+            an array of positions
+
+        The weight is sum(coefficients[i] * x ** i), evaluated with Horner's
+        method.
+        '''
+        return np.polynomial.polynomial.polyval(x, self.coefficients)
+
+    def fit_curve(self, df=None):
+        '''fit a degree 3 polynomial to curve_points of the protobowl
+            records in df, by default all of them
 
-    def fit_curve(self):
-        df, questions = load_protobowl()
+        Returns:
+            coefficients in increasing order of degree
+        '''
+        if df is None:
+            df, questions = load_protobowl()
         # convert prompt to false
-        df.result = df.result.apply(lambda x: x is True)
-
-        xy = list(zip(df.relative_position.tolist(), df.result.tolist()))
-        xy = sorted(xy, key=lambda x: x[0])
-        ratios = dict()
-        cnt = 0
-        for x, y in xy:
-            x = int(x*1000)
-            ratios[x] = cnt
-            cnt += y
-        ratios = sorted(ratios.items(), key=lambda x: x[0])
-        ratios = [(x / 1000, y) for x, y in ratios]
-
-        ttl_correct = df.result.tolist().count(True)
-        ttl_correct = len(xy)
-        curve = [(x, 1 - y / ttl_correct) for x, y in ratios]
-        X, y = list(map(list, zip(*curve)))
-
-        X = np.asarray(X)
-        y = np.asarray(y)
-        degree = 3
-        polynomial_features = PolynomialFeatures(degree=degree, include_bias=False)
-        linear_regression = LinearRegression()
-        pipeline = Pipeline([("polynomial_features", polynomial_features),
-                             ("linear_regression", linear_regression)])
-        pipeline.fit(X[:, np.newaxis], y)
-        print(pipeline.steps[1][1].coef_)
-
-        def get_weight(x):
-            return pipeline.predict(np.asarray([[x]]))[0]
+        results = np.fromiter((r is True for r in df.result.values), dtype=np.bool_, count=len(df))
+        X, y = curve_points(df.relative_position.values, results)
+        coefficients = np.polynomial.polynomial.polyfit(X, y, DEGREE)
+        print(coefficients)
 
         ddf = pd.DataFrame({'x': X, 'y': y})
         p0 = ggplot(ddf, aes(x='x', y='y')) \
             + geom_point(size=0.3, color='blue', alpha=0.5, shape='+') \
-            + stat_function(fun=get_weight, color='red', size=2, alpha=0.5) \
+            + stat_function(
+                fun=lambda x: np.polynomial.polynomial.polyval(x, coefficients),
+                color='red', size=2, alpha=0.5) \
             + labs(x='Position', y='Weight')
         p0.save('output/reporting/curve_score.pdf')
         p0.draw()
 
-        return pipeline
+        return coefficients
 
 
 if __name__ == '__main__':
@@ -1,8 +1,8 @@
 import os
 import pickle
 import numpy as np
-from multiprocessing import Pool
-from functools import partial
+import pandas as pd
+from multiprocessing import get_context
 
 from qanta.util.constants import BUZZER_DEV_FOLD
 from qanta.datasets.protobowl import load_protobowl
@@ -18,64 +18,166 @@ if not os.path.isdir(report_dir):
 curve_score = CurveScore()
 
 
-def _protobowl_scores(q, labels, buzzes, word_positions, records_grouped):
-    '''score against protobowl players with system and oracle buzzer'''
-    if q.proto_id not in records_grouped.groups:
-        return None, None
-
-    rel_pos_buzz = 1
-    rel_pos_oracle = 1
-    buzz_result = False
-    if True in buzzes:
-        idx = buzzes.index(True)
-        rel_pos_buzz = word_positions[idx] / word_positions[-1]
-        buzz_result = labels[idx]
-    if True in labels:
-        idx = labels.index(True)
-        rel_pos_oracle = word_positions[idx] / word_positions[-1]
-
-    score_buzz = 0
-    score_oracle = 0
-    records = records_grouped.get_group(q.proto_id)
-    for r in records.itertuples():
-        if r.relative_position <= rel_pos_buzz:
-            score_buzz += -10 if r.result else 5 + 10 * labels[-1]
+def _first_true(mask, offsets):
+    '''index of the first True of mask within each segment
+        mask[offsets[i]:offsets[i + 1]], -1 for segments without one.
+        Segments must be non-empty.
+    '''
+    index = np.where(mask, np.arange(len(mask)), len(mask))
+    first = np.minimum.reduceat(index, offsets[:-1])
+    found = first < offsets[1:]
+    return np.where(found, first - offsets[:-1], -1)
+
+
+class EndToEndEvaluator:
+    '''end to end evaluation of a buzzer against protobowl players and
+        with the curve score, for all questions of a fold at once
+
+    Per position labels, buzzer scores, and positions of all questions are
+    stored as flat arrays with question offsets, and the protobowl records
+    of each question as a slice of records sorted by proto_id, so every
+    metric is computed with array operations over the whole fold.
+    '''
+
+    def __init__(self, questions, guesses, buzzes, records):
+        '''
+        Args:
+            questions: questions to evaluate, those without both guesses and
+                buzzes are skipped
+            guesses: dictionary from qanta_id to the output of read_data
+            buzzes: dictionary from qanta_id to (positions, buzzer scores)
+                where buzzer scores are [p_wait, p_buzz] per position
+            records: protobowl records with qid, relative_position, and
+                result columns
+        '''
+        questions = [q for q in questions
+                     if q.qanta_id in guesses and q.qanta_id in buzzes]
+        self.qanta_ids = np.array([q.qanta_id for q in questions])
+        n_questions = len(questions)
+
+        labels, positions, buzz_scores = [], [], []
+        for q in questions:
+            qid, vectors, q_labels, word_positions = guesses[q.qanta_id]
+            _, q_buzz_scores = buzzes[q.qanta_id]
+            labels.append(np.asarray(q_labels, dtype=np.bool_))
+            positions.append(np.asarray(word_positions, dtype=np.float64))
+            buzz_scores.append(np.asarray(q_buzz_scores, dtype=np.float64).reshape(-1, 2))
+        lengths = np.array([len(x) for x in labels], dtype=np.int64)
+        self.offsets = np.zeros(n_questions + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.labels = np.concatenate(labels) if n_questions > 0 else np.zeros(0, dtype=np.bool_)
+        self.buzz_scores = np.concatenate(buzz_scores) if n_questions > 0 else np.zeros((0, 2))
+        positions = np.concatenate(positions) if n_questions > 0 else np.zeros(0)
+        question_of_position = np.repeat(np.arange(n_questions), lengths)
+        # positions relative to the last position of their question
+        self.relative_positions = positions / positions[self.offsets[1:] - 1][question_of_position]
+        self.last_labels = self.labels[self.offsets[1:] - 1].astype(np.int64)
+
+        # records sorted by proto_id, each question gets the slice of its proto_id
+        record_proto_ids = records.qid.values
+        order = np.argsort(record_proto_ids, kind='stable')
+        unique_proto_ids, unique_starts, unique_counts = np.unique(
+            record_proto_ids[order], return_index=True, return_counts=True)
+        proto_slices = dict(zip(unique_proto_ids, zip(unique_starts, unique_counts)))
+        # questions without protobowl records get an empty slice
+        starts, self.record_counts = np.array(
+            [proto_slices.get(q.proto_id, (0, 0)) for q in questions], dtype=np.int64).reshape(-1, 2).T
+        total = self.record_counts.sum()
+        self.record_question = np.repeat(np.arange(n_questions), self.record_counts)
+        record_offsets = np.zeros(n_questions, dtype=np.int64)
+        np.cumsum(self.record_counts[:-1], out=record_offsets[1:])
+        record_index = order[np.arange(total) - np.repeat(record_offsets - starts, self.record_counts)]
+        self.record_positions = records.relative_position.values[record_index].astype(np.float64)
+        self.record_results = records.result.values[record_index].astype(np.bool_)
+
+        # the oracle does not depend on the buzzer so it is only computed once
+        oracle_index = _first_true(self.labels, self.offsets)
+        self.has_oracle = oracle_index >= 0
+        self.oracle_positions = np.where(
+            self.has_oracle, self.relative_positions[self.offsets[:-1] + np.maximum(oracle_index, 0)], 1)
+
+    def buzz_index(self, threshold=None):
+        '''index of the first buzz within each question, -1 if the buzzer
+            never buzzes. By default the buzzer buzzes when p_buzz > p_wait,
+            otherwise when p_buzz > threshold.
+        '''
+        if threshold is None:
+            mask = self.buzz_scores[:, 1] > self.buzz_scores[:, 0]
         else:
-            score_buzz += 10 if buzz_result else -15
-
-        if r.relative_position <= rel_pos_oracle:
-            score_oracle += -10 if r.result else 5 + 10 * labels[-1]
+            mask = self.buzz_scores[:, 1] > threshold
+        return _first_true(mask, self.offsets)
+
+    def _protobowl_scores(self, buzz_positions, buzz_correct):
+        '''average score of a player buzzing at buzz_positions against the
+            protobowl records of each question, nan without records'''
+        q = self.record_question
+        before = self.record_positions <= buzz_positions[q]
+        # the player buzzes first: an opponent who was correct gets 10 points
+        # from us, otherwise we get 5, or 15 if our final answer is correct
+        early = np.where(self.record_results, -10, 5 + 10 * self.last_labels[q])
+        late = np.where(buzz_correct[q], 10, -15)
+        totals = np.bincount(q, weights=np.where(before, early, late), minlength=len(self.qanta_ids))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.record_counts > 0, totals / self.record_counts, np.nan)
+
+    def scores(self, threshold=None):
+        '''protobowl and curve scores of the buzzer and the oracle for each
+            question, nan where a score is undefined
+
+        Returns:
+            dictionary of arrays protobowl_buzz, protobowl_oracle, curve_buzz,
+            and curve_oracle
+        '''
+        buzz_index = self.buzz_index(threshold)
+        has_buzz = buzz_index >= 0
+        buzz_rows = self.offsets[:-1] + np.maximum(buzz_index, 0)
+        buzz_positions = np.where(has_buzz, self.relative_positions[buzz_rows], 1)
+        buzz_correct = has_buzz & self.labels[buzz_rows]
+        return {
+            'protobowl_buzz': self._protobowl_scores(buzz_positions, buzz_correct),
+            # records after the oracle position always count as a correct oracle buzz, also for questions where the
+            # guesser is never correct and the oracle position is the end of the question
+            'protobowl_oracle': self._protobowl_scores(
+                self.oracle_positions, np.ones(len(self.qanta_ids), dtype=np.bool_)),
+            'curve_buzz': np.where(has_buzz, buzz_correct * curve_score.get_weight(buzz_positions), np.nan),
+            'curve_oracle': np.where(self.has_oracle, curve_score.get_weight(self.oracle_positions), np.nan)
+        }
+
+    def summary(self, threshold=None):
+        '''mean of each score over the questions where it is defined'''
+        row = {'threshold': threshold}
+        for name, values in self.scores(threshold).items():
+            defined = values[~np.isnan(values)]
+            row[name] = defined.mean() if len(defined) > 0 else np.nan
+        return row
+
+    def evaluate(self, thresholds, n_workers=1):
+        '''summarize the scores of the buzzer at each threshold
+
+        With n_workers > 1 thresholds are split across forked processes that
+        share this evaluator's arrays with the parent instead of receiving a
+        pickled copy for every task.
+        '''
+        thresholds = list(thresholds)
+        if n_workers > 1 and len(thresholds) > 1:
+            global _shared_evaluator
+            _shared_evaluator = self
+            with get_context('fork').Pool(n_workers) as pool:
+                rows = pool.map(_summarize_threshold, thresholds)
+            _shared_evaluator = None
         else:
-            score_oracle += 10
-    return score_buzz / len(records), score_oracle / len(records)
-
-
-def _curve_scores(q, labels, buzzes, word_positions, records_grouped):
-    '''weighted accuracy with system and oracle buzzer'''
-    score_buzz = None
-    score_oracle = None
-    if True in buzzes:
-        idx = buzzes.index(True)
-        rel_pos_buzz = word_positions[idx] / word_positions[-1]
-        weight = curve_score.get_weight(rel_pos_buzz)
-        score_buzz = labels[idx] * weight
-    if True in labels:
-        idx = labels.index(True)
-        rel_pos_oracle = word_positions[idx] / word_positions[-1]
-        weight = curve_score.get_weight(rel_pos_oracle)
-        score_oracle = weight
-    return score_buzz, score_oracle
-
-
-def run_all_metrics(guesses, buzzes, record_groups, metrics, q):
-    word_positions, buzzer_scores = buzzes[q.qanta_id]
-    qid, vectors, labels, word_positions = guesses[q.qanta_id]
-    buzzes = [b > a for a, b in buzzer_scores]
-    scores = [m(q, labels, buzzes, word_positions, record_groups) for m in metrics]
-    return scores
-
-
-def main():
+            rows = [self.summary(t) for t in thresholds]
+        return pd.DataFrame(rows)
+
+
+_shared_evaluator = None
+
+
+def _summarize_threshold(threshold):
+    return _shared_evaluator.summary(threshold)
+
+
+def main(thresholds=None, n_workers=8):
     fold = BUZZER_DEV_FOLD
 
     # load questions
@@ -97,24 +199,16 @@ def main():
     # load protobowl records
     print('loading protobowl records')
     df, _ = load_protobowl()
-    record_groups = df.groupby('qid')
-
-    metrics = [_protobowl_scores, _curve_scores]
-    pool = Pool(8)
-    worker = partial(run_all_metrics, guesses, buzzes, record_groups, metrics)
-    scores = pool.map(worker, questions)
-
-    all_scores = list(map(list, zip(*scores)))
 
-    protobowl_scores = all_scores[0]
-    protobowl_scores = list(map(list, zip(*protobowl_scores)))
-    protobowl_scores = [[x for x in s if x is not None] for s in protobowl_scores]
-    print([np.mean(s) for s in protobowl_scores])
+    evaluator = EndToEndEvaluator(questions, guesses, buzzes, df)
+    row = evaluator.summary()
+    print([row['protobowl_buzz'], row['protobowl_oracle']])
+    print([row['curve_buzz'], row['curve_oracle']])
 
-    curve_scores = all_scores[1]
-    curve_scores = list(map(list, zip(*curve_scores)))
-    curve_scores = [[x for x in s if x is not None] for s in curve_scores]
-    print([np.mean(s) for s in curve_scores])
+    if thresholds is not None:
+        threshold_df = evaluator.evaluate(thresholds, n_workers=n_workers)
+        print(threshold_df)
+        threshold_df.to_csv(os.path.join(report_dir, f'end_to_end_thresholds_{fold}.csv'), index=False)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 import os
 import re
 import json
+import nltk
 import torch
 
 from torchtext.data.dataset import Dataset
@@ -9,7 +10,15 @@ from torchtext.data import Field, RawField, BucketIterator
 from torchtext.vocab import Vocab, pretrained_aliases, Vectors
 from torchtext.utils import download_from_url
 
-from qanta.wikipedia.cached_wikipedia import extract_wiki_sentences
+from qanta import qlogging
+from qanta.config import conf
+from qanta.wikipedia.cached_wikipedia import WikiSentenceCache, wiki_sentences
+from qanta.wikipedia.page_store import open_page_store
+from qanta.torch.tokenization_cache import (
+    TokenizationCache, cacheable_fields, cache_directory, parallel_tokenize
+)
+
+log = qlogging.get(__name__)
 
 DS_VERSION = '2018.04.18'
 
@@ -29,41 +38,68 @@ ftp_patterns = {
     'ftp'
 }
 
-regex_pattern = '|'.join([re.escape(p) for p in ftp_patterns])
+# Longer patterns come first so that they take precedence over their prefixes, and the order is fixed so that
+# tokenization does not depend on the hash seed
+regex_pattern = '|'.join([re.escape(p) for p in sorted(ftp_patterns, key=lambda p: (-len(p), p))])
 regex_pattern += r'|\[.*?\]|\(.*?\)'
+qb_pattern_regex = re.compile(regex_pattern, flags=re.IGNORECASE)
+whitespace_regex = re.compile(r'\s+')
 
 
 def str_split(text):
     return text.split()
 
 
-def create_qb_tokenizer(
-        unigrams=True, bigrams=False, trigrams=False,
-        zero_length_token='zerolengthunk', strip_qb_patterns=True):
-    def tokenizer(text):
-        if strip_qb_patterns:
-            text = re.sub(
-                '\s+', ' ',
-                re.sub(regex_pattern, ' ', text, flags=re.IGNORECASE)
-            ).strip().capitalize()
-        import nltk
+class QBTokenizer:
+    def __init__(self, unigrams=True, bigrams=False, trigrams=False,
+                 zero_length_token='zerolengthunk', strip_qb_patterns=True):
+        """
+        Tokenizer for quiz bowl text which optionally strips patterns like "for 10 points" and produces unigrams,
+        bigrams, and trigrams. This is a class rather than a closure so that it can be sent to worker processes and
+        so that its settings can key the tokenization cache.
+        """
+        self.unigrams = unigrams
+        self.bigrams = bigrams
+        self.trigrams = trigrams
+        self.zero_length_token = zero_length_token
+        self.strip_qb_patterns = strip_qb_patterns
+
+    def settings(self):
+        return {
+            'unigrams': self.unigrams,
+            'bigrams': self.bigrams,
+            'trigrams': self.trigrams,
+            'zero_length_token': self.zero_length_token,
+            'strip_pattern': regex_pattern if self.strip_qb_patterns else None
+        }
+
+    def __call__(self, text):
+        if self.strip_qb_patterns:
+            text = whitespace_regex.sub(' ', qb_pattern_regex.sub(' ', text)).strip().capitalize()
         tokens = nltk.word_tokenize(text)
         if len(tokens) == 0:
-            return [zero_length_token]
+            return [self.zero_length_token]
         else:
             ngrams = []
-            if unigrams:
+            if self.unigrams:
                 ngrams.extend(tokens)
-            if bigrams:
+            if self.bigrams:
                 ngrams.extend([f'{w0}++{w1}' for w0, w1 in nltk.bigrams(tokens)])
-            if trigrams:
+            if self.trigrams:
                 ngrams.extend([f'{w0}++{w1}++{w2}' for w0, w1, w2 in nltk.trigrams(tokens)])
 
             if len(ngrams) == 0:
-                ngrams.append(zero_length_token)
+                ngrams.append(self.zero_length_token)
             return ngrams
 
-    return tokenizer
+
+def create_qb_tokenizer(
+        unigrams=True, bigrams=False, trigrams=False,
+        zero_length_token='zerolengthunk', strip_qb_patterns=True):
+    return QBTokenizer(
+        unigrams=unigrams, bigrams=bigrams, trigrams=trigrams,
+        zero_length_token=zero_length_token, strip_qb_patterns=strip_qb_patterns
+    )
 
 
 class LongField(RawField):
@@ -139,17 +175,27 @@ class QuizBowl(Dataset):
                  text_field, unigram_field, bigram_field, trigram_field,
                  example_mode='sentence',
                  use_wiki=False, n_wiki_sentences=3, replace_title_mentions='',
+                 tokenization_cache=True, n_tokenize_workers=None, n_wiki_workers=None,
                  **kwargs):
-        from unidecode import unidecode
-
+        """
+        :param tokenization_cache: whether to load the tokens of question text from, and save them to, a cache keyed
+        by the settings of the text fields' tokenizers
+        :param n_tokenize_workers: number of processes to tokenize question text with when it is not cached, by
+        default dataset_workers from the qanta config
+        :param n_wiki_workers: number of processes to extract wikipedia sentences with when they are not cached, by
+        default dataset_workers from the qanta config
+        """
+        if n_tokenize_workers is None:
+            n_tokenize_workers = conf['dataset_workers']
+        if n_wiki_workers is None:
+            n_wiki_workers = conf['dataset_workers']
         if use_wiki and 'train' in path:
             base_path = os.path.dirname(path)
             filename = os.path.basename(s3_wiki)
             output_file = os.path.join(base_path, filename)
             if not os.path.exists(output_file):
                 download_from_url(s3_wiki, output_file)
-            with open(output_file) as f:
-                self.wiki_lookup = json.load(f)
+            self.wiki_lookup = open_page_store(output_file)
         else:
             self.wiki_lookup = {}
         self.path = path
@@ -172,39 +218,27 @@ class QuizBowl(Dataset):
             'text': text_dependent_fields
         }
 
-        examples = []
-        answer_set = set()
-        with open(path) as f:
-            for ex in json.load(f)['questions']:
-                if example_mode == 'sentence':
-                    sentences = [ex['text'][start:end] for start, end in ex['tokenizations']]
-                    for i, s in enumerate(sentences):
-                        examples.append(Example.fromdict({
-                            'qanta_id': ex['qanta_id'],
-                            'sent': i,
-                            'text': unidecode(s),
-                            'page': ex['page']
-                        }, example_fields))
-                        answer_set.add(ex['page'])
-                elif example_mode == 'question':
-                    examples.append(Example.fromdict({
-                        'qanta_id': ex['qanta_id'],
-                        'sent': -1,
-                        'text': unidecode(ex['text']),
-                        'page': ex['page']
-                    }, example_fields))
-                    answer_set.add(ex['page'])
-                else:
-                    raise ValueError(
-                        f"Valid modes are 'sentence' and 'question', but '{example_mode}' was given")
+        specs = cacheable_fields(text_dependent_fields)
+        if specs is not None:
+            examples = self._load_tokenized_examples(
+                path, example_mode, specs, qanta_id_field, sent_field, page_field,
+                tokenization_cache, n_tokenize_workers
+            )
+            answer_set = {ex.page for ex in examples}
+        else:
+            examples, answer_set = self._load_examples(path, example_mode, example_fields)
 
         if use_wiki and n_wiki_sentences > 0 and 'train' in path:
+            cache = WikiSentenceCache.for_store(self.wiki_lookup)
+            page_sentences = wiki_sentences(
+                self.wiki_lookup, answer_set, n_wiki_sentences,
+                replace_title_mentions=replace_title_mentions,
+                n_workers=n_wiki_workers, cache=cache
+            )
+            cache.close()
             for page in answer_set:
-                if page in self.wiki_lookup:
-                    sentences = extract_wiki_sentences(
-                        page, self.wiki_lookup[page]['text'], n_wiki_sentences,
-                        replace_title_mentions=replace_title_mentions
-                    )
+                if page in page_sentences:
+                    sentences = page_sentences[page]
                     for i, s in enumerate(sentences):
                         examples.append(Example.fromdict({
                             'qanta_id': -1,
@@ -230,6 +264,91 @@ class QuizBowl(Dataset):
 
         super(QuizBowl, self).__init__(examples, dataset_fields, **kwargs)
 
+    @staticmethod
+    def _read_rows(path, example_mode):
+        qanta_ids, sents, texts, pages = [], [], [], []
+        with open(path) as f:
+            for ex in json.load(f)['questions']:
+                if example_mode == 'sentence':
+                    for i, (start, end) in enumerate(ex['tokenizations']):
+                        qanta_ids.append(ex['qanta_id'])
+                        sents.append(i)
+                        texts.append(ex['text'][start:end])
+                        pages.append(ex['page'])
+                elif example_mode == 'question':
+                    qanta_ids.append(ex['qanta_id'])
+                    sents.append(-1)
+                    texts.append(ex['text'])
+                    pages.append(ex['page'])
+                else:
+                    raise ValueError(
+                        f"Valid modes are 'sentence' and 'question', but '{example_mode}' was given")
+        return qanta_ids, sents, texts, pages
+
+    @classmethod
+    def _load_tokenized_examples(cls, path, example_mode, specs, qanta_id_field, sent_field, page_field,
+                                 use_cache, n_workers):
+        """
+        Create examples from text that is tokenized in parallel, or read from the tokenization cache. Examples are
+        created directly from the tokens since running the fields' preprocess would tokenize again.
+        """
+        cache = TokenizationCache(cache_directory(path, example_mode, specs)) if use_cache else None
+        if cache is not None and cache.exists():
+            log.info(f'Loading tokenized {path} from {cache.directory}')
+            qanta_ids, sents, pages, tokens = cache.load()
+        else:
+            log.info(f'Tokenizing {path} with {n_workers} workers')
+            qanta_ids, sents, texts, pages = cls._read_rows(path, example_mode)
+            tokens = parallel_tokenize(texts, specs, n_workers)
+            if cache is not None:
+                try:
+                    os.makedirs(os.path.dirname(cache.directory), exist_ok=True)
+                    cache.save(qanta_ids, sents, pages, tokens)
+                except OSError:
+                    log.warning(f'Could not write tokenization cache {cache.directory}')
+
+        field_names = [name for name, _, _ in specs]
+        examples = []
+        for i in range(len(qanta_ids)):
+            ex = Example()
+            ex.qanta_id = qanta_id_field.preprocess(qanta_ids[i])
+            ex.sent = sent_field.preprocess(sents[i])
+            ex.page = page_field.preprocess(pages[i])
+            for name in field_names:
+                setattr(ex, name, tokens[name][i])
+            examples.append(ex)
+        return examples
+
+    @staticmethod
+    def _load_examples(path, example_mode, example_fields):
+        from unidecode import unidecode
+        examples = []
+        answer_set = set()
+        with open(path) as f:
+            for ex in json.load(f)['questions']:
+                if example_mode == 'sentence':
+                    sentences = [ex['text'][start:end] for start, end in ex['tokenizations']]
+                    for i, s in enumerate(sentences):
+                        examples.append(Example.fromdict({
+                            'qanta_id': ex['qanta_id'],
+                            'sent': i,
+                            'text': unidecode(s),
+                            'page': ex['page']
+                        }, example_fields))
+                        answer_set.add(ex['page'])
+                elif example_mode == 'question':
+                    examples.append(Example.fromdict({
+                        'qanta_id': ex['qanta_id'],
+                        'sent': -1,
+                        'text': unidecode(ex['text']),
+                        'page': ex['page']
+                    }, example_fields))
+                    answer_set.add(ex['page'])
+                else:
+                    raise ValueError(
+                        f"Valid modes are 'sentence' and 'question', but '{example_mode}' was given")
+        return examples, answer_set
+
     @classmethod
     def splits(cls, example_mode='sentence',
                use_wiki=False, n_wiki_sentences=5, replace_title_mentions='',
@@ -266,6 +385,7 @@ class QuizBowl(Dataset):
               combined_max_vocab_size=None,
               unigram_max_vocab_size=None, bigram_max_vocab_size=None, trigram_max_vocab_size=None,
               sort_within_batch=None,
+              tokenization_cache=True, n_tokenize_workers=None,
               **kwargs):
         QANTA_ID = LongField()
         SENT = LongField()
@@ -281,6 +401,7 @@ class QuizBowl(Dataset):
                 qanta_id_field=QANTA_ID, sent_field=SENT, text_field=TEXT, page_field=PAGE,
                 root=root, example_mode=example_mode,
                 use_wiki=use_wiki, n_wiki_sentences=n_wiki_sentences, replace_title_mentions=replace_title_mentions,
+                tokenization_cache=tokenization_cache, n_tokenize_workers=n_tokenize_workers,
                 **kwargs
             )
             TEXT.build_vocab(train, vectors=vectors, max_size=combined_max_vocab_size)
@@ -317,7 +438,9 @@ class QuizBowl(Dataset):
                 qanta_id_field=QANTA_ID, sent_field=SENT, page_field=PAGE,
                 unigram_field=UNIGRAM_TEXT, bigram_field=BIGRAM_TEXT, trigram_field=TRIGRAM_TEXT,
                 root=root, example_mode=example_mode, use_wiki=use_wiki, n_wiki_sentences=n_wiki_sentences,
-                replace_title_mentions=replace_title_mentions, **kwargs
+                replace_title_mentions=replace_title_mentions,
+                tokenization_cache=tokenization_cache, n_tokenize_workers=n_tokenize_workers,
+                **kwargs
             )
             if UNIGRAM_TEXT is not None:
                 UNIGRAM_TEXT.build_vocab(train, vectors=vectors, max_size=unigram_max_vocab_size)
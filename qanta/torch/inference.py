@@ -0,0 +1,198 @@
+"""
+Device selection and batching helpers shared by the torch guessers at inference time.
+
+Models are trained on GPU but are frequently served from CPU only machines. Setting QB_FORCE_CPU=1 keeps everything
+on CPU even if a GPU is visible, and QB_TORCH_THREADS controls the number of intra-op threads torch uses on CPU.
+"""
+from typing import List, Optional, Callable, Sequence, Any, Tuple
+import contextlib
+import time
+
+import numpy as np
+import torch
+
+from qanta import qlogging
+from qanta.util.environment import QB_FORCE_CPU, QB_TORCH_THREADS
+
+
+log = qlogging.get(__name__)
+
+
+CUDA = torch.cuda.is_available() and not QB_FORCE_CPU
+
+# torchtext interprets device=None as the current GPU and device=-1 as CPU
+TORCHTEXT_DEVICE = None if CUDA else -1
+
+DEFAULT_BATCH_SIZE_CANDIDATES = (32, 64, 128, 256, 512, 1024)
+
+
+def _cpu_storage(storage, loc):
+    return storage
+
+
+def map_location(force_cpu: bool = not CUDA):
+    """
+    Return the map_location argument of torch.load. By default tensors saved on GPU are deserialized on CPU when CUDA
+    is unavailable or disabled with QB_FORCE_CPU, and keep the device they were saved on otherwise.
+
+    :param force_cpu: deserialize on CPU regardless of CUDA, for models that only run on CPU
+    """
+    if force_cpu:
+        return _cpu_storage
+    else:
+        return None
+
+
+def maybe_cuda(x):
+    """
+    Move a tensor, variable, or module to the GPU only if one is being used
+    """
+    if CUDA:
+        return x.cuda()
+    else:
+        return x
+
+
+def configure_threads(n_threads: int = QB_TORCH_THREADS):
+    """
+    Set the number of intra-op threads torch uses on CPU, a value of 0 keeps the torch default
+    """
+    if not CUDA and n_threads > 0:
+        torch.set_num_threads(n_threads)
+        log.info(f'Using {n_threads} torch threads for CPU inference')
+
+
+def inference_mode():
+    """
+    Context manager which disables autograd during inference. Older versions of torch without torch.no_grad rely on
+    models creating volatile variables instead.
+    """
+    if hasattr(torch, 'no_grad'):
+        return torch.no_grad()
+    else:
+        return contextlib.suppress()
+
+
+def autotune_batch_size(guess_batch: Callable[[List[Any]], List],
+                        questions: Sequence[Any],
+                        candidates: Sequence[int] = DEFAULT_BATCH_SIZE_CANDIDATES):
+    """
+    Find the batch size with the highest throughput on this machine by timing guess_batch on consecutive slices of
+    questions. The outputs are returned so that no work done while tuning is wasted.
+
+    :param guess_batch: function computing guesses for a list of questions
+    :param questions: questions to tune on, the first len(result) are consumed
+    :param candidates: batch sizes to try in increasing order
+    :return: (best batch size, guesses for questions[:n_consumed], n_consumed)
+    """
+    guesses = []
+    position = 0
+    best_batch_size = None
+    best_throughput = 0
+    for i, batch_size in enumerate(candidates):
+        # The first batch pays for lazy initialization such as allocating buffers, so run it untimed
+        if i == 0:
+            warmup = questions[position:position + batch_size]
+            guesses.extend(guess_batch(warmup))
+            position += len(warmup)
+        batch = questions[position:position + batch_size]
+        if len(batch) < batch_size:
+            break
+        start = time.time()
+        guesses.extend(guess_batch(batch))
+        elapsed = time.time() - start
+        position += len(batch)
+        throughput = len(batch) / max(elapsed, 1e-9)
+        log.info(f'Batch size {batch_size}: {throughput:.1f} questions/sec')
+        if throughput > best_throughput:
+            best_throughput = throughput
+            best_batch_size = batch_size
+        else:
+            # Throughput is usually unimodal in batch size so stop once it gets worse
+            break
+
+    if best_batch_size is None:
+        best_batch_size = candidates[0]
+    log.info(f'Selected inference batch size {best_batch_size}')
+    return best_batch_size, guesses, position
+
+
+def guess_in_batches(guess_batch: Callable[[List[Any]], List], questions: Sequence[Any], batch_size: int) -> List:
+    guesses = []
+    with inference_mode():
+        for i in range(0, len(questions), batch_size):
+            guesses.extend(guess_batch(questions[i:i + batch_size]))
+    return guesses
+
+
+class BatchedInference:
+    def __init__(self, batch_size: int, autotune: bool = False,
+                 candidates: Optional[Sequence[int]] = None):
+        """
+        Run inference in batches of a fixed size, or autotune the batch size on the first call with enough questions
+        and reuse it afterwards
+
+        :param batch_size: batch size to use, also the fallback if autotuning does not have enough questions
+        :param autotune: whether to autotune the batch size
+        :param candidates: batch sizes to try when autotuning
+        """
+        self.batch_size = batch_size
+        self.autotune = autotune
+        self.candidates = DEFAULT_BATCH_SIZE_CANDIDATES if candidates is None else tuple(candidates)
+        self.tuned = False
+
+    def __call__(self, guess_batch: Callable[[List[Any]], List], questions: Sequence[Any]) -> List:
+        if len(questions) == 0:
+            return []
+        # Tuning needs a warmup batch and at least two timed batches to compare
+        min_tune_questions = 2 * self.candidates[0] + self.candidates[1]
+        if self.autotune and not self.tuned and len(questions) >= min_tune_questions:
+            with inference_mode():
+                self.batch_size, guesses, n_consumed = autotune_batch_size(guess_batch, questions, self.candidates)
+            self.tuned = True
+            return guesses + guess_in_batches(guess_batch, questions[n_consumed:], self.batch_size)
+        return guess_in_batches(guess_batch, questions, self.batch_size)
+
+
+class TopKGuesses(Sequence):
+    def __init__(self, indices: np.ndarray, scores: np.ndarray, i_to_ans: Sequence[str]):
+        """
+        Top guesses for a batch of questions stored as [n_examples, k] index and score arrays. Page names are only
+        looked up when an example's guesses are accessed.
+        """
+        self.indices = indices
+        self.scores = scores
+        self.i_to_ans = i_to_ans
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+    def __getitem__(self, i) -> List[Tuple[str, float]]:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < -len(self) or i >= len(self):
+            raise IndexError(f'Example {i} out of range for {len(self)} examples')
+        i_to_ans = self.i_to_ans
+        return [(i_to_ans[p], s) for p, s in zip(self.indices[i], self.scores[i])]
+
+
+def top_k_guesses(probs, max_n_guesses: Optional[int], i_to_ans: Sequence[str],
+                  row_order: Optional[np.ndarray] = None) -> TopKGuesses:
+    """
+    Select the max_n_guesses highest scoring classes for each row of probs with torch.topk, which avoids sorting all
+    classes for every example
+
+    :param probs: [n_examples, n_classes] tensor of class scores
+    :param max_n_guesses: number of guesses per example, None for all classes
+    :param i_to_ans: mapping from class index to page
+    :param row_order: optional permutation applied to the rows of the result, for batches sorted by length
+    """
+    n_classes = probs.size(1)
+    k = n_classes if max_n_guesses is None else min(max_n_guesses, n_classes)
+    scores, indices = torch.topk(probs, k, dim=1)
+    scores = scores.data.cpu().numpy()
+    indices = indices.data.cpu().numpy()
+    if row_order is not None:
+        scores = scores[row_order]
+        indices = indices[row_order]
+    return TopKGuesses(indices, scores, i_to_ans)
@@ -0,0 +1,161 @@
+"""
+On disk cache of the tokenized torchtext quiz bowl datasets.
+
+Tokenizing the train/val/dev json with nltk takes minutes and gives identical results for every run with the same
+tokenizer settings, so the tokens of each text field are computed once across a process pool and saved as a token
+table plus flat int32 token id and int64 offset arrays. The cache directory name is a hash of the source file
+fingerprint, the example mode, and the settings of each field's tokenizer, so changing any of them tokenizes again.
+"""
+from typing import List, Dict, Tuple, Optional, Any, Sequence
+import os
+import json
+import hashlib
+import shutil
+import multiprocessing
+
+import numpy as np
+
+from qanta import qlogging
+
+
+log = qlogging.get(__name__)
+
+
+CACHE_DIRNAME = 'tokenization_cache'
+CACHE_FORMAT_VERSION = 1
+TOKENIZE_BATCH_SIZE = 2000
+
+# (field name, tokenizer, lowercase) for each text dependent field
+FieldSpec = Tuple[str, Any, bool]
+
+
+def cacheable_fields(text_dependent_fields) -> Optional[List[FieldSpec]]:
+    """
+    Return a spec of each text field if all of them use a tokenizer with settings the cache can be keyed by, otherwise
+    None. Fields with a preprocessing pipeline are not cached since it may be arbitrary code.
+    """
+    specs = []
+    for name, field in text_dependent_fields:
+        if not hasattr(field.tokenize, 'settings') or field.preprocessing is not None:
+            return None
+        specs.append((name, field.tokenize, field.lower))
+    return specs
+
+
+def cache_key(path: str, example_mode: str, specs: List[FieldSpec]) -> str:
+    stat = os.stat(path)
+    key = {
+        'version': CACHE_FORMAT_VERSION,
+        'source': {'name': os.path.basename(path), 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size},
+        'example_mode': example_mode,
+        'fields': {name: {'tokenizer': tokenizer.settings(), 'lower': lower} for name, tokenizer, lower in specs}
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def cache_directory(path: str, example_mode: str, specs: List[FieldSpec]) -> str:
+    return os.path.join(os.path.dirname(path), CACHE_DIRNAME, cache_key(path, example_mode, specs))
+
+
+def tokenize_texts(texts: Sequence[str], specs: List[FieldSpec]) -> Dict[str, List[List[str]]]:
+    """
+    Unidecode and tokenize each text for every field the same way Field.preprocess would
+    """
+    from unidecode import unidecode
+    tokens = {name: [] for name, _, _ in specs}
+    for text in texts:
+        text = unidecode(text).rstrip('\n')
+        for name, tokenizer, lower in specs:
+            field_tokens = tokenizer(text)
+            if lower:
+                field_tokens = [t.lower() for t in field_tokens]
+            tokens[name].append(field_tokens)
+    return tokens
+
+
+_worker_specs: Optional[List[FieldSpec]] = None
+
+
+def _init_worker(specs: List[FieldSpec]):
+    global _worker_specs
+    _worker_specs = specs
+
+
+def _tokenize_batch(texts: List[str]) -> Dict[str, List[List[str]]]:
+    return tokenize_texts(texts, _worker_specs)
+
+
+def parallel_tokenize(texts: List[str], specs: List[FieldSpec], n_workers: int) -> Dict[str, List[List[str]]]:
+    """
+    Tokenize texts for every field in specs using n_workers processes, returning the tokens in the order of texts
+    """
+    if n_workers <= 1 or len(texts) <= TOKENIZE_BATCH_SIZE:
+        return tokenize_texts(texts, specs)
+    batches = [texts[i:i + TOKENIZE_BATCH_SIZE] for i in range(0, len(texts), TOKENIZE_BATCH_SIZE)]
+    tokens = {name: [] for name, _, _ in specs}
+    with multiprocessing.Pool(n_workers, initializer=_init_worker, initargs=(specs,)) as pool:
+        for batch_tokens in pool.imap(_tokenize_batch, batches):
+            for name, field_tokens in batch_tokens.items():
+                tokens[name].extend(field_tokens)
+    return tokens
+
+
+class TokenizationCache:
+    def __init__(self, directory: str):
+        """
+        Tokenized examples of one dataset file for one set of tokenizer settings. Besides the tokens of each field the
+        cache stores the qanta_id, sentence index, and page of every example.
+
+        :param directory: directory of the cache, usually from cache_directory
+        """
+        self.directory = directory
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.directory, 'meta.json')
+
+    def exists(self) -> bool:
+        return os.path.exists(self.meta_path)
+
+    def save(self, qanta_ids: List[int], sents: List[int], pages: List[str],
+             tokens: Dict[str, List[List[str]]]) -> None:
+        tmp_directory = f'{self.directory}.{os.getpid()}.tmp'
+        os.makedirs(tmp_directory, exist_ok=True)
+        np.save(os.path.join(tmp_directory, 'qanta_id.npy'), np.array(qanta_ids, dtype=np.int64))
+        np.save(os.path.join(tmp_directory, 'sent.npy'), np.array(sents, dtype=np.int32))
+        token_tables = {}
+        for name, field_tokens in tokens.items():
+            token_to_id = {}
+            ids = np.array(
+                [token_to_id.setdefault(t, len(token_to_id)) for example in field_tokens for t in example],
+                dtype=np.int32
+            )
+            offsets = np.zeros(len(field_tokens) + 1, dtype=np.int64)
+            np.cumsum(np.array([len(example) for example in field_tokens], dtype=np.int64), out=offsets[1:])
+            np.save(os.path.join(tmp_directory, f'{name}_ids.npy'), ids)
+            np.save(os.path.join(tmp_directory, f'{name}_offsets.npy'), offsets)
+            token_tables[name] = list(token_to_id.keys())
+
+        # meta.json is written last since its existence marks the cache as complete
+        with open(os.path.join(tmp_directory, 'meta.json'), 'w') as f:
+            json.dump({'pages': pages, 'token_tables': token_tables}, f)
+        try:
+            os.rename(tmp_directory, self.directory)
+        except OSError:
+            # Another process finished writing the same cache first
+            log.info(f'Tokenization cache {self.directory} already exists')
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+
+    def load(self) -> Tuple[List[int], List[int], List[str], Dict[str, List[List[str]]]]:
+        with open(self.meta_path) as f:
+            meta = json.load(f)
+        qanta_ids = np.load(os.path.join(self.directory, 'qanta_id.npy')).tolist()
+        sents = np.load(os.path.join(self.directory, 'sent.npy')).tolist()
+        tokens = {}
+        for name, table in meta['token_tables'].items():
+            ids = np.load(os.path.join(self.directory, f'{name}_ids.npy'))
+            offsets = np.load(os.path.join(self.directory, f'{name}_offsets.npy')).tolist()
+            # Decode all tokens with a single fancy index then slice per example
+            flat_tokens = np.array(table, dtype=object)[ids].tolist()
+            tokens[name] = [flat_tokens[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        return qanta_ids, sents, meta['pages'], tokens
@@ -0,0 +1,119 @@
+"""
+Shared file layout of the read only binary stores (dataset snapshots, wikipedia page stores, and guess stores).
+
+A store file is an 8 byte magic string, the little endian uint64 offset where column data starts, a JSON header, and
+one contiguous array per column. Columns start on 64 byte boundaries so each can be memory mapped independently. The
+header describes each column as {"dtype", "offset", "length"} under "columns"; other header keys belong to the store.
+
+Stores built from a source file record its fingerprint in the header so a stale store is rebuilt on open.
+"""
+from typing import Dict, Tuple, Callable, Any
+import os
+import json
+import struct
+
+import numpy as np
+
+from qanta import qlogging
+from qanta.util.io import get_tmp_filename
+
+
+log = qlogging.get(__name__)
+
+
+ALIGNMENT = 64
+
+
+def pad(offset: int) -> int:
+    return (ALIGNMENT - offset % ALIGNMENT) % ALIGNMENT
+
+
+def source_fingerprint(path: str) -> Dict[str, int]:
+    stat = os.stat(path)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def write_columns(path: str, magic: bytes, header: Dict[str, Any], arrays: Dict[str, np.ndarray]) -> None:
+    """
+    Write a store with the given header and columns. The file is written to a temporary path and renamed so that
+    concurrent readers never observe a partial store.
+
+    :param path: output path
+    :param magic: 8 byte magic string identifying the kind of store
+    :param header: JSON serializable header, its columns key is filled in from arrays
+    :param arrays: one dimensional array of each column, in the order they are written
+    """
+    header = dict(header, columns={})
+    offset = 0
+    for name, values in arrays.items():
+        header['columns'][name] = {'dtype': values.dtype.str, 'offset': offset, 'length': len(values)}
+        offset += values.nbytes
+        offset += pad(offset)
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = len(magic) + 8 + len(header_bytes)
+    data_start += pad(data_start)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(magic)
+        f.write(struct.pack('<Q', data_start))
+        f.write(header_bytes)
+        f.write(b'\0' * (data_start - f.tell()))
+        for values in arrays.values():
+            column_bytes = np.ascontiguousarray(values).tobytes()
+            f.write(column_bytes)
+            f.write(b'\0' * pad(len(column_bytes)))
+    os.replace(tmp_path, path)
+
+
+def read_header(path: str, magic: bytes, description: str) -> Tuple[Dict[str, Any], int]:
+    """
+    Read the header of a store written by write_columns
+
+    :param description: kind of store used in the error raised for files with a different magic string
+    :return: header and the offset where column data starts
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f'{path} is not a {description}')
+        data_start = struct.unpack('<Q', f.read(8))[0]
+        header_bytes = f.read(data_start - len(magic) - 8).rstrip(b'\0')
+    return json.loads(header_bytes.decode('utf-8')), data_start
+
+
+def map_column(path: str, data_start: int, info: Dict[str, Any], length: int) -> np.ndarray:
+    """
+    Memory map a column described by info in the header, empty columns are returned as empty arrays since they
+    cannot be memory mapped
+    """
+    if length == 0:
+        return np.zeros(0, dtype=info['dtype'])
+    return np.memmap(path, dtype=info['dtype'], mode='r', offset=data_start + info['offset'], shape=(length,))
+
+
+def open_or_build(source_path: str, path: str, suffix: str, open_store: Callable[[str], Any],
+                  build_store: Callable[[str, str], Any], description: str):
+    """
+    Open the store at path built from source_path, building it first if it is missing, older than the source, or in
+    an unknown format. If the store cannot be written at path it is built in the temporary directory instead.
+
+    :param open_store: opens the store at a path, raising ValueError for files in an unknown format
+    :param build_store: builds the store of a source path at an output path
+    """
+    source = source_fingerprint(source_path)
+    if os.path.exists(path):
+        try:
+            store = open_store(path)
+            if store.source == source:
+                return store
+            if hasattr(store, 'close'):
+                store.close()
+        except ValueError:
+            log.warning(f'Replacing {description} {path} written in an unknown format')
+    try:
+        build_store(source_path, path)
+    except OSError:
+        path = get_tmp_filename() + suffix
+        log.warning(f'Could not write {description} next to {source_path}, using {path}')
+        build_store(source_path, path)
+    return open_store(path)
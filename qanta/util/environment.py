@@ -7,6 +7,8 @@ from functools import lru_cache
 QB_ROOT = os.getenv('QB_ROOT')
 QB_SPARK_MASTER = os.getenv('QB_SPARK_MASTER', 'local[*]')
 QB_MAX_CORES = os.getenv('QB_MAX_CORES', multiprocessing.cpu_count())
+QB_FORCE_CPU = bool(int(os.getenv('QB_FORCE_CPU', 0)))
+QB_TORCH_THREADS = int(os.getenv('QB_TORCH_THREADS', 0))
 
 
 @lru_cache()
@@ -33,5 +35,7 @@ BONUS_PAIRS_JSON = data_path('data/internal/bonus_pairs.json')
 
 ENVIRONMENT = dict(
     QB_ROOT=QB_ROOT,
-    QB_SPARK_MASTER=QB_SPARK_MASTER
+    QB_SPARK_MASTER=QB_SPARK_MASTER,
+    QB_FORCE_CPU=QB_FORCE_CPU,
+    QB_TORCH_THREADS=QB_TORCH_THREADS
 )
@@ -1,23 +1,24 @@
-from typing import Dict
+from typing import List, Dict, Tuple, Iterable, Optional
 import os
 import json
 import csv
 import pickle
 import re
-from collections import namedtuple
+import sqlite3
+from multiprocessing import Pool
 import nltk
 from unidecode import unidecode
 
 from qanta import qlogging
-from qanta.datasets.quiz_bowl import QantaDatabase
+from qanta.datasets.quiz_bowl import get_qanta_database
 from qanta.util.constants import COUNTRY_LIST_PATH, WIKI_DUMP_REDIRECT_PICKLE, WIKI_LOOKUP_PATH
+from qanta.wikipedia.page_store import WikipediaPage, WikipediaPageStore, open_page_store, DEFAULT_CACHE_SIZE
 
 
 log = qlogging.get(__name__)
 
 COUNTRY_SUB = ["History_of_", "Geography_of_"]
-
-WikipediaPage = namedtuple('WikipediaPage', ['id', 'title', 'text', 'url'])
+WHITESPACE_REGEX = re.compile(r'\s+')
 
 
 def normalize_wikipedia_title(title):
@@ -45,7 +46,7 @@ def create_wikipedia_cache(parsed_wiki_path='data/external/wikipedia/parsed-wiki
     from qanta.spark import create_spark_context
 
     sc = create_spark_context()
-    db = QantaDatabase()
+    db = get_qanta_database()
     train_questions = db.train_questions
     answers = {q.page for q in train_questions}
     b_answers = sc.broadcast(answers)
@@ -76,7 +77,7 @@ def create_wikipedia_redirect_pickle(redirect_csv, output_pickle):
             k, v = line.split('\t')
             countries[k] = v.strip()
 
-    db = QantaDatabase()
+    db = get_qanta_database()
     pages = {q.page for q in db.train_questions}
 
     with open(redirect_csv) as redirect_f:
@@ -111,32 +112,138 @@ def extract_wiki_sentences(title, text, n_sentences, replace_title_mentions=''):
 
     :param title: title of page
     :param text: text of page
-    :param n_paragraphs: number of paragraphs to use
+    :param n_sentences: number of sentences to use
     :param replace_title_mentions: Replace mentions with the provided string token, by default removing them
     :return:
     """
-    # Get simplest representation of title and text
+    if n_sentences <= 0:
+        return []
+
+    # Get simplest representation of title, the text is unidecoded one paragraph at a time as it is consumed
     title = unidecode(title).replace('_', ' ')
-    text = unidecode(text)
 
     # Split on non-alphanumeric
     title_words = re.split('[^a-zA-Z0-9]', title)
-    title_word_pattern = '|'.join(re.escape(w.lower()) for w in title_words)
+    title_word_regex = re.compile('|'.join(re.escape(w.lower()) for w in title_words), flags=re.IGNORECASE)
 
     # Breaking by newline yields paragraphs. Ignore the first since its always just the title
-    paragraphs = [p for p in text.split('\n') if len(p) != 0][1:]
+    paragraphs = (p for raw in text.split('\n') for p in unidecode(raw).split('\n') if len(p) != 0)
+    next(paragraphs, None)
     sentences = []
     for p in paragraphs:
-        formatted_text = re.sub(title_word_pattern, replace_title_mentions, p, flags=re.IGNORECASE)
+        formatted_text = title_word_regex.sub(replace_title_mentions, p)
         # Cleanup whitespace
-        formatted_text = re.sub('\s+', ' ', formatted_text).strip()
+        formatted_text = WHITESPACE_REGEX.sub(' ', formatted_text).strip()
         sentences.extend(nltk.sent_tokenize(formatted_text))
+        # Paragraphs are tokenized independently so later ones cannot change the sentences already found
+        if len(sentences) >= n_sentences:
+            break
 
     return sentences[:n_sentences]
 
 
+def extract_wiki_sentences_batch(pages: List[Tuple[str, str]], n_sentences: int, replace_title_mentions='',
+                                 n_workers=1) -> Dict[str, List[str]]:
+    """
+    Run extract_wiki_sentences on many pages, splitting the work across n_workers processes
+
+    :param pages: (title, text) pairs
+    :return: mapping from title to its sentences
+    """
+    args = [(title, text, n_sentences, replace_title_mentions) for title, text in pages]
+    if n_workers > 1 and len(args) > 1:
+        with Pool(n_workers) as pool:
+            results = pool.starmap(extract_wiki_sentences, args, chunksize=64)
+    else:
+        results = [extract_wiki_sentences(*a) for a in args]
+    return {title: sentences for (title, _), sentences in zip(pages, results)}
+
+
+class WikiSentenceCache:
+    def __init__(self, path: str, source: Optional[Dict] = None):
+        """
+        On disk cache of extract_wiki_sentences results keyed by (page, n_sentences, replace_title_mentions)
+
+        :param path: sqlite file backing the cache
+        :param source: fingerprint of the pages the sentences were extracted from, if it differs from the one stored
+            in the cache every entry is dropped
+        """
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS sentences ('
+                'page TEXT, n_sentences INTEGER, replace_title_mentions TEXT, sentences TEXT, '
+                'PRIMARY KEY (page, n_sentences, replace_title_mentions))'
+            )
+            source_json = json.dumps(source, sort_keys=True)
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+            if row is None or row[0] != source_json:
+                self.conn.execute('DELETE FROM sentences')
+                self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('source', ?)", (source_json,))
+
+    @classmethod
+    def for_store(cls, store: WikipediaPageStore) -> 'WikiSentenceCache':
+        return cls(store.path + '.sentences.sqlite', source=store.source)
+
+    def get_many(self, pages: Iterable[str], n_sentences: int, replace_title_mentions='') -> Dict[str, List[str]]:
+        found = {}
+        for page in pages:
+            row = self.conn.execute(
+                'SELECT sentences FROM sentences WHERE page = ? AND n_sentences = ? AND replace_title_mentions = ?',
+                (page, n_sentences, replace_title_mentions)
+            ).fetchone()
+            if row is not None:
+                found[page] = json.loads(row[0])
+        return found
+
+    def put_many(self, page_sentences: Dict[str, List[str]], n_sentences: int, replace_title_mentions=''):
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO sentences VALUES (?, ?, ?, ?)',
+                [(page, n_sentences, replace_title_mentions, json.dumps(sentences))
+                 for page, sentences in page_sentences.items()]
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+def wiki_sentences(lookup, pages: Iterable[str], n_sentences: int, replace_title_mentions='', n_workers=1,
+                   cache: Optional[WikiSentenceCache] = None) -> Dict[str, List[str]]:
+    """
+    Extract sentences for each page in pages which is in lookup, reading and filling cache if it is given
+
+    :param lookup: Wikipedia, WikipediaPageStore or other mapping from title to WikipediaPage
+    :param pages: titles to extract sentences for
+    :param n_sentences: number of sentences per page
+    :param replace_title_mentions: see extract_wiki_sentences
+    :param n_workers: number of processes extracting sentences for pages which are not cached
+    :param cache: optional cache of previously extracted sentences
+    :return: mapping from title to its sentences
+    """
+    pages = [p for p in pages if p in lookup]
+    if cache is None:
+        found = {}
+    else:
+        found = cache.get_many(pages, n_sentences, replace_title_mentions)
+    missing = [p for p in pages if p not in found]
+    if len(missing) > 0:
+        log.info(f'Extracting sentences for {len(missing)} wikipedia pages, {len(found)} were cached')
+        extracted = extract_wiki_sentences_batch(
+            [(p, lookup[p].text) for p in missing], n_sentences,
+            replace_title_mentions=replace_title_mentions, n_workers=n_workers
+        )
+        if cache is not None:
+            cache.put_many(extracted, n_sentences, replace_title_mentions)
+        found.update(extracted)
+    return found
+
+
 class Wikipedia:
-    def __init__(self, lookup_path=WIKI_LOOKUP_PATH, dump_redirect_path=WIKI_DUMP_REDIRECT_PICKLE):
+    def __init__(self, lookup_path=WIKI_LOOKUP_PATH, dump_redirect_path=WIKI_DUMP_REDIRECT_PICKLE,
+                 cache_size=DEFAULT_CACHE_SIZE):
         """
         CachedWikipedia provides a unified way and easy way to access Wikipedia pages. Its design is motivated by:
         1) Getting a wikipedia page should function as a simple python dictionary access
@@ -150,17 +257,17 @@ class Wikipedia:
         of this we do the very light preprocessing step of replacing whitespace with underscores since the canonical
         page names in the wikipedia database dumps contains an underscore instead of whitespace (a difference from the
         HTTP package which defaults to the opposite)
+
+        Pages
+        Pages are read from a compressed page store built from lookup_path the first time it is used, see
+        qanta.wikipedia.page_store. Only the title index is held in memory along with the cache_size most recently
+        used pages.
         """
         self.countries = {}
         self.redirects = {}
         self.lookup_path = lookup_path
         self.dump_redirect_path = dump_redirect_path
-        with open(lookup_path, 'rb') as f:
-            raw_lookup: Dict[str, Dict] = json.load(f)
-            self.lookup: Dict[str, WikipediaPage] = {
-                title: WikipediaPage(page['id'], page['title'], page['text'], page['url'])
-                for title, page in raw_lookup.items()
-            }
+        self.lookup = open_page_store(lookup_path, cache_size=cache_size)
 
         if COUNTRY_LIST_PATH:
             with open(COUNTRY_LIST_PATH) as f:
@@ -177,11 +284,12 @@ class Wikipedia:
                 f'WikipediaRedirectPickle')
 
     def load_country(self, key: str):
-        content = self.lookup[key]
-        for page in [f"{prefix}{self.countries[key]}" for prefix in COUNTRY_SUB]:
-            if page in self.lookup:
-                content = content + ' ' + self.lookup[page].text
-        return content
+        page = self.lookup[key]
+        text = page.text
+        for sub_page in [f"{prefix}{self.countries[key]}" for prefix in COUNTRY_SUB]:
+            if sub_page in self.lookup:
+                text = text + ' ' + self.lookup[sub_page].text
+        return WikipediaPage(page.id, page.title, text, page.url)
 
     def __getitem__(self, key: str) -> WikipediaPage:
         if key in self.countries:
@@ -0,0 +1,142 @@
+"""
+Read only on disk store of wikipedia pages built from a wiki_lookup.json file.
+
+Each page is serialized and compressed independently into a single byte column, and an offsets column maps the index
+of each title in the header to the byte range of its page, so a lookup reads and decompresses a single page from a
+memory mapped file laid out as described in qanta.util.columnar. Processes opening the same store share the OS page
+cache instead of each holding every page in memory, and recently used pages are kept decoded in an LRU cache.
+"""
+from typing import Dict, Optional, Iterator
+from collections import namedtuple, OrderedDict
+import json
+import threading
+import zlib
+
+import numpy as np
+
+from qanta import qlogging
+from qanta.util.columnar import write_columns, read_header, map_column, open_or_build, source_fingerprint
+
+
+log = qlogging.get(__name__)
+
+
+WikipediaPage = namedtuple('WikipediaPage', ['id', 'title', 'text', 'url'])
+
+MAGIC = b'QBWIKI02'
+STORE_SUFFIX = '.store'
+DEFAULT_CACHE_SIZE = 1024
+
+
+def store_path(lookup_path: str) -> str:
+    return lookup_path + STORE_SUFFIX
+
+
+def build_page_store(lookup_path: str, output_path: Optional[str] = None, compression_level: int = 6) -> str:
+    """
+    Convert a wiki_lookup.json file mapping titles to {id, title, text, url} dictionaries to a page store
+
+    :param lookup_path: path to the json lookup
+    :param output_path: path of the store, by default next to the lookup
+    :param compression_level: zlib compression level
+    :return: path of the store
+    """
+    if output_path is None:
+        output_path = store_path(lookup_path)
+    log.info(f'Building wikipedia page store of {lookup_path} at {output_path}')
+    source = source_fingerprint(lookup_path)
+    with open(lookup_path) as f:
+        raw_lookup = json.load(f)
+
+    titles = list(raw_lookup.keys())
+    compressed_pages = []
+    for title in titles:
+        page = raw_lookup[title]
+        record = json.dumps([page['id'], page['title'], page['text'], page['url']]).encode('utf-8')
+        compressed_pages.append(zlib.compress(record, compression_level))
+    offsets = np.zeros(len(titles) + 1, dtype=np.int64)
+    np.cumsum(np.array([len(c) for c in compressed_pages], dtype=np.int64), out=offsets[1:])
+    arrays = {
+        'offsets': offsets,
+        'pages': np.frombuffer(b''.join(compressed_pages), dtype=np.uint8)
+    }
+    write_columns(output_path, MAGIC, {'titles': titles, 'source': source}, arrays)
+    return output_path
+
+
+def open_page_store(lookup_path: str, cache_size: int = DEFAULT_CACHE_SIZE) -> 'WikipediaPageStore':
+    """
+    Open the page store for lookup_path, building it first if it is missing or older than the lookup. If the store
+    cannot be written next to the lookup it is built in the temporary directory instead.
+    """
+    return open_or_build(
+        lookup_path, store_path(lookup_path), STORE_SUFFIX,
+        lambda path: WikipediaPageStore(path, cache_size=cache_size), build_page_store, 'page store'
+    )
+
+
+class WikipediaPageStore:
+    def __init__(self, path: str, cache_size: int = DEFAULT_CACHE_SIZE):
+        """
+        Dictionary like read only access to a page store written by build_page_store
+
+        :param path: path to the store
+        :param cache_size: number of decoded pages to keep in memory
+        """
+        self.path = path
+        self.cache_size = cache_size
+        header, data_start = read_header(path, MAGIC, 'wikipedia page store')
+        self.source: Optional[Dict[str, int]] = header['source']
+        self.titles = header['titles']
+        self._index = {title: i for i, title in enumerate(self.titles)}
+        columns = header['columns']
+        self._offsets = map_column(path, data_start, columns['offsets'], columns['offsets']['length'])
+        self._pages = map_column(path, data_start, columns['pages'], columns['pages']['length'])
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'path': self.path, 'cache_size': self.cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], cache_size=state['cache_size'])
+
+    def _read_page(self, i: int) -> WikipediaPage:
+        record = zlib.decompress(self._pages[self._offsets[i]:self._offsets[i + 1]].tobytes())
+        return WikipediaPage(*json.loads(record.decode('utf-8')))
+
+    def __getitem__(self, title: str) -> WikipediaPage:
+        with self._lock:
+            page = self._cache.get(title)
+            if page is not None:
+                self._cache.move_to_end(title)
+                return page
+        page = self._read_page(self._index[title])
+        with self._lock:
+            self._cache[title] = page
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return page
+
+    def get(self, title: str, default=None):
+        if title in self._index:
+            return self[title]
+        else:
+            return default
+
+    def __contains__(self, title):
+        return title in self._index
+
+    def __len__(self):
+        return len(self.titles)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.titles)
+
+    def keys(self):
+        return self._index.keys()
+
+    def close(self):
+        # Dropping the references releases the memory maps once no page slices are alive
+        self._offsets = None
+        self._pages = None
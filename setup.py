@@ -23,6 +23,7 @@ requirements = [
     'spacy==2.0.11',
     'pycountry',
     'flask',
+    'gunicorn',
     'dash',
     'dash-renderer',
     'dash-html-components',
@@ -0,0 +1,171 @@
+import math
+import mmap
+
+import pytest
+
+from qanta.guesser.bm25 import BM25Index, BM25Guesser, FIELDS, tokenize
+
+
+K1 = 1.2
+B = .75
+
+# (page, wiki_content, qb_content)
+DOCS = [
+    ('apple', 'red fruit red', 'apple pie'),
+    ('banana', 'yellow fruit', ''),
+    ('cherry', '', 'red cherry pie tart'),
+]
+
+
+def build_index(docs=DOCS):
+    index = BM25Index(k1=K1, b=B)
+    index._build(docs)
+    return index
+
+
+def reference_field_scores(docs, field, query):
+    """
+    BM25 as computed by Lucene: idf = ln(1 + (N - df + .5) / (df + .5)) where N counts the documents with a non empty
+    field, and each query term occurrence adds idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl))
+    """
+    field_ix = FIELDS.index(field) + 1
+    doc_tokens = [tokenize(d[field_ix]) for d in docs]
+    lengths = [len(t) for t in doc_tokens]
+    n_docs = sum(1 for length in lengths if length > 0)
+    avg_length = sum(lengths) / n_docs
+    scores = [0.0] * len(docs)
+    for term in tokenize(query):
+        df = sum(1 for tokens in doc_tokens if term in tokens)
+        if df == 0:
+            continue
+        idf = math.log(1 + (n_docs - df + .5) / (df + .5))
+        for i, tokens in enumerate(doc_tokens):
+            tf = tokens.count(term)
+            if tf > 0:
+                scores[i] += idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * lengths[i] / avg_length))
+    return scores
+
+
+def reference_search(docs, query, wiki_boost=1, qb_boost=1):
+    wiki = reference_field_scores(docs, 'wiki_content', query)
+    qb = reference_field_scores(docs, 'qb_content', query)
+    scores = {}
+    for (page, _, _), w, q in zip(docs, wiki, qb):
+        score = max(wiki_boost * w, qb_boost * q)
+        if score > 0:
+            scores[page] = max(scores.get(page, 0), score)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+
+
+def is_memory_mapped(array) -> bool:
+    # scipy wraps the arrays it is given in views, so look through the chain of bases for the mapping
+    while array is not None:
+        if isinstance(array, mmap.mmap):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+def assert_guesses_equal(actual, expected):
+    assert [page for page, _ in actual] == [page for page, _ in expected]
+    assert [score for _, score in actual] == pytest.approx([score for _, score in expected], rel=1e-5)
+
+
+def test_lucene_idf_and_length_normalization():
+    index = build_index()
+    # yellow occurs in 1 of the 2 documents with wiki content, banana's wiki content has 2 of 5 wiki tokens
+    idf = math.log(1 + (2 - 1 + .5) / (1 + .5))
+    expected = idf * 1 * (K1 + 1) / (1 + K1 * (1 - B + B * 2 / 2.5))
+    [[(page, score)]] = index.search(['yellow'], None)
+    assert page == 'banana'
+    assert score == pytest.approx(expected, rel=1e-6)
+
+    # fruit occurs once in both wiki documents, so the shorter banana document scores higher
+    guesses = index.search(['fruit'], None)[0]
+    assert [page for page, _ in guesses] == ['banana', 'apple']
+    idf = math.log(1 + (2 - 2 + .5) / (2 + .5))
+    assert guesses[1][1] == pytest.approx(idf * (K1 + 1) / (1 + K1 * (1 - B + B * 3 / 2.5)), rel=1e-6)
+    assert_guesses_equal(guesses, reference_search(DOCS, 'fruit'))
+
+
+def test_query_term_frequency_and_unknown_terms():
+    index = build_index()
+    assert_guesses_equal(index.search(['red red pie'], None)[0], reference_search(DOCS, 'red red pie'))
+    assert index.search(['durian'], None) == [[]]
+
+
+def test_max_over_fields_and_boosts():
+    index = build_index()
+    query = 'red pie'
+    wiki = reference_field_scores(DOCS, 'wiki_content', query)
+    qb = reference_field_scores(DOCS, 'qb_content', query)
+    # apple matches both fields and is scored by the better one rather than their sum
+    apple = dict(index.search([query], None)[0])['apple']
+    assert apple == pytest.approx(max(wiki[0], qb[0]), rel=1e-6)
+    assert apple < wiki[0] + qb[0]
+
+    for wiki_boost, qb_boost in [(1, 1), (1, 3), (4, 1), (.5, 2)]:
+        assert_guesses_equal(
+            index.search([query], None, wiki_boost=wiki_boost, qb_boost=qb_boost)[0],
+            reference_search(DOCS, query, wiki_boost=wiki_boost, qb_boost=qb_boost)
+        )
+
+
+def test_pages_are_scored_by_their_best_document():
+    docs = DOCS + [('banana', '', 'pie pie pie'), ('banana', 'yellow curved fruit', '')]
+    index = build_index(docs)
+    for query in ['pie', 'yellow fruit', 'red pie tart']:
+        assert_guesses_equal(index.search([query], None)[0], reference_search(docs, query))
+
+
+def test_max_n_guesses_and_score_normalization():
+    index = build_index()
+    query = 'red fruit pie'
+    expected = reference_search(DOCS, query)
+    assert len(expected) == 3
+    assert_guesses_equal(index.search([query], 2)[0], expected[:2])
+    normalized = index.search([query], None, normalize_score_by_length=True)[0]
+    assert_guesses_equal(normalized, [(page, score / 3) for page, score in expected])
+
+
+def test_batches_match_single_queries():
+    index = build_index()
+    queries = ['red', 'fruit pie', 'tart', 'nothing here', 'yellow red']
+    batched = index.search(queries, None, chunk_size=2)
+    for query, guesses in zip(queries, batched):
+        assert guesses == index.search([query], None)[0]
+
+
+def test_save_load_memory_maps_postings(tmp_path):
+    index = build_index()
+    index.save(str(tmp_path))
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(BM25Index.files())
+
+    loaded = BM25Index.load(str(tmp_path))
+    assert (loaded.k1, loaded.b, loaded.pages) == (index.k1, index.b, index.pages)
+    for field in FIELDS:
+        postings = loaded.postings[field]
+        assert is_memory_mapped(postings.data)
+        assert is_memory_mapped(postings.indices)
+        assert is_memory_mapped(postings.indptr)
+        assert (postings != index.postings[field]).nnz == 0
+
+    queries = ['red pie', 'yellow fruit', 'cherry tart', 'apple']
+    assert loaded.search(queries, 2, wiki_boost=2) == index.search(queries, 2, wiki_boost=2)
+
+
+def test_guesser_train_save_load(tmp_path):
+    guesser = BM25Guesser(0)
+    guesser.use_wiki = False
+    guesser.qb_boost = 1
+    guesser.normalize_score_by_length = False
+    sentences = [['apple pie', 'red apple'], ['yellow fruit'], ['cherry tart'], ['banana split']]
+    pages = ['apple', 'banana', 'cherry', 'banana']
+    guesser.train((sentences, pages))
+    guesser.save(str(tmp_path))
+
+    loaded = BM25Guesser.load(str(tmp_path))
+    questions = ['red apple', 'banana fruit', 'tart']
+    guesses = loaded.guess(questions, 1)
+    assert [g[0][0] for g in guesses] == ['apple', 'banana', 'cherry']
+    assert guesses == guesser.guess(questions, 1)
@@ -0,0 +1,196 @@
+import json
+import random
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import elasticsearch
+import pytest
+from elasticsearch_dsl.connections import connections
+
+from qanta.guesser import elasticsearch as es_guesser
+from qanta.guesser.elasticsearch import ElasticSearchIndex, bounded_thread_map
+
+
+INDEX = 'qb_bulk_test'
+
+
+class RecordingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), RecordingHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.refresh_interval = None
+        self.index_exists = True
+        self.fail_bulk_after = None
+
+    @property
+    def bulk_payloads(self):
+        return [body for method, path, body in self.requests if path.startswith('/_bulk')]
+
+    @property
+    def refresh_intervals(self):
+        intervals = []
+        for method, path, body in self.requests:
+            if method == 'PUT' and path.startswith(f'/{INDEX}/_settings'):
+                settings = json.loads(body)
+                if 'refresh_interval' in settings.get('index', {}):
+                    intervals.append(settings['index']['refresh_interval'])
+        return intervals
+
+
+class RecordingHandler(BaseHTTPRequestHandler):
+    """
+    Stand in for the parts of the elasticsearch REST API used while indexing. Every request is recorded, bulk
+    requests are acknowledged item by item, and refresh_interval settings are stored so they can be read back.
+    """
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, body=None):
+        payload = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length).decode('utf-8')
+        path = self.path
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, path, body))
+            n_bulk = len(server.bulk_payloads)
+
+        if self.command == 'HEAD' and path.split('?')[0] == f'/{INDEX}':
+            self._respond(200 if server.index_exists else 404)
+        elif path.startswith('/_bulk'):
+            if server.fail_bulk_after is not None and n_bulk > server.fail_bulk_after:
+                self._respond(500, {'error': 'bulk rejected', 'status': 500})
+                return
+            lines = [json.loads(line) for line in body.splitlines() if len(line) > 0]
+            items = [
+                {'index': {'_index': INDEX, '_id': str(i), 'status': 201, 'result': 'created'}}
+                for i in range(0, len(lines), 2)
+            ]
+            self._respond(200, {'took': 1, 'errors': False, 'items': items})
+        elif self.command == 'GET' and path.startswith(f'/{INDEX}/_settings'):
+            settings = {} if server.refresh_interval is None else {
+                'index': {'refresh_interval': server.refresh_interval}
+            }
+            self._respond(200, {INDEX: {'settings': settings}})
+        elif self.command == 'PUT' and path.startswith(f'/{INDEX}/_settings'):
+            index_settings = json.loads(body).get('index', {})
+            if 'refresh_interval' in index_settings:
+                server.refresh_interval = index_settings['refresh_interval']
+            self._respond(200, {'acknowledged': True})
+        else:
+            self._respond(200, {'acknowledged': True, '_shards': {'total': 1, 'successful': 1, 'failed': 0}})
+
+    do_GET = do_PUT = do_POST = do_HEAD = do_DELETE = _handle
+
+
+@pytest.fixture
+def server():
+    server = RecordingServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    connections.create_connection(hosts=[f'127.0.0.1:{server.server_port}'], max_retries=0)
+    yield server
+    server.shutdown()
+    server.server_close()
+    connections.create_connection(hosts=['localhost'])
+
+
+def bulk_documents(payload):
+    lines = [json.loads(line) for line in payload.splitlines() if len(line) > 0]
+    assert all('index' in action and action['index']['_index'] == INDEX for action in lines[::2])
+    return lines[1::2]
+
+
+def test_bulk_index_batches_actions(server):
+    server.refresh_interval = '30s'
+    index = ElasticSearchIndex(name=INDEX, bulk_batch_size=3)
+    index.bulk_index(index._doc_action(page=f'page_{i}', qb_content=f'text {i}') for i in range(10))
+
+    batches = [bulk_documents(p) for p in server.bulk_payloads]
+    assert [len(b) for b in batches] == [3, 3, 3, 1]
+    assert [d['page'] for b in batches for d in b] == [f'page_{i}' for i in range(10)]
+    assert server.refresh_intervals == ['-1', '30s']
+    methods_paths = [(m, p.split('?')[0]) for m, p, _ in server.requests]
+    # the index is refreshed once after refresh_interval is restored
+    assert methods_paths[-1] == ('POST', f'/{INDEX}/_refresh')
+
+
+def test_bulk_index_resets_unset_refresh_interval_to_default(server):
+    index = ElasticSearchIndex(name=INDEX, bulk_batch_size=2)
+    index.bulk_index(index._doc_action(page='p', qb_content='text') for _ in range(3))
+    assert server.refresh_intervals == ['-1', None]
+
+
+def test_bulk_index_restores_refresh_interval_when_actions_fail(server):
+    server.refresh_interval = '5s'
+    index = ElasticSearchIndex(name=INDEX, bulk_batch_size=2)
+
+    def actions():
+        for i in range(5):
+            yield index._doc_action(page=f'page_{i}', qb_content='text')
+        raise RuntimeError('failed to produce documents')
+
+    with pytest.raises(RuntimeError):
+        index.bulk_index(actions())
+    assert server.refresh_intervals == ['-1', '5s']
+    assert server.refresh_interval == '5s'
+
+
+def test_bulk_index_restores_refresh_interval_when_bulk_request_fails(server):
+    server.refresh_interval = '5s'
+    server.fail_bulk_after = 1
+    index = ElasticSearchIndex(name=INDEX, bulk_batch_size=2)
+    with pytest.raises(elasticsearch.exceptions.TransportError):
+        index.bulk_index(index._doc_action(page=f'page_{i}', qb_content='text') for i in range(10))
+    assert len(server.bulk_payloads) == 2
+    assert server.refresh_intervals == ['-1', '5s']
+
+
+def test_bounded_thread_map_keeps_order_and_items():
+    rng = random.Random(0)
+    delays = [rng.random() / 500 for _ in range(200)]
+
+    def work(i):
+        time.sleep(delays[i])
+        return i * i
+
+    assert list(bounded_thread_map(work, range(200), n_threads=8, window=5)) == [i * i for i in range(200)]
+
+
+class FakePage:
+    def __init__(self, text):
+        self.text = text
+
+
+def test_build_many_docs_indexes_every_chunk(server, monkeypatch):
+    # 60 pages with up to 450 tokens each are chunked into 200 token documents by the producer threads
+    wiki = {f'page_{i}': FakePage(' '.join(f'w{i}_{j}' for j in range(i * 7 % 450))) for i in range(60)}
+    monkeypatch.setattr(es_guesser, 'Wikipedia', lambda: wiki)
+    monkeypatch.setattr(es_guesser, 'word_tokenize', str.split)
+    server.index_exists = False
+    pages = list(wiki) + ['missing_page']
+    index = ElasticSearchIndex(name=INDEX, bulk_batch_size=7, n_producer_threads=4)
+    index.build_many_docs(pages, [], use_qb=False, use_wiki=True)
+
+    documents = [d for p in server.bulk_payloads for d in bulk_documents(p)]
+    expected = []
+    for page in pages:
+        tokens = wiki[page].text.split() if page in wiki else []
+        for i in range(0, len(tokens), 200):
+            expected.append((page, ' '.join(tokens[i:i + 200])))
+    assert [(d['page'], d['wiki_content']) for d in documents] == expected
+    assert all(len(bulk_documents(p)) <= 7 for p in server.bulk_payloads)
+    assert server.refresh_intervals == ['-1', None]
@@ -0,0 +1,72 @@
+import random
+
+import numpy as np
+import pytest
+
+from qanta.guesser.abstract import AbstractGuesser
+from qanta.guesser.tfidf import TfidfGuesser, _cumulative_counts
+
+
+WORDS = ['the', 'author', 'of', 'this', 'novel', 'wrote', 'about', 'a', 'whale', 'named', 'Moby', 'Dick',
+         'for', '10', 'points', 'name', 'composer', 'symphony', 'fantastique', 'Berlioz', 'river', 'Nile', 'x',
+         # prefixes of other words so that tokens cut by the prefix boundary are in the vocabulary
+         'wh', 'wha', 'Mo', 'Mob', 'comp', 'Ber']
+
+
+def random_text(rng, n_words):
+    text = ' '.join(rng.choice(WORDS) for _ in range(n_words))
+    return text.replace(' x ', ', ').replace(' a ', ' a-')
+
+
+@pytest.fixture
+def guesser():
+    rng = random.Random(0)
+    questions = [[random_text(rng, 30)] for _ in range(40)]
+    answers = [f'answer_{i % 8}' for i in range(40)]
+    guesser = TfidfGuesser(None)
+    guesser.train((questions, answers))
+    return guesser
+
+
+def all_char_indices(text):
+    return list(range(len(text) + 1))
+
+
+def assert_incremental_matches_prefixes(guesser, questions, char_indices):
+    incremental = guesser.guess_incremental(questions, char_indices, 5)
+    expected = AbstractGuesser.guess_incremental(guesser, questions, char_indices, 5)
+    for question_guesses, question_expected in zip(incremental, expected):
+        assert len(question_guesses) == len(question_expected)
+        for prefix_guesses, prefix_expected in zip(question_guesses, question_expected):
+            assert [s for _, s in prefix_guesses] == pytest.approx([s for _, s in prefix_expected], abs=1e-12)
+
+
+def test_guess_incremental_matches_guessing_each_prefix(guesser):
+    rng = random.Random(1)
+    questions = [random_text(rng, 25) for _ in range(5)] + ['', 'Moby Moby Moby Dick Dick the the']
+    assert_incremental_matches_prefixes(guesser, questions, [all_char_indices(q) for q in questions])
+
+    sparse_indices = [sorted(rng.sample(range(len(q) + 1), min(5, len(q) + 1))) for q in questions]
+    assert_incremental_matches_prefixes(guesser, questions, sparse_indices)
+
+
+def test_custom_token_pattern_falls_back_to_prefixes(guesser):
+    guesser.tfidf_vectorizer.token_pattern = r'(?u)\b\w+\b'
+    assert not guesser._supports_incremental()
+    questions = ['a whale named Moby Dick', 'the composer Berlioz']
+    assert_incremental_matches_prefixes(guesser, questions, [all_char_indices(q) for q in questions])
+
+
+def test_cumulative_counts():
+    # group 0 covers rows 0-3 and group 1 rows 4-5, col 7 is incremented twice in row 1
+    rows = np.array([1, 0, 1, 2, 4, 5])
+    cols = np.array([7, 3, 7, 3, 3, 3])
+    groups = np.array([0, 0, 0, 0, 1, 1])
+    counts = {}
+    for r, c, v in zip(*_cumulative_counts(rows, cols, groups, np.array([4, 6]))):
+        counts[r, c] = counts.get((r, c), 0) + v
+    assert counts == {
+        (0, 3): 1, (1, 3): 1, (2, 3): 2, (3, 3): 2,
+        (1, 7): 2, (2, 7): 2, (3, 7): 2,
+        (4, 3): 1, (5, 3): 2
+    }